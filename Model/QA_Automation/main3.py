@@ -1,24 +1,35 @@
 import logging
 import numpy as np
-import pandas as pd
 import time
-from io import BytesIO
+import tempfile
+import zipfile
 import asyncio
+import uuid
 from datetime import datetime
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException, File, UploadFile, Depends
+from typing import List, Dict, Optional, Tuple
+from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from transformers import AutoModel, AutoTokenizer
 from pandas import errors as pd_errors
+from openpyxl.utils.exceptions import InvalidFileException
 import atexit
 import os
 from utils import (
-    state, AppState, get_app_state, clean_text, count_records, load_data_db,
+    state, AppState, get_app_state, clean_text,
     save_data_batch, encode_text_batch, save_faiss_index, save_cache,
-    initialize_cache_and_index, init_db_pool, close_db_state, init_db,
-    CACHE_PATH, FAISS_INDEX_PATH, FINE_TUNE_THRESHOLD, FINE_TUNE_INTERVAL
+    initialize_cache_and_index, init_db_pool, close_db_state, init_db, import_records_stream, append_to_cache,
+    sync_new_records, create_import_job, get_import_job, get_corpus_stats,
+    CACHE_PATH, FINE_TUNE_THRESHOLD, SUPPORTED_UPLOAD_EXTENSIONS,
+    IMPORT_STAGING_DIR, serving_model_path, load_projection, answer_hash, get_row_index, edit_record,
+    delete_record, compact_cache, get_lexical_index, ensure_lexical_index, BM25Index,
+    LEXICAL_PREBUILD, publish_mutation, consume_mutations, AdmissionController, reserve_fine_tune,
+    release_fine_tune, acquire_leadership, release_leadership, current_leader, get_schedule, set_schedule_enabled,
+    advance_schedule, CollectionRegistry, RequestTrace, current_trace, trace_span, sample_stacks,
+    PROFILING_ENABLED, PROFILE_MAX_SECONDS, export_snapshot, restore_snapshot, warm_start_from_snapshot, REPLICA_ID,
+    SCHEDULER_TICK, FINE_TUNE_PENDING_KEY,
+    TOMBSTONE_COMPACT_THRESHOLD, TrafficRecorder, current_capture, capture_shape, text_shape, TRAFFIC_CAPTURE
 )
 from sentence_transformers import SentenceTransformer
 
@@ -33,6 +44,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+UPLOAD_READ_BLOCK = 1024 * 1024  # 1 MB mỗi lần đọc file tải lên
+# Chế độ lấy ứng viên khi tìm kiếm: "range" (range_search theo ngưỡng), "adaptive" (tăng dần số láng giềng),
+# "fixed" (luôn lấy k * 4 như trước), "hybrid" (BM25 trước, chỉ gọi encoder khi kết quả từ vựng chưa chắc chắn)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "adaptive")
+SEARCH_MODES = ("range", "adaptive", "fixed", "hybrid")
+# Chế độ hybrid: trả lời thẳng từ BM25 khi điểm chuẩn hóa của nhóm đầu >= LEXICAL_CONFIDENCE và gấp
+# LEXICAL_MARGIN lần nhóm thứ hai; ngược lại trộn thứ hạng BM25 và dense bằng reciprocal rank fusion
+LEXICAL_CONFIDENCE = float(os.getenv("LEXICAL_CONFIDENCE", 0.9))
+LEXICAL_MARGIN = float(os.getenv("LEXICAL_MARGIN", 1.5))
+HYBRID_LEXICAL_MIN_SCORE = float(os.getenv("HYBRID_LEXICAL_MIN_SCORE", 0.5))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+# Kiểm soát tải /search: số request xử lý đồng thời, độ dài hàng đợi và deadline mặc định (ms)
+SEARCH_MAX_IN_FLIGHT = int(os.getenv("SEARCH_MAX_IN_FLIGHT", os.cpu_count() or 4))
+SEARCH_MAX_QUEUE = int(os.getenv("SEARCH_MAX_QUEUE", 64))
+SEARCH_DEFAULT_DEADLINE_MS = int(os.getenv("SEARCH_DEFAULT_DEADLINE_MS", 5000))
+search_admission = AdmissionController(SEARCH_MAX_IN_FLIGHT, SEARCH_MAX_QUEUE)
+# Các collection ngoài "default" được nạp khi dùng lần đầu, dùng chung encoder với state gốc
+collections = CollectionRegistry(state)
+# Ghi traffic ẩn danh cho replay.py (TRAFFIC_CAPTURE=true)
+CAPTURED_PATHS = ("/search", "/update", "/upload-excel")
+traffic_recorder = TrafficRecorder() if TRAFFIC_CAPTURE else None
+
 # Khởi tạo FastAPI
 app = FastAPI()
 
@@ -45,138 +78,289 @@ app = FastAPI()
 #     allow_headers=["*"],
 # )
 
-# API tải lên file Excel
+# Trace theo request: gửi header X-Trace để nhận thời gian từng stage qua header Server-Timing
+@app.middleware("http")
+async def request_trace_middleware(request: Request, call_next):
+    if "x-trace" not in request.headers:
+        return await call_next(request)
+    trace = RequestTrace(uuid.uuid4().hex[:16])
+    token = current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_trace.reset(token)
+    trace.record("total", time.perf_counter() - start)
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Trace-Id"] = trace.trace_id
+    logger.info(f"Trace {trace.trace_id} {request.method} {request.url.path}: {trace.summary()}")
+    return response
+
+# Ghi lại hình dạng và thời gian xử lý của các request cần replay; endpoint bổ sung shape qua capture_shape
+@app.middleware("http")
+async def traffic_capture_middleware(request: Request, call_next):
+    if traffic_recorder is None or request.url.path not in CAPTURED_PATHS or not traffic_recorder.should_capture():
+        return await call_next(request)
+    shape = {}
+    token = current_capture.set(shape)
+    started_at = time.time()
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        current_capture.reset(token)
+        traffic_recorder.record(request.method, request.url.path, started_at, time.monotonic() - started, status, shape)
+
+# Kích hoạt fine-tune nếu đủ bản ghi mới (kiểm tra O(1) trên bảng qa_stats)
+async def maybe_trigger_fine_tune(state: AppState) -> bool:
+    try:
+        owner = await reserve_fine_tune(state)
+        if not owner:
+            return False
+        logger.info(f"New records >= {FINE_TUNE_THRESHOLD}, triggering fine-tuning")
+        enqueue_fine_tune(state, owner)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to trigger fine-tuning: {e}")
+        return False
+
+# Đưa fine_tune_task vào Celery sau khi đã giữ chỗ; trả lại chỗ nếu không gửi được
+def enqueue_fine_tune(state: AppState, owner: str):
+    from tasks import fine_tune_task
+    try:
+        fine_tune_task.delay(owner)
+    except Exception:
+        release_fine_tune(state.redis_client, owner)
+        raise
+    state.last_fine_tune = time.time()
+
+# Lưu file tải lên xuống thư mục tạm theo từng khối, không đọc toàn bộ vào bộ nhớ
+async def stage_upload(file: UploadFile, directory: str = None) -> str:
+    suffix = os.path.splitext(file.filename)[1].lower()
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="qa_upload_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                block = await file.read(UPLOAD_READ_BLOCK)
+                if not block:
+                    break
+                f.write(block)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+# API tải lên file dữ liệu (Excel, CSV, JSONL, Parquet)
 @app.post("/upload-excel")
-async def upload_excel(file: UploadFile = File(...), state: AppState = Depends(get_app_state)):
-    if not file.filename.endswith((".xls", ".xlsx")):
-        raise HTTPException(status_code=400, detail="Only Excel files (.xls, .xlsx) supported")
+async def upload_excel(file: UploadFile = File(...), collection: Optional[str] = None,
+                       state: AppState = Depends(get_app_state)):
+    if not file.filename.lower().endswith(SUPPORTED_UPLOAD_EXTENSIONS):
+        raise HTTPException(status_code=400, detail=f"Only {', '.join(SUPPORTED_UPLOAD_EXTENSIONS)} files supported")
+    staged_path = None
     try:
+        state = await collections.get(collection)
         if state.db_pool is None:
             logger.error("Database pool is not initialized")
             raise HTTPException(status_code=500, detail="Database connection not initialized")
-        contents = await file.read()
-        df = pd.read_excel(BytesIO(contents), engine='openpyxl')
-        if 'question' not in df.columns or 'answer' not in df.columns:
-            raise HTTPException(status_code=400, detail="Excel must have 'question' and 'answer' columns")
-        if len(df) > 10000:
-            raise HTTPException(status_code=400, detail="Exceed 10,000 records")
-
-        # Kiểm tra và chuyển đổi kiểu dữ liệu trước khi gọi .str methods
-        for col in ['question', 'answer']:
-            if df[col].isnull().any() or not pd.api.types.is_string_dtype(df[col]):
-                df[col] = df[col].fillna('').astype(str)  # Điền null bằng chuỗi rỗng và chuyển thành chuỗi
-            df[col] = df[col].str.strip() #loai bỏ khoảng trắng thừa
-            if df[col].str.len().eq(0).any():
-                raise HTTPException(status_code=400, detail="Questions and answers cannot be empty")
-
-        records = []
-        new_embeddings = []
-        skipped_empty = 0
-        skipped_duplicate = 0
-        async with state.db_pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                for _, row in df.iterrows(): #lặp qua từng hàng
-                    q = row['question']
-                    a = row['answer']
-                    q_clean = clean_text(q)
-                    a_clean = clean_text(a)
-                    if not q_clean or not a_clean:
-                        logger.info(f"Skipped empty question-answer pair after cleaning: question='{q}', answer='{a}'")
-                        skipped_empty += 1
-                        continue
-                    await cursor.execute(
-                        "SELECT id FROM qa_data WHERE question = %s AND answer = %s LIMIT 1",
-                        (q, a)
-                    )
-                    if await cursor.fetchone():
-                        logger.info(f"Skipped duplicate question-answer pair: {q}")
-                        skipped_duplicate += 1
-                        continue
-                    emb = encode_text_batch([q_clean], state)[0]
-                    records.append((datetime.now(), q, a, emb.tobytes()))
-                    new_embeddings.append((emb, q, a, q_clean, a_clean))
-        if not records:
+        with trace_span("stage_upload"):
+            staged_path = await stage_upload(file)
+        capture_shape(collection=state.collection, extension=os.path.splitext(file.filename)[1].lower(),
+                      bytes=os.path.getsize(staged_path))
+        stats = await import_records_stream(staged_path, state)
+        capture_shape(parsed=stats['parsed'], inserted=stats['inserted'], skipped_empty=stats['skipped_empty'],
+                      skipped_duplicate=stats['skipped_duplicate'])
+        skipped_empty = stats['skipped_empty']
+        skipped_duplicate = stats['skipped_duplicate']
+        if not stats['inserted']:
             logger.error(f"No valid records to save: {skipped_empty} empty after cleaning, {skipped_duplicate} duplicates")
             raise HTTPException(
                 status_code=401,
                 detail=f"No valid records to save: {skipped_empty} empty after cleaning, {skipped_duplicate} duplicates"
             )
-        inserted_data = await save_data_batch(records, state) # trả về danh sách (id, question, answer)
-        inserted_ids = [data[0] for data in inserted_data]
-        new_questions = [data[1] for data in new_embeddings]
-        new_answers = [data[2] for data in new_embeddings]
-        new_clean_questions = [data[3] for data in new_embeddings]
-        new_clean_answers = [data[4] for data in new_embeddings]
-        new_embs = [data[0] for data in new_embeddings]
-        if state.cache_data['embeddings'].size:
-            state.cache_data['embeddings'] = np.vstack([state.cache_data['embeddings'], new_embs]) # Gộp với dữ liệu cũ bằng np.vstack hoặc tạo mới.
-        else:
-            state.cache_data['embeddings'] = np.array(new_embs)
-        state.cache_data['ids'].extend(inserted_ids)
-        state.cache_data['questions'].extend(new_questions)
-        state.cache_data['answers'].extend(new_answers)
-        state.cache_data['clean_questions'] = state.cache_data.get('clean_questions', []) + new_clean_questions
-        state.cache_data['clean_answers'] = state.cache_data.get('clean_answers', []) + new_clean_answers
-        state.cache_data['last_updated'] = datetime.now()
-        save_cache(state.cache_data, CACHE_PATH, state.redis_client)
-        state.index.add_with_ids(
-            np.array(new_embs).astype(np.float32),
-            np.array(inserted_ids, dtype=np.int64)
-        )
-        save_faiss_index(state.index, FAISS_INDEX_PATH, state.redis_client)
-        total_records = await count_records(state)
-        new_records = total_records - state.last_fine_tune_record_count
-        fine_tuned = False
-        state.raw_data = await load_data_db(state)
-        if new_records >= FINE_TUNE_THRESHOLD and time.time() - state.last_fine_tune > FINE_TUNE_INTERVAL and len(state.raw_data) >= 10:
-            try:
-                from tasks import fine_tune_task
-                logger.info(f"New records ({new_records}) >= {FINE_TUNE_THRESHOLD}, triggering fine-tuning")
-                fine_tune_task.delay()
-                fine_tuned = True
-                state.last_fine_tune = time.time()
-                state.last_fine_tune_record_count = total_records
-            except ImportError as e:
-                logger.error(f"Failed to import fine_tune_task: {e}")
-        logger.info(f"Uploaded {len(df)} records, saved {len(inserted_ids)} new records, skipped {skipped_duplicate} duplicates")
+        with trace_span("save_cache"):
+            save_cache(state.cache_data, state.cache_path, state.redis_client)
+        with trace_span("save_index"):
+            save_faiss_index(state.index, state.index_path, state.redis_client)
+        corpus_stats = await get_corpus_stats(state)
+        total_records = corpus_stats['total_records']
+        new_records = corpus_stats['new_records']
+        with trace_span("fine_tune_trigger"):
+            fine_tuned = await maybe_trigger_fine_tune(state)
+        message = (f"Uploaded {stats['parsed']} records, saved {stats['inserted']} new records, "
+                   f"skipped {skipped_duplicate} duplicates")
+        logger.info(message)
         return {
-            "message": f"Uploaded {len(df)} records, saved {len(inserted_ids)} new records, skipped {skipped_duplicate} duplicates",
+            "message": message,
             "fine_tuned": fine_tuned,
             "total_records": total_records,
-            "new_records": new_records
+            "new_records": new_records,
+            "skipped_empty": skipped_empty
         }
-    except pd_errors.ParserError:
-        logger.error("Invalid Excel file")
-        raise HTTPException(status_code=400, detail="Invalid Excel file")
+    except (pd_errors.ParserError, zipfile.BadZipFile, InvalidFileException, ValueError) as e:
+        logger.error(f"Invalid upload file: {e}")
+        raise HTTPException(status_code=400, detail="Invalid file")
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=402, detail="Đã xảy ra lỗi không mong muốn, vui lòng thử lại sau")
+    finally:
+        if staged_path and os.path.exists(staged_path):
+            os.remove(staged_path)
+
+# API tạo job nhập dữ liệu: lưu file vào thư mục staging và xử lý bằng Celery, trả về job_id ngay
+@app.post("/import-jobs")
+async def create_import(file: UploadFile = File(...), collection: Optional[str] = None,
+                        state: AppState = Depends(get_app_state)):
+    if not file.filename.lower().endswith(SUPPORTED_UPLOAD_EXTENSIONS):
+        raise HTTPException(status_code=400, detail=f"Only {', '.join(SUPPORTED_UPLOAD_EXTENSIONS)} files supported")
+    staged_path = None
+    try:
+        state = await collections.get(collection)
+        staged_path = await stage_upload(file, IMPORT_STAGING_DIR)
+        job_id = uuid.uuid4().hex
+        create_import_job(state.redis_client, job_id, file.filename, staged_path, state.collection)
+        from tasks import import_task
+        import_task.apply_async(args=[job_id, staged_path, state.collection], task_id=job_id)
+        logger.info(f"Created import job {job_id} for {file.filename}")
+        return {"job_id": job_id, "status": "PENDING"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating import job: {e}")
+        if staged_path and os.path.exists(staged_path):
+            os.remove(staged_path)
+        raise HTTPException(status_code=500, detail=f"Import job error: {str(e)}")
+
+# API kiểm tra tiến độ job nhập dữ liệu
+@app.get("/import-jobs/{job_id}")
+async def get_import_status(job_id: str, state: AppState = Depends(get_app_state)):
+    job = get_import_job(state.redis_client, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    # Worker chỉ ghi vào DB, replica này nạp các bản ghi mới vào cache/index khi job hoàn tất
+    if job['status'] == "SUCCESS":
+        state = await collections.get(job.get('collection'))
+    if job['status'] == "SUCCESS" and job_id not in state.synced_import_jobs:
+        try:
+            synced = await sync_new_records(state)
+            if synced:
+                save_cache(state.cache_data, state.cache_path, state.redis_client)
+                save_faiss_index(state.index, state.index_path, state.redis_client)
+            state.synced_import_jobs.add(job_id)
+        except Exception as e:
+            logger.error(f"Error syncing records for import job {job_id}: {e}")
+    return job
+
+# Đếm số nhóm câu trả lời khác nhau trong các ID đã lấy về
+def count_answer_groups(ids: np.ndarray, state: AppState) -> int:
+    id_to_idx = get_row_index(state)
+    return len({state.cache_data['answer_ids'][id_to_idx[i]] for i in ids if i in id_to_idx})
+
+# Lấy các ứng viên trong ngưỡng khoảng cách, sắp xếp tăng dần
+def retrieve_candidates(query_embedding: np.ndarray, k: int, max_distance_threshold: float, state: AppState,
+                        mode: str = SEARCH_MODE) -> Tuple[np.ndarray, np.ndarray]:
+    query_vector = query_embedding.reshape(1, -1).astype(np.float32)
+    ntotal = state.index.ntotal
+    if ntotal == 0:
+        return np.array([]), np.array([], dtype=np.int64)
+    if mode == "range":
+        # range_search trả về các vector có khoảng cách < radius, cộng epsilon để giữ điều kiện <=
+        lims, distances, ids = state.index.range_search(query_vector, max_distance_threshold + 1e-6)
+        order = np.argsort(distances[lims[0]:lims[1]], kind="stable")
+        return distances[order], ids[order]
+    fetch = min(k * 4, ntotal)
+    while True:
+        distances, ids = state.index.search(query_vector, fetch)
+        distances, ids = distances[0], ids[0]
+        within = (ids >= 0) & (distances <= max_distance_threshold)
+        # Dừng khi đủ k nhóm, khi láng giềng xa nhất đã vượt ngưỡng, hoặc đã lấy hết index
+        if mode == "fixed" or fetch >= ntotal or not within[-1] or count_answer_groups(ids[within], state) >= k:
+            return distances[within], ids[within]
+        fetch = min(fetch * 2, ntotal)
 
 # Hàm tìm kiếm với ngưỡng tương đồng
-def search_answer(query: str, k: int = 5, state: AppState = Depends(get_app_state), max_distance_threshold: float = 1.0) -> List[Dict]:
+def search_answer(query: str, k: int = 5, state: AppState = Depends(get_app_state), max_distance_threshold: float = 1.0,
+                  mode: str = SEARCH_MODE, query_embedding: np.ndarray = None, lexical_hits: List = None) -> List[Dict]:
     if not query.strip(): # Kiểm tra chuỗi query sau khi loại bỏ khoảng trắng Nếu rỗng...
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     query_clean = clean_text(query)
-    query_embedding = encode_text_batch([query_clean], state)[0]
-    distances, indices = state.index.search(query_embedding.reshape(1, -1).astype(np.float32), k * 4)
+    if mode == "hybrid":
+        if lexical_hits is None:
+            with trace_span("lexical"):
+                lexical_hits = lexical_search(query_clean, k, get_lexical_index(state))
+        if lexical_confident(lexical_hits, state):
+            with trace_span("group"):
+                return group_results([None] * len(lexical_hits), [hit[0] for hit in lexical_hits], k, state,
+                                     max_distance_threshold, query_clean,
+                                     rank_keys=[-hit[2] for hit in lexical_hits])
+    if query_embedding is None:
+        with trace_span("encode"):
+            query_embedding = encode_text_batch([query_clean], state)[0]
+    with trace_span("retrieve"):
+        distances, indices = retrieve_candidates(query_embedding, k, max_distance_threshold, state,
+                                                 "adaptive" if mode == "hybrid" else mode)
+    with trace_span("group"):
+        if mode == "hybrid":
+            return fuse_results(distances, indices, lexical_hits, k, state, max_distance_threshold, query_clean)
+        return group_results(distances, indices, k, state, max_distance_threshold, query_clean)
+
+# Lấy ứng viên BM25 (đủ rộng để gom được k nhóm câu trả lời)
+def lexical_search(query_clean: str, k: int, index: BM25Index) -> List[Tuple[int, float, float]]:
+    return index.search(query_clean, k * 4)
+
+# Kết quả từ vựng đủ chắc chắn để bỏ qua encoder: nhóm đầu có điểm chuẩn hóa cao và bỏ xa nhóm thứ hai
+def lexical_confident(lexical_hits: List[Tuple[int, float, float]], state: AppState) -> bool:
+    if not lexical_hits or lexical_hits[0][2] < LEXICAL_CONFIDENCE:
+        return False
+    id_to_idx = get_row_index(state)
+    best = {}
+    for doc_id, score, _ in lexical_hits:
+        if doc_id in id_to_idx:
+            answer_id = state.cache_data['answer_ids'][id_to_idx[doc_id]]
+            best[answer_id] = max(best.get(answer_id, 0.0), score)
+    scores = sorted(best.values(), reverse=True)
+    return bool(scores) and (len(scores) == 1 or scores[0] >= LEXICAL_MARGIN * scores[1])
 
+# Trộn ứng viên dense (trong ngưỡng) và BM25 bằng reciprocal rank fusion; ứng viên chỉ có từ BM25
+# phải đạt HYBRID_LEXICAL_MIN_SCORE để không kéo vào các câu chỉ trùng vài từ phổ biến
+def fuse_results(distances: np.ndarray, indices: np.ndarray, lexical_hits: List[Tuple[int, float, float]], k: int,
+                 state: AppState, max_distance_threshold: float, query_clean: str) -> List[Dict]:
+    fused = {}
+    dense_distance = {}
+    for rank, (distance, i) in enumerate(zip(distances, indices)):
+        i = int(i)
+        dense_distance[i] = float(distance)
+        fused[i] = 1.0 / (HYBRID_RRF_K + rank + 1)
+    for rank, (doc_id, _, normalized) in enumerate(lexical_hits or []):
+        if doc_id in fused or normalized >= HYBRID_LEXICAL_MIN_SCORE:
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (HYBRID_RRF_K + rank + 1)
+    ordered = sorted(fused.items(), key=lambda x: -x[1])
+    return group_results([dense_distance.get(doc_id) for doc_id, _ in ordered], [doc_id for doc_id, _ in ordered],
+                         k, state, max_distance_threshold, query_clean, rank_keys=[-score for _, score in ordered])
+
+# Lọc theo ngưỡng, gom theo answer_id và lấy câu hỏi gần nhất của mỗi nhóm; rank_keys (nhỏ hơn là tốt hơn)
+# thay khoảng cách làm tiêu chí xếp hạng khi ứng viên đến từ BM25/hybrid (distance có thể là None)
+def group_results(distances: np.ndarray, indices: np.ndarray, k: int, state: AppState, max_distance_threshold: float,
+                  query_clean: str, rank_keys: List[float] = None) -> List[Dict]:
     # Lọc các kết quả dựa trên ngưỡng khoảng cách
     valid_results = []
-    id_to_idx = {id_: idx for idx, id_ in enumerate(state.cache_data['ids'])} # Tạo từ điển ánh xạ ID sang chỉ số trong cache.
-    for j, i in enumerate(indices[0]): #lặp qua ds ID từ cache
-        if i in id_to_idx and distances[0][j] <= max_distance_threshold:
+    id_to_idx = get_row_index(state) # Từ điển ánh xạ ID sang chỉ số trong cache.
+    tombstones = state.cache_data.get('tombstones', ())
+    for j, (distance, i) in enumerate(zip(distances, indices)): #lặp qua ds ID từ cache
+        if i in id_to_idx and i not in tombstones:
             idx = id_to_idx[i]      # lấy thông tin từ cache thm vào thêm vào valid result
-            answer = state.cache_data['answers'][idx]
-            question = state.cache_data['questions'][idx]
-            clean_answer = state.cache_data['clean_answers'][idx]
-            distance = float(distances[0][j])
+            distance = None if distance is None else float(distance)
             valid_results.append({
-                "question": question,
-                "answer": answer,
+                "question": state.cache_data['questions'][idx],
                 "distance": distance,
-                "clean_answer": clean_answer
+                "rank": rank_keys[j] if rank_keys is not None else distance,
+                "answer_id": state.cache_data['answer_ids'][idx]
             })
 
     if not valid_results:
@@ -187,44 +371,23 @@ def search_answer(query: str, k: int = 5, state: AppState = Depends(get_app_stat
             "distance": None
         }]
 
-    # Nhóm theo clean_answer và chọn câu hỏi tốt nhất
+    # Nhóm theo answer_id và chọn câu hỏi tốt nhất
     answer_groups = {}
     for result in valid_results:
-        clean_answer = result["clean_answer"]
-        if clean_answer not in answer_groups:
-            answer_groups[clean_answer] = {"questions": [], "min_distance": float('inf')}
-        answer_groups[clean_answer]["questions"].append({"question": result["question"], "distance": result["distance"]})
-        answer_groups[clean_answer]["min_distance"] = min(answer_groups[clean_answer]["min_distance"], result["distance"])
-
-    # Sắp xếp nhóm theo khoảng cách nhỏ nhất
-    sorted_groups = sorted(answer_groups.items(), key=lambda x: x[1]["min_distance"])
+        group = answer_groups.setdefault(result["answer_id"], {"questions": [], "min_rank": float('inf')})
+        group["questions"].append({"question": result["question"], "distance": result["distance"], "rank": result["rank"]})
+        group["min_rank"] = min(group["min_rank"], result["rank"])
+
+    # Sắp xếp nhóm theo khoảng cách (hoặc rank) nhỏ nhất, lấy câu hỏi tốt nhất trong mỗi nhóm
+    sorted_groups = sorted(answer_groups.items(), key=lambda x: x[1]["min_rank"])
     results = []
-    used_clean_answers = set()
-
-    # lấy ch s nhỏ nhâ trong nhom
-    if sorted_groups:
-        top_clean_answer, top_group = sorted_groups[0]
-        top_question = min(top_group["questions"], key=lambda x: x["distance"])
-        idx = state.cache_data['clean_answers'].index(top_clean_answer)
-        top_answer = state.cache_data['answers'][idx]
+    for answer_id, group in sorted_groups[:k]:
+        best_question = min(group["questions"], key=lambda x: x["rank"])
         results.append({
-            "question": top_question["question"],
-            "answer": top_answer,
-            "distance": top_question["distance"]
+            "question": best_question["question"],
+            "answer": state.cache_data['answers'][answer_id][0],
+            "distance": best_question["distance"]
         })
-        used_clean_answers.add(top_clean_answer)
-
-    for clean_answer, group in sorted_groups[1:]:
-        if clean_answer not in used_clean_answers and len(results) < k:
-            best_question = min(group["questions"], key=lambda x: x["distance"])
-            idx = state.cache_data['clean_answers'].index(clean_answer)
-            answer = state.cache_data['answers'][idx]
-            results.append({
-                "question": best_question["question"],
-                "answer": answer,
-                "distance": best_question["distance"]
-            })
-            used_clean_answers.add(clean_answer)
 
     if len(results) < k:
         logger.warning(f"Only found {len(results)} unique answers within threshold for query: {query_clean}")
@@ -234,11 +397,49 @@ def search_answer(query: str, k: int = 5, state: AppState = Depends(get_app_stat
 class Query(BaseModel):
     question: str
     max_distance_threshold: float = 1.0
+    mode: Optional[str] = None
+    collection: Optional[str] = None
+
+# Mã hóa câu truy vấn (phần tốn CPU nhất), chạy trong thread để không chặn event loop
+def encode_query(question: str, state: AppState) -> np.ndarray:
+    return encode_text_batch([clean_text(question)], state)[0]
 
 @app.post("/search")
-async def search(query: Query, state: AppState = Depends(get_app_state)):
+async def search(query: Query, state: AppState = Depends(get_app_state),
+                 deadline_ms: Optional[int] = Header(None, alias="X-Request-Deadline-Ms")):
     try:
-        results = search_answer(query.question, k=5, state=state, max_distance_threshold=query.max_distance_threshold)
+        if query.mode and query.mode not in SEARCH_MODES:
+            raise HTTPException(status_code=400, detail=f"Search mode must be one of {', '.join(SEARCH_MODES)}")
+        if not query.question.strip():
+            raise HTTPException(status_code=400, detail="Query cannot be empty")
+        capture_shape(question=text_shape(query.question), mode=query.mode or SEARCH_MODE,
+                      threshold=query.max_distance_threshold, collection=query.collection, deadline_ms=deadline_ms)
+        # Deadline do bên gọi truyền (thời gian còn lại, ms); request không kịp xử lý bị từ chối sớm
+        budget = (deadline_ms if deadline_ms and deadline_ms > 0 else SEARCH_DEFAULT_DEADLINE_MS) / 1000
+        mode = query.mode or SEARCH_MODE
+        # Nạp collection (và chỉ mục BM25) trước khi vào hàng đợi: thời gian nạp nguội không chiếm slot xử lý
+        # và không tính vào thời gian phục vụ trung bình, nhưng vẫn trừ vào deadline của request
+        load_start = time.perf_counter()
+        with trace_span("collection"):
+            state = await collections.get(query.collection)
+            lexical_index = await ensure_lexical_index(state) if mode == "hybrid" else None
+        budget -= time.perf_counter() - load_start
+        async with search_admission.admit(budget) as deadline:
+            lexical_hits = None
+            query_embedding = None
+            if mode == "hybrid":
+                # BM25 chạy trong thread; encoder chỉ được gọi khi kết quả từ vựng chưa chắc chắn
+                search_admission.check_deadline(deadline, "lexical")
+                with trace_span("lexical"):
+                    lexical_hits = await asyncio.to_thread(lexical_search, clean_text(query.question), 5, lexical_index)
+            if mode != "hybrid" or not lexical_confident(lexical_hits, state):
+                search_admission.check_deadline(deadline, "encode")
+                with trace_span("encode"):
+                    query_embedding = await asyncio.to_thread(encode_query, query.question, state)
+            search_admission.check_deadline(deadline, "search")
+            results = search_answer(query.question, k=5, state=state, max_distance_threshold=query.max_distance_threshold,
+                                    mode=mode, query_embedding=query_embedding, lexical_hits=lexical_hits)
+        capture_shape(encoded=query_embedding is not None, results=len(results))
         logger.info(f"Search query: {query.question}, found {len(results)} results")
         return results
     except HTTPException as e:
@@ -248,19 +449,58 @@ async def search(query: Query, state: AppState = Depends(get_app_state)):
         logger.error(f"Search error: {e}")
         raise HTTPException(status_code=500, detail="Lỗi tìm kiếm, vui lòng thử lại sau")
 
+# API xem số liệu kiểm soát tải của /search
+@app.get("/metrics/search")
+async def search_metrics():
+    return search_admission.snapshot()
+
+# API chụp sampling profile của tiến trình API trong một khoảng thời gian (định dạng folded cho flame graph)
+profile_lock = asyncio.Lock()
+
+@app.post("/admin/profile")
+async def capture_profile(seconds: float = 10, interval_ms: float = 10):
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=403, detail="Profiling is disabled (set PROFILING_ENABLED=true)")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        logger.info(f"Capturing {seconds}s sampling profile every {interval_ms}ms")
+        folded = await asyncio.to_thread(sample_stacks, seconds, max(interval_ms, 1) / 1000)
+    filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    return PlainTextResponse(folded, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# API xem các collection đang được nạp và bộ nhớ sử dụng
+@app.get("/collections")
+async def list_collections():
+    return collections.snapshot()
+
+# API xuất snapshot để khởi động nhanh replica mới (SNAPSHOT_BUNDLE=<đường dẫn bundle>)
+@app.post("/snapshots")
+async def create_snapshot(state: AppState = Depends(get_app_state)):
+    try:
+        manifest = await export_snapshot(state)
+        return {key: value for key, value in manifest.items() if key != "files"}
+    except Exception as e:
+        logger.error(f"Snapshot export error: {e}")
+        raise HTTPException(status_code=500, detail=f"Snapshot export error: {str(e)}")
+
 # API cập nhật dữ liệu
 class UpdateData(BaseModel):
     question: str
     answer: str
+    collection: Optional[str] = None
 
 @app.post("/update")
 async def update(data_input: UpdateData, state: AppState = Depends(get_app_state)):
     try:
+        state = await collections.get(data_input.collection)
         if state.db_pool is None:
             logger.error("Database pool is not initialized")
             raise HTTPException(status_code=500, detail="Database connection not initialized")
         question = data_input.question
         answer = data_input.answer
+        capture_shape(question=text_shape(question), answer=text_shape(answer), collection=state.collection)
         question_clean = clean_text(question)
         answer_clean = clean_text(answer)
         if not question_clean or not answer_clean:
@@ -268,45 +508,94 @@ async def update(data_input: UpdateData, state: AppState = Depends(get_app_state
         async with state.db_pool.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(
-                    "SELECT id FROM qa_data WHERE question = %s AND answer = %s LIMIT 1",
-                    (question, answer)
+                    f"SELECT d.id FROM {state.data_table} d JOIN {state.answers_table} a ON a.id = d.answer_id "
+                    "WHERE d.question = %s AND a.answer_hash = %s LIMIT 1",
+                    (question, answer_hash(answer))
                 )
                 if await cursor.fetchone():
                     logger.info(f"Skipped duplicate question-answer pair: {question}")
+                    capture_shape(inserted=False)
                     return {"message": False}
         new_embedding = encode_text_batch([question_clean], state)[0]
-        new_id, q_saved, a_saved = (await save_data_batch(
+        new_id, q_saved, a_saved, answer_id = (await save_data_batch(
             [(datetime.now(), question, answer, new_embedding.tobytes())], state
         ))[0]
         state.index.add_with_ids(
             new_embedding.reshape(1, -1).astype(np.float32),
             np.array([new_id], dtype=np.int64)
         )
-        if state.cache_data['embeddings'].size:
-            state.cache_data['embeddings'] = np.vstack([state.cache_data['embeddings'], new_embedding])
-        else:
-            state.cache_data['embeddings'] = new_embedding.reshape(1, -1)
-        state.cache_data['ids'].append(new_id)
-        state.cache_data['questions'].append(question)
-        state.cache_data['answers'].append(answer)
-        state.cache_data['clean_questions'] = state.cache_data.get('clean_questions', []) + [question_clean]
-        state.cache_data['clean_answers'] = state.cache_data.get('clean_answers', []) + [answer_clean]
-        state.cache_data['last_updated'] = datetime.now()
-        save_cache(state.cache_data, CACHE_PATH, state.redis_client)
-        save_faiss_index(state.index, FAISS_INDEX_PATH, state.redis_client)
+        append_to_cache(state, [new_id], new_embedding, [question], [question_clean], [answer_id],
+                        {answer_id: (answer, answer_clean)})
+        publish_mutation(state.redis_client, "insert", [new_id], new_embedding.reshape(1, -1), stream=state.mutation_stream,
+                         questions=[question], clean_questions=[question_clean], answer_ids=[answer_id],
+                         answers={answer_id: [answer, answer_clean]})
+        save_cache(state.cache_data, state.cache_path, state.redis_client)
+        save_faiss_index(state.index, state.index_path, state.redis_client)
         logger.info(f"Updated data with ID: {new_id}")
+        capture_shape(inserted=True)
         return {"message": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Update error: {e}")
         raise HTTPException(status_code=500, detail=f"Update error: {str(e)}")
 
+# API sửa một cặp hỏi đáp
+@app.put("/qa/{qa_id}")
+async def edit_qa(qa_id: int, data_input: UpdateData, state: AppState = Depends(get_app_state)):
+    try:
+        state = await collections.get(data_input.collection)
+        if state.db_pool is None:
+            logger.error("Database pool is not initialized")
+            raise HTTPException(status_code=500, detail="Database connection not initialized")
+        question = data_input.question.strip()
+        answer = data_input.answer.strip()
+        question_clean = clean_text(question)
+        answer_clean = clean_text(answer)
+        if not question_clean or not answer_clean:
+            raise HTTPException(status_code=400, detail="Question and answer cannot be empty")
+        new_embedding = encode_text_batch([question_clean], state)[0]
+        if not await edit_record(state, qa_id, question, answer, new_embedding, question_clean, answer_clean):
+            raise HTTPException(status_code=404, detail="Q&A entry not found")
+        save_cache(state.cache_data, state.cache_path, state.redis_client)
+        save_faiss_index(state.index, state.index_path, state.redis_client)
+        return {"message": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Edit error: {e}")
+        raise HTTPException(status_code=500, detail=f"Edit error: {str(e)}")
+
+# API xóa một cặp hỏi đáp
+@app.delete("/qa/{qa_id}")
+async def delete_qa(qa_id: int, collection: Optional[str] = None, state: AppState = Depends(get_app_state)):
+    try:
+        state = await collections.get(collection)
+        if state.db_pool is None:
+            logger.error("Database pool is not initialized")
+            raise HTTPException(status_code=500, detail="Database connection not initialized")
+        if not await delete_record(state, qa_id):
+            raise HTTPException(status_code=404, detail="Q&A entry not found")
+        save_cache(state.cache_data, state.cache_path, state.redis_client)
+        save_faiss_index(state.index, state.index_path, state.redis_client)
+        # Nén cache ở nền khi số tombstone vượt ngưỡng
+        if len(state.cache_data.get('tombstones', ())) >= TOMBSTONE_COMPACT_THRESHOLD and not state.compacting:
+            asyncio.create_task(compact_cache(state))
+        return {"message": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Delete error: {e}")
+        raise HTTPException(status_code=500, detail=f"Delete error: {str(e)}")
+
 # API fine-tune thủ công
 @app.post("/fine-tune")
 async def fine_tune(state: AppState = Depends(get_app_state)):
     try:
-        from tasks import fine_tune_task
-        fine_tune_task.delay()
-        fine_tuned = True
+        owner = await reserve_fine_tune(state, force=True)
+        if not owner:
+            return {"message": "Fine-tuning already scheduled"}
+        enqueue_fine_tune(state, owner)
         # state.last_fine_tune = time.time()
         # total_records = await count_records(state)
         # state.last_fine_tune_record_count = total_records
@@ -329,31 +618,43 @@ async def auto_fine_tune():
         logger.info("Auto fine-tune is disabled, skipping")
         return
     try:
-        state.raw_data = await load_data_db(state)
-        total_records = await count_records(state)
-        new_records = total_records - state.last_fine_tune_record_count
-        if new_records >= FINE_TUNE_THRESHOLD and len(state.raw_data) >= 10:
-            from tasks import fine_tune_task
-            logger.info(f"New records ({new_records}) >= {FINE_TUNE_THRESHOLD}, scheduling fine-tune")
-            fine_tune_task.delay()
+        corpus_stats = await get_corpus_stats(state)
+        # Lịch tuần không áp dụng khoảng nghỉ FINE_TUNE_INTERVAL
+        owner = await reserve_fine_tune(state, interval=0)
+        if owner:
+            logger.info(f"New records ({corpus_stats['new_records']}) >= {FINE_TUNE_THRESHOLD}, scheduling fine-tune")
+            enqueue_fine_tune(state, owner)
             logger.info("Auto fine-tune scheduled")
         else:
-            logger.warning(f"Not enough new records ({new_records}) or total records ({len(state.raw_data)})")
+            logger.warning(f"Not enough new records ({corpus_stats['new_records']}) "
+                           f"or total records ({corpus_stats['total_records']})")
     except Exception as e:
         logger.error(f"Auto fine-tune error: {e}")
 
+# Mỗi nhịp: gia hạn/giành lease leader; chỉ leader kiểm tra lịch trong Redis và chạy fine-tune khi đến hạn
+async def scheduler_tick():
+    state = get_app_state()
+    try:
+        is_leader = acquire_leadership(state.redis_client)
+        if is_leader != state.is_scheduler_leader:
+            logger.info(f"Replica {REPLICA_ID} {'acquired' if is_leader else 'lost'} scheduler leadership")
+            state.is_scheduler_leader = is_leader
+        schedule = get_schedule(state.redis_client)
+        state.auto_fine_tune_enabled = schedule["enabled"]
+        now = time.time()
+        if is_leader and schedule["enabled"] and now >= schedule["next_run"]:
+            advance_schedule(state.redis_client, now)
+            await auto_fine_tune()
+    except Exception as e:
+        logger.error(f"Scheduler tick error: {e}")
+
 # API bật lập lịch
 @app.post("/enable-auto-fine-tune")
 async def enable_auto_fine_tune(state: AppState = Depends(get_app_state)):
     try:
-        if not state.auto_fine_tune_enabled:
-            state.auto_fine_tune_enabled = True
-            if not scheduler.running:
-                scheduler.add_job(auto_fine_tune, 'interval', weeks=1)
-                scheduler.start()
-                logger.info("Auto fine-tune scheduler enabled and started")
-            else:
-                logger.info("Auto fine-tune scheduler already running")
+        set_schedule_enabled(state.redis_client, True)
+        state.auto_fine_tune_enabled = True
+        logger.info("Auto fine-tune scheduling enabled cluster-wide")
         return {"message": "Auto fine-tune scheduling enabled", "status": state.auto_fine_tune_enabled}
     except Exception as e:
         logger.error(f"Error enabling auto fine-tune: {e}")
@@ -363,13 +664,9 @@ async def enable_auto_fine_tune(state: AppState = Depends(get_app_state)):
 @app.post("/disable-auto-fine-tune")
 async def disable_auto_fine_tune(state: AppState = Depends(get_app_state)):
     try:
-        if state.auto_fine_tune_enabled:
-            state.auto_fine_tune_enabled = False
-            if scheduler.running:
-                scheduler.shutdown()
-                logger.info("Auto fine-tune scheduler disabled and shut down")
-            else:
-                logger.info("Auto fine-tune scheduler already stopped")
+        set_schedule_enabled(state.redis_client, False)
+        state.auto_fine_tune_enabled = False
+        logger.info("Auto fine-tune scheduling disabled cluster-wide")
         return {"message": "Auto fine-tune scheduling disabled", "status": state.auto_fine_tune_enabled}
     except Exception as e:
         logger.error(f"Error disabling auto fine-tune: {e}")
@@ -378,10 +675,24 @@ async def disable_auto_fine_tune(state: AppState = Depends(get_app_state)):
 # API kiểm tra trạng thái lập lịch
 @app.get("/get-auto-fine-tune-status")
 async def get_auto_fine_tune_status(state: AppState = Depends(get_app_state)):
-    return {"status": state.auto_fine_tune_enabled, "message": "Auto fine-tune status retrieved"}
+    try:
+        schedule = get_schedule(state.redis_client)
+        state.auto_fine_tune_enabled = schedule["enabled"]
+        return {
+            "status": schedule["enabled"],
+            "next_run": datetime.fromtimestamp(schedule["next_run"]).isoformat(),
+            "last_run": datetime.fromtimestamp(schedule["last_run"]).isoformat() if schedule["last_run"] else None,
+            "leader": current_leader(state.redis_client),
+            "fine_tune_pending": bool(state.redis_client.exists(FINE_TUNE_PENDING_KEY)),
+            "message": "Auto fine-tune status retrieved"
+        }
+    except Exception as e:
+        logger.error(f"Error reading auto fine-tune status: {e}")
+        raise HTTPException(status_code=500, detail=f"Error reading auto fine-tune status: {str(e)}")
 
-# Tắt scheduler
-atexit.register(lambda: scheduler.shutdown() if scheduler.running else None)  # Chỉ giữ một lần
+# Tắt scheduler (None khi app chạy không qua startup, ví dụ replay.py)
+scheduler = None
+atexit.register(lambda: scheduler.shutdown() if scheduler and scheduler.running else None)  # Chỉ giữ một lần
 
 # Khởi tạo ứng dụng
 @app.on_event("startup")
@@ -392,7 +703,16 @@ async def startup_event():
         logger.debug("init_db_pool completed")
         await init_db(state)
         logger.debug("init_db completed")
-        model_path = os.getenv("MODEL_PATH", "/app/data/phobert_base")
+        # Replica mới: cài snapshot (mô hình, index, cache) trước khi nạp mô hình
+        snapshot = None
+        snapshot_bundle = os.getenv("SNAPSHOT_BUNDLE")
+        if snapshot_bundle and not os.path.exists(CACHE_PATH):
+            try:
+                snapshot = await asyncio.to_thread(restore_snapshot, snapshot_bundle)
+            except Exception as e:
+                logger.error(f"Failed to restore snapshot {snapshot_bundle}: {e}")
+        # Truy vấn dùng cùng mô hình đã mã hóa corpus (student, fine-tune hoặc mô hình gốc)
+        model_path = serving_model_path()
         if not os.path.exists(model_path):
             logger.info("Downloading PhoBERT model from Hugging Face...")
             state.model = SentenceTransformer("vinai/phobert-base")
@@ -402,19 +722,26 @@ async def startup_event():
         else:
             logger.info(f"Loading PhoBERT model from {model_path}")
             state.model = SentenceTransformer(model_path)
+        state.projection = load_projection(model_path)
         logger.debug("Model loaded successfully")
-        await initialize_cache_and_index(state)
+        if not (snapshot and await warm_start_from_snapshot(state, snapshot)):
+            # Snapshot bị từ chối: dựng lại từ DB, không dùng lại bất kỳ cache cục bộ nào
+            await initialize_cache_and_index(state, rebuild=snapshot is not None)
         logger.debug("initialize_cache_and_index completed")
+        if LEXICAL_PREBUILD:
+            # Dựng sẵn chỉ mục BM25 để request hybrid đầu tiên không phải chờ
+            await ensure_lexical_index(state)
+        # Nhận thay đổi index từ các replica khác qua Redis stream
+        state.mutation_consumer = asyncio.create_task(consume_mutations(state))
 
         # Khởi tạo và khởi động scheduler trong startup_event
         global scheduler  # Đảm bảo scheduler là biến toàn cục
+        # Mọi replica chạy nhịp bầu leader; lịch fine-tune (bật/tắt, lần chạy kế tiếp) nằm trong Redis
         scheduler = AsyncIOScheduler()
-        if state.auto_fine_tune_enabled:
-            scheduler.add_job(auto_fine_tune, 'interval', weeks=1)
-            scheduler.start()
-            logger.info("Auto fine-tune scheduler started")
-        else:
-            logger.info("Auto fine-tune scheduler not started due to disabled state")
+        scheduler.add_job(scheduler_tick, 'interval', seconds=SCHEDULER_TICK)
+        scheduler.start()
+        await scheduler_tick()
+        logger.info("Auto fine-tune scheduler started")
 
         logger.info("Application startup completed successfully")
     except Exception as e:
@@ -423,4 +750,12 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if state.mutation_consumer:
+        state.mutation_consumer.cancel()
+    collections.close()
+    if state.is_scheduler_leader:
+        # Nhường lease ngay để replica khác tiếp quản mà không phải chờ hết hạn
+        release_leadership(state.redis_client)
+    if traffic_recorder is not None:
+        await traffic_recorder.close()
     await close_db_state(state)
\ No newline at end of file
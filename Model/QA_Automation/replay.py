@@ -0,0 +1,683 @@
+# Phát lại traffic đã ghi (TRAFFIC_CAPTURE=true) vào main3.app ngay trong tiến trình, thay MySQL, Redis và Celery
+# bằng bản giả lập trong bộ nhớ. Báo cáo throughput, phân vị độ trễ, độ trễ event loop và mức tăng bộ nhớ.
+#
+#   python replay.py traffic_capture.jsonl --concurrency 16 --speedup 10 --seed-records 5000
+#   python replay.py capture-a.jsonl capture-b.jsonl --speedup 10   # gộp capture của nhiều replica theo thời điểm
+#   python replay.py traffic_capture.jsonl --speedup 0 --repeat 5 --model ./phobert_base --output report.json
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import uuid
+import zlib
+from collections import Counter
+from datetime import datetime
+
+# Replay không ghi đè file capture đang dùng làm đầu vào
+os.environ["TRAFFIC_CAPTURE"] = "false"
+
+import numpy as np
+import pandas as pd
+import psutil
+import faiss
+
+logger = logging.getLogger("replay")
+
+# Từ vựng sinh câu hỏi giả lập (đã tách từ theo kiểu pyvi) cho các truy vấn không trùng corpus
+VOCAB = [
+    "học_phí", "ngành", "tuyển_sinh", "điểm", "chuẩn", "xét", "tuyển", "hồ_sơ", "thời_gian", "đăng_ký", "ký_túc_xá",
+    "học_bổng", "chương_trình", "đào_tạo", "chất_lượng", "cao", "công_nghệ", "thông_tin", "kinh_tế", "ngôn_ngữ",
+    "anh", "kỹ_thuật", "phần_mềm", "trường", "sinh_viên", "năm", "nhất", "bao_nhiêu", "như", "thế_nào", "khi", "nào",
+    "có", "không", "được", "miễn", "giảm", "tín_chỉ", "học_kỳ", "thi", "lại", "tốt_nghiệp", "văn_bằng", "hai",
+    "liên_thông", "chỉ_tiêu", "phương_thức", "học_bạ", "đánh_giá", "năng_lực", "ưu_tiên", "khu_vực", "đối_tượng",
+    "nhập_học", "thủ_tục", "giấy_tờ", "cần", "những", "gì", "ở", "đâu", "lệ_phí", "nộp", "online",
+]
+
+# ---------------------------------------------------------------------------------------------------------------
+# Bản giả lập MySQL: chỉ hiểu các câu lệnh mà /search, /update, /upload-excel dùng, có độ trễ mạng tùy chọn
+# ---------------------------------------------------------------------------------------------------------------
+class StandInDatabase:
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.next_id = 1
+        self.next_answer_id = 1
+        self.answers = {}  # answer_hash -> (id, answer)
+        self.answer_text = {}  # id -> answer
+        self.questions = {}  # question -> {answer_id: id bản ghi}
+        self.total_records = 0
+        self.fine_tuned_records = 0
+        self.last_fine_tune = None
+        self.statements = Counter()
+
+    async def round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def insert_answer(self, answer_hash: str, answer: str) -> int:
+        if answer_hash not in self.answers:
+            self.answers[answer_hash] = (self.next_answer_id, answer)
+            self.answer_text[self.next_answer_id] = answer
+            self.next_answer_id += 1
+        return self.answers[answer_hash][0]
+
+    def insert_record(self, question: str, answer_id: int) -> int:
+        record_id = self.next_id
+        self.next_id += 1
+        self.questions.setdefault(question, {})[answer_id] = record_id
+        return record_id
+
+    def execute(self, cursor, query: str, args) -> list:
+        sql = " ".join(query.split())
+        if sql.startswith("INSERT IGNORE INTO") and "answer_hash" in sql:
+            self.statements["insert_answers"] += 1
+            for answer_hash, answer in args:
+                self.insert_answer(answer_hash, answer)
+            cursor.rowcount = len(args)
+            return []
+        if sql.startswith("INSERT INTO"):
+            self.statements["insert_records"] += 1
+            ids = [self.insert_record(question, answer_id) for _, question, answer_id, _ in args]
+            cursor.rowcount = len(ids)
+            cursor.lastrowid = ids[0] if ids else None
+            return []
+        # Các câu lệnh còn lại chạy với một bộ tham số
+        args = args[0] if args else ()
+        if sql.startswith("SELECT answer_hash, id"):
+            self.statements["select_answers"] += 1
+            return [(h, self.answers[h][0]) for h in args if h in self.answers]
+        if sql.startswith("SELECT d.question, a.answer"):
+            self.statements["select_pairs"] += 1
+            return [(q, self.answer_text[answer_id]) for q in args for answer_id in self.questions.get(q, {})]
+        if sql.startswith("SELECT d.id") and "answer_hash = %s" in sql:
+            self.statements["select_duplicate"] += 1
+            question, answer_hash = args
+            answer = self.answers.get(answer_hash)
+            record_id = answer and self.questions.get(question, {}).get(answer[0])
+            return [(record_id,)] if record_id else []
+        if sql.startswith("SELECT total_records"):
+            self.statements["select_stats"] += 1
+            last = datetime.fromtimestamp(self.last_fine_tune) if self.last_fine_tune else None
+            return [(self.total_records, self.fine_tuned_records, last)]
+        if sql.startswith("SELECT COUNT(*)"):
+            self.statements["count"] += 1
+            return [(self.total_records,)]
+        if sql.startswith("UPDATE") and "total_records = total_records" in sql:
+            self.statements["update_stats"] += 1
+            self.total_records += args[0] if "+ %s" in sql else -1
+            cursor.rowcount = 1
+            return []
+        if sql.startswith("SELECT 1") and "last_fine_tune_record_count" in sql:
+            # claim_fine_tune: cùng điều kiện với câu SELECT thật (đủ bản ghi mới và đã qua khoảng nghỉ)
+            self.statements["claim_fine_tune"] += 1
+            threshold, interval = args
+            due = (self.total_records >= 10 and self.total_records - self.fine_tuned_records >= threshold
+                   and (self.last_fine_tune is None or time.time() - self.last_fine_tune > interval))
+            return [(1,)] if due else []
+        if sql.startswith("UPDATE") and "last_fine_tune_record_count = %s" in sql:
+            # record_fine_tune: dời mốc khi fine-tune hoàn tất
+            self.statements["record_fine_tune"] += 1
+            self.fine_tuned_records = args[0]
+            self.last_fine_tune = time.time()
+            cursor.rowcount = 1
+            return []
+        self.statements["other"] += 1
+        cursor.rowcount = 0
+        return []
+
+
+class StandInCursor:
+    def __init__(self, db: StandInDatabase):
+        self.db = db
+        self.rowcount = 0
+        self.lastrowid = None
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query: str, args=None):
+        await self.db.round_trip()
+        self.rows = self.db.execute(self, query, [args] if args is not None else [])
+
+    async def executemany(self, query: str, args):
+        await self.db.round_trip()
+        self.rows = self.db.execute(self, query, list(args))
+
+    async def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    async def fetchall(self):
+        return list(self.rows)
+
+
+class StandInConnection:
+    def __init__(self, db: StandInDatabase):
+        self.db = db
+
+    def cursor(self):
+        return StandInCursor(self.db)
+
+    async def commit(self):
+        await self.db.round_trip()
+
+    async def rollback(self):
+        await self.db.round_trip()
+
+
+class StandInPool:
+    def __init__(self, db: StandInDatabase, size: int = 10):
+        self.db = db
+        self.slots = asyncio.Semaphore(size)
+        self.waits = []
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                start = time.perf_counter()
+                await pool.slots.acquire()
+                pool.waits.append(time.perf_counter() - start)
+                return StandInConnection(pool.db)
+
+            async def __aexit__(self, *exc):
+                pool.slots.release()
+                return False
+
+        return Acquire()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+# ---------------------------------------------------------------------------------------------------------------
+# Bản giả lập Redis: khóa (redis.lock.Lock), hash trạng thái và stream thay đổi (chỉ đếm, không giữ dữ liệu)
+# ---------------------------------------------------------------------------------------------------------------
+class StandInScript:
+    def __init__(self, client: "StandInRedis", script: str):
+        self.client = client
+        self.release = "del" in script.lower()
+
+    def __call__(self, keys=(), args=(), client=None):
+        if self.release:
+            if self.client.values.get(keys[0]) != args[0]:
+                return 0
+            self.client.values.pop(keys[0], None)
+        return 1
+
+
+class StandInRedis:
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.stream_entries = Counter()
+        self.commands = Counter()
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+    def register_script(self, script: str) -> StandInScript:
+        return StandInScript(self, script)
+
+    def set(self, name, value, ex=None, px=None, nx=False, **kwargs):
+        self.commands["set"] += 1
+        if nx and name in self.values:
+            return None
+        self.values[name] = value.encode() if isinstance(value, str) else value
+        return True
+
+    def get(self, name):
+        self.commands["get"] += 1
+        return self.values.get(name)
+
+    def delete(self, *names):
+        self.commands["delete"] += 1
+        return sum(self.values.pop(n, None) is not None or self.hashes.pop(n, None) is not None for n in names)
+
+    def exists(self, *names):
+        return sum(n in self.values or n in self.hashes for n in names)
+
+    def expire(self, name, seconds):
+        return name in self.values or name in self.hashes
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        self.commands["hset"] += 1
+        fields = dict(mapping or {})
+        if key is not None:
+            fields[key] = value
+        self.hashes.setdefault(name, {}).update({str(k).encode(): str(v).encode() for k, v in fields.items()})
+        return len(fields)
+
+    def hsetnx(self, name, key, value):
+        fields = self.hashes.setdefault(name, {})
+        if str(key).encode() in fields:
+            return 0
+        fields[str(key).encode()] = str(value).encode()
+        return 1
+
+    def hgetall(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    def xadd(self, name, fields, maxlen=None, approximate=True, **kwargs):
+        self.commands["xadd"] += 1
+        self.stream_entries[name] += 1
+        return f"{int(time.time() * 1000)}-{self.stream_entries[name]}".encode()
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        return []
+
+    # Chỉ mô phỏng script trả lease (so khớp chủ sở hữu rồi xóa); các script khác coi như không làm gì
+    def eval(self, script, numkeys, *args):
+        self.commands["eval"] += 1
+        if "'del'" in script and numkeys == 1:
+            name, owner = args[0], args[1]
+            if self.values.get(name) == (owner.encode() if isinstance(owner, str) else owner):
+                return self.delete(name)
+        return 0
+
+# ---------------------------------------------------------------------------------------------------------------
+# Bản giả lập Celery: thay module tasks, chỉ đếm số lần gửi task
+# ---------------------------------------------------------------------------------------------------------------
+class StandInTask:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+
+    def delay(self, *args, **kwargs):
+        return self.apply_async(args=args, kwargs=kwargs)
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        self.calls += 1
+        return types.SimpleNamespace(id=task_id or uuid.uuid4().hex)
+
+
+def install_celery_stand_in() -> dict:
+    module = types.ModuleType("tasks")
+    tasks = {name: StandInTask(name) for name in ("fine_tune_task", "import_task", "update_embeddings_task")}
+    for name, task in tasks.items():
+        setattr(module, name, task)
+    sys.modules["tasks"] = module
+    return tasks
+
+# ---------------------------------------------------------------------------------------------------------------
+# Encoder giả lập: vector tất định theo từ (câu có nhiều từ chung thì gần nhau), chi phí CPU mô phỏng bằng sleep
+# ---------------------------------------------------------------------------------------------------------------
+class StandInEncoder:
+    def __init__(self, dim: int = 768, cost_ms: float = 0.0):
+        self.dim = dim
+        self.cost = cost_ms / 1000
+        self.word_vectors = {}
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def word_vector(self, word: str) -> np.ndarray:
+        vector = self.word_vectors.get(word)
+        if vector is None:
+            vector = np.random.default_rng(zlib.crc32(word.encode("utf-8"))).standard_normal(self.dim).astype(np.float32)
+            self.word_vectors[word] = vector
+        return vector
+
+    def encode(self, texts, convert_to_numpy=True, show_progress_bar=False, batch_size=32, **kwargs) -> np.ndarray:
+        if self.cost:
+            time.sleep(self.cost * -(-len(texts) // batch_size))
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.split():
+                vectors[i] += self.word_vector(word)
+            if not text.split():
+                vectors[i, 0] = 1.0
+        return vectors
+
+# ---------------------------------------------------------------------------------------------------------------
+# Dựng lại request từ shape ẩn danh
+# ---------------------------------------------------------------------------------------------------------------
+class TrafficSynthesizer:
+    def __init__(self, corpus: list, hit_ratio: float, seed: int = 0):
+        self.corpus = corpus  # [(question, answer)]
+        self.hit_ratio = hit_ratio
+        self.rng = random.Random(seed)
+
+    @staticmethod
+    def sentence(key: str, words: int) -> str:
+        rng = random.Random(key)
+        return " ".join(rng.choice(VOCAB) for _ in range(max(words, 1))).replace("_", " ")
+
+    # Cùng hash -> cùng câu hỏi, giữ nguyên tỉ lệ truy vấn lặp lại; một phần hash được ánh xạ vào câu hỏi có sẵn
+    def question(self, shape: dict) -> str:
+        if not shape:
+            return ""
+        key = int(shape["hash"], 16)
+        if self.corpus and (key % 1000) < self.hit_ratio * 1000:
+            return self.corpus[key % len(self.corpus)][0]
+        return self.sentence(shape["hash"], shape.get("words", 8))
+
+    def fresh_pair(self, question: dict = None, answer: dict = None) -> tuple:
+        tag = uuid.uuid4().hex[:8]
+        return (f"{self.sentence(tag + 'q', (question or {}).get('words', 8))} {tag}",
+                self.sentence(tag + "a", (answer or {}).get("words", 30)))
+
+    def upload_file(self, entry: dict) -> tuple:
+        parsed = entry.get("parsed") or max(entry.get("bytes", 0) // 200, 1)
+        duplicates = min(entry.get("skipped_duplicate", 0), parsed)
+        empty = min(entry.get("skipped_empty", 0), parsed - duplicates)
+        rows = [self.rng.choice(self.corpus) for _ in range(duplicates if self.corpus else 0)]
+        rows += [("", "") for _ in range(empty)]
+        rows += [self.fresh_pair() for _ in range(parsed - len(rows))]
+        df = pd.DataFrame(rows, columns=["question", "answer"])
+        ext = entry.get("extension") or ".xlsx"
+        ext = ".xlsx" if ext == ".xls" else ext
+        buffer = io.BytesIO()
+        if ext == ".csv":
+            df.to_csv(buffer, index=False)
+        elif ext == ".jsonl":
+            buffer.write(df.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8"))
+        elif ext == ".parquet":
+            df.to_parquet(buffer, index=False)
+        else:
+            df.to_excel(buffer, index=False)
+        return f"replay{ext}", buffer.getvalue()
+
+# ---------------------------------------------------------------------------------------------------------------
+# Gọi ASGI app trực tiếp (không qua socket, không chạy lifespan startup)
+# ---------------------------------------------------------------------------------------------------------------
+async def asgi_request(app, method: str, path: str, body: bytes = b"", headers: dict = None) -> tuple:
+    headers = dict(headers or {})
+    headers["content-length"] = str(len(body))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+        "client": ("127.0.0.1", 0), "server": ("replay", 80),
+    }
+    done = asyncio.Event()
+    request_sent = False
+    status = None
+    chunks = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    done.set()
+    return status, b"".join(chunks)
+
+
+def build_request(entry: dict, synthesizer: TrafficSynthesizer, mode: str = None) -> tuple:
+    path = entry["path"]
+    if path == "/search":
+        payload = {"question": synthesizer.question(entry.get("question")),
+                   "max_distance_threshold": entry.get("threshold", 1.0)}
+        if mode or entry.get("mode"):
+            payload["mode"] = mode or entry["mode"]
+        headers = {"content-type": "application/json"}
+        if entry.get("deadline_ms"):
+            headers["x-request-deadline-ms"] = str(entry["deadline_ms"])
+        return path, json.dumps(payload, ensure_ascii=False).encode("utf-8"), headers
+    if path == "/update":
+        if entry.get("inserted") is False and synthesizer.corpus:
+            question, answer = synthesizer.rng.choice(synthesizer.corpus)
+        else:
+            question, answer = synthesizer.fresh_pair(entry.get("question"), entry.get("answer"))
+        return path, json.dumps({"question": question, "answer": answer}, ensure_ascii=False).encode("utf-8"), \
+            {"content-type": "application/json"}
+    filename, data = synthesizer.upload_file(entry)
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return path, body, {"content-type": f"multipart/form-data; boundary={boundary}"}
+
+# ---------------------------------------------------------------------------------------------------------------
+# Theo dõi độ trễ event loop và bộ nhớ trong lúc replay
+# ---------------------------------------------------------------------------------------------------------------
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.perf_counter() - start - self.interval, 0.0))
+
+
+class MemoryMonitor:
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.samples = []
+
+    def sample(self):
+        self.samples.append((time.perf_counter(), self.process.memory_info().rss))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+def percentiles(values: list, scale: float = 1000.0) -> dict:
+    if not values:
+        return {}
+    arr = np.asarray(values) * scale
+    return {"p50": round(float(np.percentile(arr, 50)), 2), "p90": round(float(np.percentile(arr, 90)), 2),
+            "p99": round(float(np.percentile(arr, 99)), 2), "max": round(float(arr.max()), 2)}
+
+# ---------------------------------------------------------------------------------------------------------------
+# Chuẩn bị state của app với các bản giả lập và corpus khởi đầu
+# ---------------------------------------------------------------------------------------------------------------
+# "t" là thời điểm epoch nên capture của nhiều replica (nhiều file hoặc cùng một file) gộp được thành một dòng thời gian
+def load_capture(paths: list) -> list:
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda e: e["t"])
+    return entries
+
+
+def seed_state(state, utils, encoder, db: StandInDatabase, records: int, workdir: str) -> list:
+    rng = random.Random(0)
+    answers = [TrafficSynthesizer.sentence(f"answer-{i}", rng.randint(15, 60)) for i in range(max(records // 5, 1))]
+    corpus = [(TrafficSynthesizer.sentence(f"question-{i}", rng.randint(4, 14)) + f" {i}", rng.choice(answers))
+              for i in range(records)]
+    state.cache_path = os.path.join(workdir, "embedding_cache.pkl")
+    state.index_path = os.path.join(workdir, "qa_index.faiss")
+    state.index = faiss.IndexIDMap(faiss.IndexFlatL2(encoder.get_sentence_embedding_dimension()))
+    if not corpus:
+        return corpus
+    clean_questions = [utils.clean_text(q) for q, _ in corpus]
+    answer_ids, answer_map, ids = [], {}, []
+    for question, answer in corpus:
+        answer_id = db.insert_answer(utils.answer_hash(answer), answer)
+        ids.append(db.insert_record(question, answer_id))
+        answer_ids.append(answer_id)
+        answer_map[answer_id] = (answer, answer)
+    db.total_records = db.fine_tuned_records = len(corpus)
+    embeddings = utils.encode_text_batch(clean_questions, state).astype(np.float32)
+    state.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+    utils.append_to_cache(state, ids, embeddings, [q for q, _ in corpus], clean_questions, answer_ids, answer_map)
+    return corpus
+
+# ---------------------------------------------------------------------------------------------------------------
+# Phát lại: theo thời điểm gốc chia cho speedup (open loop), hoặc nhanh nhất có thể khi speedup <= 0 (closed loop)
+# ---------------------------------------------------------------------------------------------------------------
+async def replay(args) -> dict:
+    tasks = install_celery_stand_in()
+    import utils
+    import main3
+    if args.model:
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer(args.model)
+        utils.state.projection = utils.load_projection(args.model)
+    else:
+        encoder = StandInEncoder(args.dim, args.encode_ms)
+        utils.state.projection = None
+    logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+    db = StandInDatabase(args.db_latency_ms)
+    state = utils.state
+    state.model = encoder
+    state.db_pool = StandInPool(db, args.db_pool_size)
+    state.redis_client = StandInRedis()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="qa_replay_")
+    os.makedirs(workdir, exist_ok=True)
+    corpus = seed_state(state, utils, encoder, db, args.seed_records, workdir)
+    if args.mode == "hybrid" or main3.SEARCH_MODE == "hybrid":
+        utils.get_lexical_index(state)
+    synthesizer = TrafficSynthesizer(corpus, args.hit_ratio)
+
+    entries = [e for e in load_capture(args.capture) if e.get("path") in main3.CAPTURED_PATHS]
+    if args.only:
+        entries = [e for e in entries if e["path"] in args.only]
+    if not entries:
+        raise SystemExit(f"No replayable requests in {', '.join(args.capture)}")
+    span = entries[-1]["t"] - entries[0]["t"]
+    schedule = [(e["t"] - entries[0]["t"] + loop * (span + 1), e) for loop in range(args.repeat) for e in entries]
+    logger.warning(f"Replaying {len(schedule)} requests ({len(entries)} captured x {args.repeat}) against "
+                   f"{len(corpus)} seed records, concurrency {args.concurrency}, speedup {args.speedup or 'max'}")
+
+    results = []
+    lag = LoopLagMonitor()
+    memory = MemoryMonitor()
+    memory.sample()
+    start_rows, start_ntotal = len(state.cache_data['ids']), state.index.ntotal
+    monitors = [asyncio.create_task(lag.run()), asyncio.create_task(memory.run())]
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def fire(entry: dict, scheduled: float):
+        path, body, headers = build_request(entry, synthesizer, args.mode)
+        async with slots:
+            begin = time.perf_counter()
+            try:
+                status, _ = await asgi_request(main3.app, entry.get("method", "POST"), path, body, headers)
+            except Exception as e:
+                logger.error(f"Replay request to {path} failed: {e}")
+                status = "error"
+            end = time.perf_counter()
+        results.append({"path": path, "status": status, "service": end - begin, "response": end - scheduled,
+                        "captured_ms": entry.get("ms")})
+
+    started = time.perf_counter()
+    if args.speedup > 0:
+        pending = []
+        for offset, entry in schedule:
+            scheduled = started + offset / args.speedup
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            pending.append(asyncio.create_task(fire(entry, scheduled)))
+        await asyncio.gather(*pending)
+    else:
+        queue = iter(schedule)
+
+        async def worker():
+            for _, entry in queue:
+                await fire(entry, time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    for monitor in monitors:
+        monitor.cancel()
+    memory.sample()
+
+    by_path = {}
+    for path in sorted({r["path"] for r in results}):
+        rows = [r for r in results if r["path"] == path]
+        by_path[path] = {
+            "count": len(rows),
+            "throughput_rps": round(len(rows) / elapsed, 2),
+            "status": dict(Counter(str(r["status"]) for r in rows)),
+            "service_ms": percentiles([r["service"] for r in rows]),
+            "response_ms": percentiles([r["response"] for r in rows]),
+            "captured_ms": percentiles([r["captured_ms"] for r in rows if r["captured_ms"] is not None], 1.0),
+        }
+    rss = [value for _, value in memory.samples]
+    return {
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "paths": by_path,
+        "event_loop_lag_ms": percentiles(lag.samples),
+        "memory_mb": {"start": round(rss[0] / 2 ** 20, 1), "peak": round(max(rss) / 2 ** 20, 1),
+                      "end": round(rss[-1] / 2 ** 20, 1), "growth": round((rss[-1] - rss[0]) / 2 ** 20, 1)},
+        "cache": {"rows_start": start_rows, "rows_end": len(state.cache_data['ids']),
+                  "index_start": start_ntotal, "index_end": state.index.ntotal,
+                  "cache_file_mb": round(os.path.getsize(state.cache_path) / 2 ** 20, 2)
+                  if os.path.exists(state.cache_path) else None,
+                  "index_file_mb": round(os.path.getsize(state.index_path) / 2 ** 20, 2)
+                  if os.path.exists(state.index_path) else None},
+        "db_pool_wait_ms": percentiles(state.db_pool.waits),
+        "db_statements": dict(db.statements),
+        "redis_commands": dict(state.redis_client.commands),
+        "celery_tasks": {name: task.calls for name, task in tasks.items()},
+        "search_admission": main3.search_admission.snapshot(),
+        "workdir": workdir,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured /search, /update and /upload-excel traffic "
+                                                 "against main3.app in-process")
+    parser.add_argument("capture", nargs="+", help="JSONL file(s) written with TRAFFIC_CAPTURE=true")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max requests in flight")
+    parser.add_argument("--speedup", type=float, default=1.0,
+                        help="Replay N times faster than captured; <= 0 replays as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the capture N times back to back")
+    parser.add_argument("--only", nargs="*", help="Replay only these paths")
+    parser.add_argument("--mode", help="Override the search mode of every /search request")
+    parser.add_argument("--seed-records", type=int, default=5000, help="Synthetic corpus size loaded before replay")
+    parser.add_argument("--hit-ratio", type=float, default=0.7,
+                        help="Share of distinct search queries mapped onto seed questions")
+    parser.add_argument("--model", help="SentenceTransformer path; default is a CPU-cheap stand-in encoder")
+    parser.add_argument("--dim", type=int, default=768, help="Stand-in encoder dimension")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="Simulated stand-in encoder cost per batch")
+    parser.add_argument("--db-latency-ms", type=float, default=0.5, help="Simulated MySQL round trip")
+    parser.add_argument("--db-pool-size", type=int, default=10)
+    parser.add_argument("--workdir", help="Where cache/index files are persisted (default: temp dir)")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(replay(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
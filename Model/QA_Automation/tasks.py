@@ -3,9 +3,18 @@ import logging
 import asyncio
 import sys
 import os
+import time
 import redis
+import shutil
+from celery import chord
 from celery_config import app
-from utils import db_config, get_app_state, state, AppState, fine_tune_phobert, update_embeddings_after_finetune, load_data_db
+from utils import (
+    db_config, get_app_state, state, AppState, fine_tune_phobert, update_embeddings_after_finetune,
+    import_records_stream, update_import_job, reserve_fine_tune, release_fine_tune, defer_fine_tune, distill_student,
+    serving_model_path, load_projection, load_training_data, collection_state, plan_reembed_shards, load_question_range,
+    clean_text, encode_normalized, write_reembed_shard, load_reembed_shards, DISTILL_ENABLED, QA_COLLECTIONS,
+    DEFAULT_COLLECTION, sweep_reembed_staging, REEMBED_DISTRIBUTED, REEMBED_SHARD_SIZE, REEMBED_STAGING_DIR
+)
 from sentence_transformers import SentenceTransformer
 
 # Thêm thư mục dự án vào sys.path
@@ -60,7 +69,7 @@ def load_or_download_phobert(model_path="./phobert_base"):
         raise
 
 @app.task(bind=True, max_retries=3, retry_backoff=True)
-def fine_tune_task(self):
+def fine_tune_task(self, owner: str = None):
     loop = None
     state = get_app_state()
     try:
@@ -85,7 +94,8 @@ def fine_tune_task(self):
 
         loop = loop or asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        state.raw_data = loop.run_until_complete(load_data_db(state))
+        # Encoder dùng chung nên được huấn luyện trên dữ liệu của mọi collection
+        state.raw_data = loop.run_until_complete(load_training_data(state))
         # if state.raw_data.empty or len(state.raw_data) < 10:
         #     logger.warning("Insufficient data for fine-tuning, skipping")
         #     return False
@@ -96,11 +106,19 @@ def fine_tune_task(self):
             raise Exception("Fine-tuning failed")
 
         logger.info("fine_tune_task completed successfully")
-        update_embeddings_task.delay()
+        if owner:
+            release_fine_tune(state.redis_client, owner)
+        if DISTILL_ENABLED:
+            distill_task.delay()
+        else:
+            update_embeddings_task.delay()
         return True
 
     except Exception as e:
         logger.error(f"Error in fine_tune_task: {str(e)}", exc_info=True)
+        if self.request.retries >= self.max_retries and state.redis_client and owner:
+            # Hết lượt thử lại: mốc bản ghi chưa dời; giữ chỗ thêm FINE_TUNE_RETRY_DELAY rồi lần kích hoạt sau thử lại
+            defer_fine_tune(state.redis_client, owner)
         raise self.retry(exc=e, countdown=60)
 
     finally:
@@ -138,15 +156,36 @@ def update_embeddings_task(self):
             state.db_pool = loop.run_until_complete(init_worker_pool())
             logger.info("Database pool initialized successfully")
 
-        model_path = os.getenv("CHECKPOINT_PATH", "./phobert_finetuned")
-        if not os.path.exists(model_path):
-            logger.warning(f"Checkpoint path {model_path} not found, falling back to {os.getenv('MODEL_PATH', './phobert_base')}")
-            model_path = os.getenv("MODEL_PATH", "./phobert_base")
-        state.model, state.tokenizer = load_or_download_phobert(model_path)
-
+        # Mã hóa corpus bằng đúng mô hình mà API dùng cho truy vấn (teacher hoặc student)
+        model_path = serving_model_path()
         loop = loop or asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(update_embeddings_after_finetune(state))
+        if REEMBED_DISTRIBUTED:
+            # Chia corpus theo dải id, mã hóa song song trên các worker rồi gộp trong merge_reembed_task
+            sweep_reembed_staging()
+            run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + os.urandom(4).hex()
+            shards = [
+                reembed_shard_task.s(run_id, collection, lo, hi, model_path)
+                for collection in [DEFAULT_COLLECTION] + QA_COLLECTIONS
+                for lo, hi in loop.run_until_complete(
+                    plan_reembed_shards(collection_state(state, collection), REEMBED_SHARD_SIZE)
+                )
+            ]
+            logger.info(f"Dispatching re-embed run {run_id} with {len(shards)} shards")
+            chord(shards)(merge_reembed_task.s(run_id, model_path))
+            return run_id
+
+        logger.info(f"Re-embedding corpus with {model_path}")
+        state.model, state.tokenizer = load_or_download_phobert(model_path)
+        # Một mã re-embed cho mọi collection: replica đổi mô hình chung khi mọi collection đã nhận vector mới
+        reembed_id = time.strftime("%Y%m%d-%H%M%S") + "-" + os.urandom(4).hex()
+        loop.run_until_complete(update_embeddings_after_finetune(state, model_path, reembed_id=reembed_id))
+        # Các collection khác dùng lại phép chiếu vừa học của collection mặc định
+        for collection in QA_COLLECTIONS:
+            logger.info(f"Re-embedding collection {collection}")
+            loop.run_until_complete(update_embeddings_after_finetune(
+                collection_state(state, collection), model_path, refit_projection=False, reembed_id=reembed_id
+            ))
         logger.info("update_embeddings_task completed successfully")
 
     except Exception as e:
@@ -166,4 +205,224 @@ def update_embeddings_task(self):
                     loop.close()
                     logger.info("Closed event loop in update_embeddings_task")
         elif state.db_pool:
-            logger.warning("db_pool exists but no loop, skipping close")
\ No newline at end of file
+            logger.warning("db_pool exists but no loop, skipping close")
+
+# Mô hình dùng cho các shard được giữ trong tiến trình worker, nạp lại khi checkpoint thay đổi
+_shard_models = {}
+
+def load_shard_model(model_path):
+    # Checkpoint là symlink tới thư mục phiên bản: đổi phiên bản thì đường dẫn thật đổi theo
+    version = (os.path.realpath(model_path), os.path.getmtime(model_path))
+    cached = _shard_models.get(model_path)
+    if cached is None or cached[0] != version:
+        model, _ = load_or_download_phobert(model_path)
+        _shard_models.clear()
+        _shard_models[model_path] = (version, model)
+    return _shard_models[model_path][1]
+
+@app.task(bind=True, max_retries=3, retry_backoff=True)
+def reembed_shard_task(self, run_id, collection, lo, hi, model_path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = None
+    try:
+        logger.info(f"Re-embedding shard {collection}[{lo}, {hi}] for run {run_id}")
+        pool = loop.run_until_complete(init_worker_pool())
+        shard_state = collection_state(AppState(), collection)
+        shard_state.db_pool = pool
+        ids, questions = loop.run_until_complete(load_question_range(shard_state, lo, hi))
+        model = load_shard_model(model_path)
+        embeddings = encode_normalized(model, [clean_text(q) for q in questions]) if ids else None
+        path = write_reembed_shard(run_id, collection, lo, hi, ids, embeddings) if ids else None
+        return {"collection": collection, "lo": lo, "hi": hi, "count": len(ids), "path": path}
+
+    except Exception as e:
+        logger.error(f"Re-embed shard {collection}[{lo}, {hi}] failed: {str(e)}", exc_info=True)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=30)
+        # Không chặn chord: merge_reembed_task sẽ tự mã hóa các dòng của shard này
+        return {"collection": collection, "lo": lo, "hi": hi, "count": 0, "path": None, "error": str(e)}
+
+    finally:
+        if pool:
+            loop.run_until_complete(close_db_pool(pool))
+        loop.close()
+
+@app.task(bind=True, max_retries=1, retry_backoff=True)
+def merge_reembed_task(self, shard_results, run_id, model_path):
+    loop = None
+    state = get_app_state()
+    try:
+        failed = [r for r in shard_results if r.get("error")]
+        logger.info(f"Merging re-embed run {run_id}: {len(shard_results)} shards, "
+                    f"{sum(r['count'] for r in shard_results)} vectors, {len(failed)} failed shards")
+        if state.redis_client is None:
+            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            state.redis_client = redis.Redis.from_url(redis_url)
+            state.redis_client.ping()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if state.db_pool is None:
+            state.db_pool = loop.run_until_complete(init_worker_pool())
+        state.model, state.tokenizer = load_or_download_phobert(model_path)
+
+        # Dựng cache/index, ghi DB và phát embedding mới như luồng một worker, dùng vector từ các shard
+        loop.run_until_complete(update_embeddings_after_finetune(
+            state, model_path, precomputed=load_reembed_shards(run_id, DEFAULT_COLLECTION), reembed_id=run_id
+        ))
+        for collection in QA_COLLECTIONS:
+            loop.run_until_complete(update_embeddings_after_finetune(
+                collection_state(state, collection), model_path, refit_projection=False,
+                precomputed=load_reembed_shards(run_id, collection), reembed_id=run_id
+            ))
+        shutil.rmtree(os.path.join(REEMBED_STAGING_DIR, run_id), ignore_errors=True)
+        logger.info(f"merge_reembed_task completed for run {run_id}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Merge of re-embed run {run_id} failed: {str(e)}", exc_info=True)
+        if self.request.retries >= self.max_retries:
+            # Hết lượt thử lại: bỏ vector đã mã hóa của lần chạy này, lần re-embed sau sẽ mã hóa lại
+            shutil.rmtree(os.path.join(REEMBED_STAGING_DIR, run_id), ignore_errors=True)
+        raise self.retry(exc=e, countdown=60)
+
+    finally:
+        if state.db_pool and loop:
+            try:
+                loop.run_until_complete(close_db_pool(state.db_pool))
+                logger.info("Closed db pool in merge_reembed_task")
+            except Exception as e:
+                logger.error(f"Error closing db_pool: {str(e)}")
+            finally:
+                state.db_pool = None
+        if loop and not loop.is_closed():
+            loop.close()
+
+IMPORT_TASK_TIME_LIMIT = int(os.getenv("IMPORT_TASK_TIME_LIMIT", 6 * 3600))
+
+@app.task(bind=True, max_retries=3, retry_backoff=True,
+          time_limit=IMPORT_TASK_TIME_LIMIT, soft_time_limit=IMPORT_TASK_TIME_LIMIT - 300)
+def import_task(self, job_id, path, collection=None):
+    loop = None
+    state = get_app_state()
+    try:
+        logger.info(f"Starting import_task for job {job_id}")
+        if state.redis_client is None:
+            logger.info("Initializing redis client for worker")
+            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            state.redis_client = redis.Redis.from_url(redis_url)
+            state.redis_client.ping()
+            logger.info("Redis client initialized successfully")
+        update_import_job(state.redis_client, job_id, status="STARTED", started_at=time.time())
+
+        if state.db_pool is None:
+            logger.info("Initializing db pool for worker")
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            state.db_pool = loop.run_until_complete(init_worker_pool())
+            logger.info("Database pool initialized successfully")
+
+        if state.model is None:
+            model_path = serving_model_path()
+            state.model, state.tokenizer = load_or_download_phobert(model_path)
+            state.projection = load_projection(model_path)
+
+        # Các chunk đã lưu ở lần thử trước sẽ được bỏ qua như bản ghi trùng
+        stats = {}
+        loop = loop or asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(import_records_stream(
+            path, collection_state(state, collection), stats, update_index=False,
+            progress=lambda s: update_import_job(state.redis_client, job_id, **s)
+        ))
+        update_import_job(state.redis_client, job_id, status="SUCCESS", finished_at=time.time(), **stats)
+        logger.info(f"import_task for job {job_id} completed: {stats}")
+        owner = stats.get('inserted') and loop.run_until_complete(reserve_fine_tune(collection_state(state, collection)))
+        if owner:
+            logger.info("Import reached fine-tune threshold, scheduling fine-tune")
+            try:
+                fine_tune_task.delay(owner)
+            except Exception:
+                release_fine_tune(state.redis_client, owner)
+                raise
+        if os.path.exists(path):
+            os.remove(path)
+        return stats
+
+    except Exception as e:
+        logger.error(f"Import task for job {job_id} failed: {str(e)}", exc_info=True)
+        if self.request.retries >= self.max_retries:
+            update_import_job(state.redis_client, job_id, status="FAILURE", finished_at=time.time(), error=str(e))
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        update_import_job(state.redis_client, job_id, status="RETRY", error=str(e))
+        raise self.retry(exc=e, countdown=60)
+
+    finally:
+        if state.db_pool and loop:
+            try:
+                loop.run_until_complete(close_db_pool(state.db_pool))
+                logger.info("Closed db pool in import_task")
+            except Exception as e:
+                logger.error(f"Error closing db_pool: {str(e)}")
+            finally:
+                state.db_pool = None
+                if not loop.is_closed():
+                    loop.close()
+                    logger.info("Closed event loop in import_task")
+        elif state.db_pool:
+            logger.warning("db_pool exists but no loop, skipping close")
+
+
+@app.task(bind=True, max_retries=1, retry_backoff=True)
+def distill_task(self):
+    loop = None
+    state = get_app_state()
+    try:
+        logger.info("Starting distill_task")
+        if state.redis_client is None:
+            logger.info("Initializing redis client for worker")
+            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            state.redis_client = redis.Redis.from_url(redis_url)
+            state.redis_client.ping()
+            logger.info("Redis client initialized successfully")
+
+        if state.db_pool is None:
+            logger.info("Initializing db pool for worker")
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            state.db_pool = loop.run_until_complete(init_worker_pool())
+            logger.info("Database pool initialized successfully")
+
+        loop = loop or asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Student học trên cùng dữ liệu (mọi collection) với teacher
+        state.raw_data = loop.run_until_complete(load_training_data(state))
+        report = distill_student(state)
+        logger.info(f"distill_task completed: {report}")
+        update_embeddings_task.delay()
+        return report
+
+    except Exception as e:
+        logger.error(f"Distill task failed: {str(e)}", exc_info=True)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=60)
+        # Chưng cất là bước tùy chọn, corpus vẫn phải được mã hóa lại bằng mô hình mới
+        update_embeddings_task.delay()
+        return None
+
+    finally:
+        if state.db_pool and loop:
+            try:
+                loop.run_until_complete(close_db_pool(state.db_pool))
+                logger.info("Closed db pool in distill_task")
+            except Exception as e:
+                logger.error(f"Error closing db_pool: {str(e)}")
+            finally:
+                state.db_pool = None
+                if not loop.is_closed():
+                    loop.close()
+                    logger.info("Closed event loop in distill_task")
+        elif state.db_pool:
+            logger.warning("db_pool exists but no loop, skipping close")
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import faiss
+import fakeredis
+import numpy as np
+import pytest
+
+# Các module của dự án nằm phẳng trong Model/QA_Automation
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import AppState, empty_cache  # noqa: E402
+
+DIM = 4
+
+
+@pytest.fixture
+def redis_client():
+    # fakeredis[lua] chạy được các script Lua (so khớp chủ sở hữu lease) như Redis thật
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def app_state(redis_client):
+    state = AppState()
+    state.redis_client = redis_client
+    state.cache_data = empty_cache()
+    state.index = faiss.IndexIDMap(faiss.IndexFlatL2(DIM))
+    return state
+
+
+def unit_vectors(n: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from utils import AdmissionController
+
+
+async def serve(controller: AdmissionController, budget: float, work: float):
+    async with controller.admit(budget) as deadline:
+        await asyncio.sleep(work)
+        controller.check_deadline(deadline, "search")
+
+
+def test_permits_are_returned_after_timeouts():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        results = await asyncio.gather(
+            serve(controller, 1.0, 0.3), *(serve(controller, 0.2, 0.01) for _ in range(3)),
+            return_exceptions=True
+        )
+        assert results[0] is None
+        assert all(isinstance(r, HTTPException) and r.status_code == 503 for r in results[1:])
+        assert controller.metrics["timed_out"] == 3
+        return controller
+
+    controller = asyncio.run(scenario())
+    assert controller.semaphore._value == 1
+    assert controller.in_flight == 0 and controller.queued == 0
+
+
+def test_cancelled_waiter_does_not_leak_permit():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        async with controller.admit(5.0):
+            waiter = asyncio.ensure_future(serve(controller, 5.0, 0.01))
+            await asyncio.sleep(0.05)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        # Slot duy nhất phải dùng lại được ngay
+        await asyncio.wait_for(serve(controller, 1.0, 0.01), timeout=1.0)
+        return controller
+
+    controller = asyncio.run(scenario())
+    assert controller.semaphore._value == 1
+    assert controller.queued == 0
+
+
+def test_deadline_is_enforced_during_service():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=2, max_queue=10)
+        with pytest.raises(HTTPException) as error:
+            await serve(controller, 0.1, 0.2)
+        assert error.value.status_code == 503
+        assert controller.metrics["deadline_exceeded"] == 1
+        return controller
+
+    controller = asyncio.run(scenario())
+    assert controller.in_flight == 0
+
+
+def test_queue_full_is_shed():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1)
+        async with controller.admit(5.0):
+            waiters = [asyncio.ensure_future(serve(controller, 5.0, 0.01)) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            assert controller.metrics["shed_queue_full"] == 1
+            assert controller.queued == 1
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert sum(isinstance(r, HTTPException) for r in results) == 1
+        return controller
+
+    controller = asyncio.run(scenario())
+    assert controller.semaphore._value == 1
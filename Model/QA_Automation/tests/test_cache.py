@@ -0,0 +1,65 @@
+import numpy as np
+
+from conftest import unit_vectors
+from utils import append_to_cache, apply_delete, apply_edit, build_compacted_cache, empty_cache
+
+
+def append(state, ids, vectors):
+    state.index.add_with_ids(vectors, np.array(ids, dtype=np.int64))
+    append_to_cache(state, ids, vectors, questions=[f"q{i}" for i in ids], clean_questions=[f"q{i}" for i in ids],
+                    answer_ids=[i * 10 for i in ids], answers={i * 10: (f"a{i}", f"a{i}") for i in ids})
+
+
+def test_append_grows_buffer_without_losing_rows(app_state):
+    vectors = unit_vectors(3000)
+    for start in range(0, 3000, 700):
+        append(app_state, list(range(start, min(start + 700, 3000))), vectors[start:start + 700])
+    embeddings = app_state.cache_data['embeddings']
+    assert embeddings.shape == (3000, 4)
+    assert np.array_equal(embeddings, vectors)
+    assert embeddings.base is app_state.embedding_buffer
+    assert len(app_state.embedding_buffer) >= 3000
+
+
+def test_append_after_cache_replaced_does_not_reuse_stale_buffer(app_state):
+    append(app_state, [1, 2], unit_vectors(2, seed=1))
+    replacement = unit_vectors(1, seed=2)
+    app_state.cache_data = empty_cache()
+    app_state.cache_data.update(ids=[7], embeddings=replacement, questions=["q7"], clean_questions=["q7"],
+                                answer_ids=[70], answers={70: ("a7", "a7")})
+    app_state.id_to_idx = None
+    new = unit_vectors(1, seed=3)
+    append(app_state, [8], new)
+    assert app_state.cache_data['ids'] == [7, 8]
+    assert np.array_equal(app_state.cache_data['embeddings'], np.vstack([replacement, new]))
+
+
+def test_edit_of_unknown_record_leaves_index_untouched(app_state):
+    append(app_state, [1, 2], unit_vectors(2))
+    apply_edit(app_state, 99, unit_vectors(1, seed=5)[0], "q", "q", 990, "a", "a")
+    assert app_state.index.ntotal == 2
+    assert 99 not in app_state.cache_data['ids']
+
+    apply_delete(app_state, 2)
+    apply_edit(app_state, 2, unit_vectors(1, seed=5)[0], "q", "q", 20, "a", "a")
+    assert app_state.index.ntotal == 1
+
+
+def test_edit_replaces_row_in_place(app_state):
+    append(app_state, [1, 2], unit_vectors(2))
+    vector = unit_vectors(1, seed=7)[0]
+    apply_edit(app_state, 2, vector, "new", "new", 21, "b", "b")
+    assert app_state.index.ntotal == 2
+    assert np.array_equal(app_state.cache_data['embeddings'][1], vector)
+    assert app_state.cache_data['answer_ids'] == [10, 21]
+
+
+def test_compaction_drops_tombstones_and_unused_answers(app_state):
+    vectors = unit_vectors(3)
+    append(app_state, [1, 2, 3], vectors)
+    apply_delete(app_state, 2)
+    compacted = build_compacted_cache(app_state.cache_data)
+    assert compacted['ids'] == [1, 3]
+    assert np.array_equal(compacted['embeddings'], vectors[[0, 2]])
+    assert set(compacted['answers']) == {10, 30}
+    assert compacted['tombstones'] == set()
@@ -0,0 +1,48 @@
+import asyncio
+
+import utils
+from utils import (
+    FINE_TUNE_PENDING_KEY, SCHEDULER_LEADER_KEY, acquire_leadership, defer_fine_tune, release_fine_tune,
+    release_leadership, reserve_fine_tune
+)
+
+
+def test_reservation_is_exclusive(app_state):
+    owner = asyncio.run(reserve_fine_tune(app_state, force=True))
+    assert owner and owner.startswith(utils.REPLICA_ID)
+    assert asyncio.run(reserve_fine_tune(app_state, force=True)) is None
+
+
+def test_release_only_by_owner(app_state, redis_client):
+    owner = asyncio.run(reserve_fine_tune(app_state, force=True))
+    release_fine_tune(redis_client, "another-replica:token")
+    assert redis_client.get(FINE_TUNE_PENDING_KEY).decode() == owner
+    release_fine_tune(redis_client, owner)
+    assert redis_client.get(FINE_TUNE_PENDING_KEY) is None
+
+
+def test_expired_reservation_is_not_released_by_stale_task(app_state, redis_client):
+    # Chỗ giữ cũ hết hạn và bị lần giữ mới chiếm: task cũ trả chỗ không được xóa chỗ của lần mới
+    stale = asyncio.run(reserve_fine_tune(app_state, force=True))
+    redis_client.delete(FINE_TUNE_PENDING_KEY)
+    fresh = asyncio.run(reserve_fine_tune(app_state, force=True))
+    release_fine_tune(redis_client, stale)
+    assert redis_client.get(FINE_TUNE_PENDING_KEY).decode() == fresh
+
+
+def test_defer_shortens_only_own_reservation(app_state, redis_client):
+    owner = asyncio.run(reserve_fine_tune(app_state, force=True))
+    defer_fine_tune(redis_client, "another-replica:token", delay=5)
+    assert redis_client.ttl(FINE_TUNE_PENDING_KEY) > 5
+    defer_fine_tune(redis_client, owner, delay=5)
+    assert 0 < redis_client.ttl(FINE_TUNE_PENDING_KEY) <= 5
+    assert redis_client.get(FINE_TUNE_PENDING_KEY).decode() == owner
+
+
+def test_leadership_lease_is_owned(redis_client):
+    assert acquire_leadership(redis_client, ttl=30)
+    assert acquire_leadership(redis_client, ttl=30)  # gia hạn lease của chính mình
+    redis_client.set(SCHEDULER_LEADER_KEY, "other-replica", px=30000)
+    assert not acquire_leadership(redis_client, ttl=30)
+    release_leadership(redis_client)
+    assert redis_client.get(SCHEDULER_LEADER_KEY) == b"other-replica"
@@ -0,0 +1,46 @@
+import glob
+import os
+
+from utils import promote_checkpoint
+
+
+def make_model(path, marker: str) -> str:
+    os.makedirs(path)
+    with open(os.path.join(path, "marker"), "w") as f:
+        f.write(marker)
+    return path
+
+
+def read_marker(checkpoint_path) -> str:
+    with open(os.path.join(checkpoint_path, "marker")) as f:
+        return f.read()
+
+
+def test_promote_swaps_symlink_and_keeps_previous_version(tmp_path):
+    checkpoint = str(tmp_path / "fine_tuned_model")
+    for i in range(3):
+        promote_checkpoint(make_model(str(tmp_path / f"staging{i}"), f"v{i}"), checkpoint)
+        assert os.path.islink(checkpoint)
+        assert read_marker(checkpoint) == f"v{i}"
+    versions = glob.glob(checkpoint + ".v*")
+    # Chỉ giữ phiên bản hiện tại và phiên bản liền trước
+    assert len(versions) == 2
+    assert os.path.realpath(checkpoint) in {os.path.realpath(v) for v in versions}
+    assert not os.path.lexists(checkpoint + ".link")
+
+
+def test_promote_migrates_legacy_directory(tmp_path):
+    checkpoint = str(tmp_path / "fine_tuned_model")
+    make_model(checkpoint, "legacy")
+    promote_checkpoint(make_model(str(tmp_path / "staging"), "new"), checkpoint)
+    assert os.path.islink(checkpoint)
+    assert read_marker(checkpoint) == "new"
+    assert read_marker(checkpoint + ".v0-legacy") == "legacy"
+
+
+def test_promote_with_relative_checkpoint_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_model("fine_tuned_model", "legacy")
+    promote_checkpoint(make_model("staging", "new"), "fine_tuned_model")
+    assert read_marker("fine_tuned_model") == "new"
+    assert read_marker("fine_tuned_model.v0-legacy") == "legacy"
@@ -0,0 +1,42 @@
+import pytest
+
+from utils import AppState, switch_encoder
+
+
+@pytest.fixture
+def root():
+    root = AppState()
+    root.model, root.projection = "old-model", None
+    # Như CollectionRegistry.loaded: chỉ chứa các collection khác "default"
+    root.collection_states = {name: AppState(name, parent=root) for name in ("faq", "hr")}
+    root.reembed_run = {"batch_id": "b1", "model": "new-model", "projection": {"dim": 4}, "applied": set()}
+    return root
+
+
+def test_child_applied_first_pins_new_model(root):
+    faq = root.collection_states["faq"]
+    switch_encoder(faq, root.reembed_run)
+    assert faq.model == "new-model"
+    assert root.model == "old-model"
+    assert root.collection_states["hr"].model == "old-model"
+
+
+def test_root_switch_pins_old_model_on_unapplied_children(root):
+    faq, hr = root.collection_states["faq"], root.collection_states["hr"]
+    switch_encoder(faq, root.reembed_run)
+    switch_encoder(root, root.reembed_run)
+    assert root.model == "new-model"
+    assert faq.model == "new-model"
+    assert hr.model == "old-model" and hr.projection is None
+    assert root.reembed_run is not None
+
+
+def test_run_settles_once_every_collection_applied(root):
+    run = root.reembed_run
+    switch_encoder(root, run)
+    for name in ("faq", "hr"):
+        switch_encoder(root.collection_states[name], run)
+    assert root.reembed_run is None
+    for child in (root.collection_states["faq"], root.collection_states["hr"]):
+        assert "model" not in child.__dict__
+        assert child.model == "new-model" and child.projection == {"dim": 4}
@@ -10,16 +10,36 @@ import os
 import re
 import time
 import psutil
-import tempfile
 import shutil
+import json
+import glob
+import hashlib
+import hmac
+import socket
+import uuid
+import sys
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import math
+import heapq
+import tarfile
+import tempfile
+from contextlib import asynccontextmanager
 from redis.lock import Lock
+from celery.exceptions import SoftTimeLimitExceeded
 from datetime import datetime
-from typing import List, Tuple
+from typing import List, Tuple, Iterator, Optional
 from pyvi import ViTokenizer
 from fastapi import HTTPException
-from sentence_transformers import SentenceTransformer, InputExample, losses
-from torch.utils.data import DataLoader
-from transformers import AutoTokenizer
+import random
+import torch
+from datasets import Dataset
+from sentence_transformers import (
+    SentenceTransformer, SentenceTransformerTrainer, SentenceTransformerTrainingArguments, losses
+)
+from transformers import AutoTokenizer, TrainerCallback
 from tenacity import retry, stop_after_attempt, wait_fixed
 
 # Tắt cảnh báo pin_memory
@@ -42,10 +62,100 @@ CACHE_PATH = os.getenv("CACHE_PATH", "embedding_cache.pkl")
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "qa_index.faiss")
 MODEL_PATH = os.path.join(os.path.dirname(__file__), "phobert_base") if os.getenv("RENDER_ENV") != "production" else "/app/data/phobert_base"
 CHECKPOINT_PATH = os.path.join(os.path.dirname(__file__), "phobert_finetuned") if os.getenv("RENDER_ENV") != "production" else "/app/data/phobert_finetuned"
+STUDENT_PATH = os.path.join(os.path.dirname(__file__), "phobert_student") if os.getenv("RENDER_ENV") != "production" else "/app/data/phobert_student"
+CHECKPOINT_SAVE_STEPS = int(os.getenv("CHECKPOINT_SAVE_STEPS", 100))
+# "cpu_fast": bf16 autocast (nếu CPU hỗ trợ), giới hạn max_seq_length, gom batch theo độ dài, cố định số luồng
+# "default": fp32, không giới hạn độ dài, batch ngẫu nhiên như trước
+FINE_TUNE_PROFILE = os.getenv("FINE_TUNE_PROFILE", "cpu_fast")
+FINE_TUNE_SEQ_PERCENTILE = float(os.getenv("FINE_TUNE_SEQ_PERCENTILE", 99))
+FINE_TUNE_BATCH_SIZE = 4
+# Khai thác hard negative từ FAISS index: số láng giềng xét cho mỗi câu hỏi
+HARD_NEGATIVE_MINING = os.getenv("HARD_NEGATIVE_MINING", "true").lower() == "true"
+HARD_NEGATIVE_CANDIDATES = int(os.getenv("HARD_NEGATIVE_CANDIDATES", 10))
+# Số câu hỏi tối đa được khai thác mỗi collection (lấy mẫu), giới hạn chi phí tìm kiếm trên corpus lớn
+HARD_NEGATIVE_MAX_ANCHORS = int(os.getenv("HARD_NEGATIVE_MAX_ANCHORS", 20000))
+# Chưng cất (distillation) mô hình nhỏ hơn để phục vụ truy vấn
+DISTILL_ENABLED = os.getenv("DISTILL_ENABLED", "false").lower() == "true"
+DISTILL_NUM_LAYERS = int(os.getenv("DISTILL_NUM_LAYERS", 4))
+DISTILL_EPOCHS = int(os.getenv("DISTILL_EPOCHS", 3))
+DISTILL_MIN_RECALL = float(os.getenv("DISTILL_MIN_RECALL", 0.9))
+# Tỉ lệ câu hỏi giữ lại (không dùng để chưng cất) để đo recall@k của student
+DISTILL_HOLDOUT = float(os.getenv("DISTILL_HOLDOUT", 0.1))
+# Giảm chiều embedding bằng PCA (0 = giữ nguyên số chiều của mô hình)
+PROJECTION_DIM = int(os.getenv("PROJECTION_DIM", 0))
+PROJECTION_WHITEN = os.getenv("PROJECTION_WHITEN", "false").lower() == "true"
+PROJECTION_FILE = "projection.npz"
+# Số câu hỏi mẫu dùng để học phép chiếu khi promote checkpoint
+PROJECTION_FIT_SAMPLE = int(os.getenv("PROJECTION_FIT_SAMPLE", 20000))
+# Số dòng đã xóa (tombstone) trong cache trước khi nén lại
+TOMBSTONE_COMPACT_THRESHOLD = int(os.getenv("TOMBSTONE_COMPACT_THRESHOLD", 1000))
+# Redis stream đồng bộ thay đổi index giữa các replica
+MUTATION_STREAM = os.getenv("MUTATION_STREAM", "qa_mutations")
+MUTATION_STREAM_MAXLEN = int(os.getenv("MUTATION_STREAM_MAXLEN", 100000))
+# Số entry lỗi bị bỏ qua trước khi replica dựng lại cache từ DB; entry lỗi được giữ trong <stream>:dead
+MUTATION_MAX_FAILURES = int(os.getenv("MUTATION_MAX_FAILURES", 3))
+MUTATION_DEAD_LETTER_MAXLEN = 10000
+# Tham số BM25 cho chỉ mục từ vựng trên clean_questions (đã tách từ bằng pyvi)
+BM25_K1 = float(os.getenv("BM25_K1", 1.5))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# Bỏ qua term xuất hiện trong quá nhiều câu (gần như stopword) để chi phí một truy vấn có giới hạn
+BM25_MAX_TERM_DF = int(os.getenv("BM25_MAX_TERM_DF", 20000))
+# Dựng sẵn chỉ mục BM25 khi nạp collection (mặc định bật khi SEARCH_MODE=hybrid)
+LEXICAL_PREBUILD = (os.getenv("LEXICAL_PREBUILD") or str(os.getenv("SEARCH_MODE") == "hybrid")).lower() == "true"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Bầu leader cho scheduler: chỉ replica giữ lease mới chạy lịch fine-tune tự động
+SCHEDULER_LEADER_KEY = "scheduler:leader"
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", 60))
+SCHEDULER_TICK = int(os.getenv("SCHEDULER_TICK", 15))
+AUTO_FINE_TUNE_SCHEDULE_KEY = "scheduler:auto_fine_tune"
+AUTO_FINE_TUNE_INTERVAL = int(os.getenv("AUTO_FINE_TUNE_INTERVAL", 7 * 24 * 3600))
+# Khóa đánh dấu đang có fine-tune chờ/chạy trong cluster, tránh xếp hàng trùng lặp
+FINE_TUNE_PENDING_KEY = "fine_tune:pending"
+FINE_TUNE_PENDING_TTL = int(os.getenv("FINE_TUNE_PENDING_TTL", 6 * 3600))
+# Fine-tune thất bại hết lượt thử lại: giữ chỗ thêm chừng này giây rồi mới cho kích hoạt lại
+FINE_TUNE_RETRY_DELAY = int(os.getenv("FINE_TUNE_RETRY_DELAY", 1800))
 
 # Hằng số
 FINE_TUNE_THRESHOLD = 50
 FINE_TUNE_INTERVAL = 3600  # 1 giờ
+# Chỉ tiếp tục lần fine-tune dang dở trong khoảng thời gian này (giây) và khi dữ liệu chưa thay đổi
+FINE_TUNE_RESUME_MAX_AGE = int(os.getenv("FINE_TUNE_RESUME_MAX_AGE", 24 * 3600))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+SUPPORTED_UPLOAD_EXTENSIONS = (".xls", ".xlsx", ".csv", ".jsonl", ".parquet")
+IMPORT_STAGING_DIR = os.getenv("IMPORT_STAGING_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_staging"))
+IMPORT_JOB_TTL = 7 * 24 * 3600  # giữ trạng thái job 1 tuần
+# Bundle snapshot (mô hình + index + cache + mốc DB) để replica mới khởi động nhanh
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"))
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Profiling theo yêu cầu: sampling profile cho API, torch profiler cho worker (số bước, 0 = tắt)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+TORCH_PROFILE_STEPS = int(os.getenv("TORCH_PROFILE_STEPS", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+
+# Re-embed phân tán: chia corpus theo dải id cho nhiều worker, vector ghi vào thư mục staging dùng chung
+REEMBED_DISTRIBUTED = os.getenv("REEMBED_DISTRIBUTED", "false").lower() == "true"
+REEMBED_SHARD_SIZE = int(os.getenv("REEMBED_SHARD_SIZE", 20000))
+REEMBED_STAGING_DIR = os.getenv("REEMBED_STAGING_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "reembed_staging"))
+# Thư mục staging của lần re-embed cũ hơn TTL (giây) bị dọn khi bắt đầu lần re-embed mới
+REEMBED_STAGING_TTL = int(os.getenv("REEMBED_STAGING_TTL", 86400))
+
+# Ghi lại traffic (đã ẩn danh) của /search, /update, /upload-excel để replay.py phát lại offline
+TRAFFIC_CAPTURE = os.getenv("TRAFFIC_CAPTURE", "false").lower() == "true"
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traffic_capture.jsonl"))
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", 1.0))
+# Khóa HMAC cho hash nội dung câu hỏi; để trống thì sinh ngẫu nhiên mỗi tiến trình (không liên kết được giữa các lần chạy)
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT") or uuid.uuid4().hex
+
+# Nhiều collection (kho tri thức theo phòng ban) dùng chung một encoder; "default" là các bảng qa_* gốc
+DEFAULT_COLLECTION = "default"
+QA_COLLECTIONS = [c.strip().lower() for c in os.getenv("QA_COLLECTIONS", "").split(",")
+                  if re.fullmatch(r"[a-z0-9_]{1,32}", c.strip().lower() or "-") and c.strip().lower() != DEFAULT_COLLECTION]
+COLLECTION_MEMORY_BUDGET_MB = int(os.getenv("COLLECTION_MEMORY_BUDGET_MB", 2048))
+# Thuộc tính dùng chung giữa state của các collection: encoder, kết nối và trạng thái lập lịch
+SHARED_STATE_ATTRS = ("model", "tokenizer", "projection", "db_pool", "redis_client",
+                      "auto_fine_tune_enabled", "is_scheduler_leader")
 
 # Cấu hình MySQL cho aiomysql
 db_config = {
@@ -60,27 +170,78 @@ db_config = {
     "charset": "utf8mb4"
 }
 
-# Quản lý trạng thái ứng dụng
+# Cấu trúc cache trong bộ nhớ: mỗi câu hỏi một dòng, câu trả lời được lưu một lần theo answer_id
+# 'answers' = {answer_id: (answer, clean_answer)}, 'answer_ids' = answer_id của từng dòng
+def empty_cache() -> dict:
+    return {
+        'ids': [],
+        'embeddings': np.array([]),
+        'questions': [],
+        'clean_questions': [],
+        'answer_ids': [],
+        'answers': {},
+        'tombstones': set(),
+        'last_updated': None
+    }
+
+# Đường dẫn lưu trữ riêng của collection: embedding_cache.pkl -> embedding_cache.<collection>.pkl
+def collection_path(path: str, collection: str) -> str:
+    if collection == DEFAULT_COLLECTION:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{collection}{ext}"
+
+# Quản lý trạng thái ứng dụng. State của collection khác "default" có parent là state gốc
+# và đọc/ghi các thuộc tính dùng chung (SHARED_STATE_ATTRS) qua parent.
 class AppState:
-    def __init__(self):
+    def __init__(self, collection: str = DEFAULT_COLLECTION, parent: "AppState" = None):
+        object.__setattr__(self, "parent", parent)
+        self.collection = collection
+        prefix = "qa" if collection == DEFAULT_COLLECTION else f"qa_{collection}"
+        self.data_table = f"{prefix}_data"
+        self.answers_table = f"{prefix}_answers"
+        self.stats_table = f"{prefix}_stats"
+        self.cache_path = collection_path(CACHE_PATH, collection)
+        self.index_path = collection_path(FAISS_INDEX_PATH, collection)
+        self.mutation_stream = MUTATION_STREAM if collection == DEFAULT_COLLECTION else f"{MUTATION_STREAM}:{collection}"
         self.raw_data = None
-        self.cache_data = {
-            'ids': [],
-            'embeddings': np.array([]),
-            'questions': [],
-            'answers': [],
-            'clean_questions': [],
-            'clean_answers': [],
-            'last_updated': None
-        }
+        self.cache_data = empty_cache()
         self.index = None
-        self.model = None
         self.last_fine_tune = 0
         self.last_fine_tune_record_count = 0
-        self.db_pool = None
-        self.redis_client = None
-        self.tokenizer = None
-        self.auto_fine_tune_enabled = True
+        if parent is None:
+            self.model = None
+            self.db_pool = None
+            self.redis_client = None
+            self.tokenizer = None
+            self.auto_fine_tune_enabled = True
+            self.projection = None
+            self.is_scheduler_leader = False
+            self.collection_states = {}  # collection đang nạp (CollectionRegistry.loaded)
+            self.reembed_run = None  # lần re-embed đang được các collection áp dụng (xem apply_reembed)
+        self.synced_import_jobs = set()
+        self.id_to_idx = None
+        self.embedding_buffer = None  # vùng nhớ dư chỗ chứa cache_data['embeddings'] (xem append_to_cache)
+        self.lexical_index = None
+        self.lexical_build = None  # task đang dựng chỉ mục BM25 trong thread
+        self.lexical_pending = None  # thay đổi cache xảy ra trong lúc dựng, áp dụng khi dựng xong
+        self.cache_version = 0
+        self.compacting = False
+        self.pending_reembed = None
+        self.mutation_consumer = None
+
+    def __getattr__(self, name):
+        parent = self.__dict__.get("parent")
+        if parent is not None and name in SHARED_STATE_ATTRS:
+            return getattr(parent, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        parent = self.__dict__.get("parent")
+        if parent is not None and name in SHARED_STATE_ATTRS:
+            setattr(parent, name, value)
+        else:
+            object.__setattr__(self, name, value)
 
 # Khởi tạo state global
 state = AppState()
@@ -134,22 +295,75 @@ async def init_db(state: AppState):
     async with state.db_pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                await cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS qa_data (
+                # Câu trả lời được lưu một lần trong qa_answers, qa_data tham chiếu qua answer_id
+                await cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {state.answers_table} (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        answer_hash CHAR(64) NOT NULL,
+                        answer TEXT NOT NULL,
+                        UNIQUE KEY uq_answer_hash (answer_hash)
+                    )
+                """)
+                await cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {state.data_table} (
                         id INT AUTO_INCREMENT PRIMARY KEY,
                         date DATETIME NOT NULL,
                         question TEXT NOT NULL,
-                        answer TEXT NOT NULL,
+                        answer_id INT NOT NULL,
                         embedding BLOB,
-                        INDEX idx_date (date)
+                        INDEX idx_date (date),
+                        INDEX idx_answer_id (answer_id)
+                    )
+                """)
+                await migrate_answer_table(cursor, state)
+                # Thống kê corpus được duy trì cùng transaction với các lệnh INSERT
+                await cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {state.stats_table} (
+                        id TINYINT PRIMARY KEY,
+                        total_records BIGINT NOT NULL DEFAULT 0,
+                        last_fine_tune_record_count BIGINT NOT NULL DEFAULT 0,
+                        last_fine_tune DATETIME NULL,
+                        updated_at DATETIME NOT NULL
                     )
                 """)
+                await cursor.execute(
+                    f"INSERT IGNORE INTO {state.stats_table} (id, total_records, updated_at) "
+                    f"SELECT 1, COUNT(*), NOW() FROM {state.data_table}"
+                )
                 await conn.commit()
                 logger.info("Database initialized successfully")
             except Exception as e:
                 logger.error(f"Error initializing database: {e}")
                 raise HTTPException(status_code=500, detail=f"Error initializing database: {str(e)}")
 
+# Chuyển bảng qa_data cũ (cột answer TEXT trên từng dòng) sang tham chiếu qa_answers
+async def migrate_answer_table(cursor, state: AppState):
+    data_table, answers_table = state.data_table, state.answers_table
+    await cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (data_table,)
+    )
+    columns = {row[0] for row in await cursor.fetchall()}
+    if 'answer' not in columns:
+        return
+    logger.info(f"Migrating {data_table} answers into {answers_table}")
+    if 'answer_id' not in columns:
+        await cursor.execute(f"ALTER TABLE {data_table} ADD COLUMN answer_id INT NULL, ADD INDEX idx_answer_id (answer_id)")
+    await cursor.execute(
+        f"INSERT IGNORE INTO {answers_table} (answer_hash, answer) "
+        f"SELECT SHA2(answer, 256), answer FROM {data_table} WHERE answer_id IS NULL"
+    )
+    await cursor.execute(
+        f"UPDATE {data_table} d JOIN {answers_table} a ON a.answer_hash = SHA2(d.answer, 256) "
+        "SET d.answer_id = a.id WHERE d.answer_id IS NULL"
+    )
+    await cursor.execute(f"ALTER TABLE {data_table} DROP COLUMN answer, MODIFY answer_id INT NOT NULL")
+    logger.info(f"Migrated {data_table} answers into {answers_table}")
+
+def answer_hash(answer: str) -> str:
+    return hashlib.sha256(answer.encode("utf-8")).hexdigest()
+
 # Hàm làm sạch văn bản
 def clean_text(text: str) -> str:
     if not isinstance(text, str) or not text.strip():
@@ -166,7 +380,7 @@ async def count_records(state: AppState) -> int:
     async with state.db_pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                await cursor.execute("SELECT COUNT(*) FROM qa_data")
+                await cursor.execute(f"SELECT COUNT(*) FROM {state.data_table}")
                 count = (await cursor.fetchone())[0]
                 return count
             except Exception as e:
@@ -178,7 +392,7 @@ async def get_latest_timestamp(state: AppState) -> datetime:
     async with state.db_pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                await cursor.execute("SELECT MAX(date) FROM qa_data")
+                await cursor.execute(f"SELECT MAX(date) FROM {state.data_table}")
                 result = (await cursor.fetchone())[0]
                 return result if result else datetime.min
             except Exception as e:
@@ -190,33 +404,35 @@ async def load_data_db(state: AppState, limit: int = None, batch_size: int = 100
     try:
         async with state.db_pool.acquire() as conn:
             async with conn.cursor() as cursor:
-                query = "SELECT id, date, question, answer, embedding FROM qa_data"
+                query = ("SELECT d.id, d.date, d.question, a.answer, d.embedding, d.answer_id "
+                         f"FROM {state.data_table} d JOIN {state.answers_table} a ON a.id = d.answer_id")
                 if limit:
                     query += f" LIMIT {limit}"
                 await cursor.execute(query)
                 rows = await cursor.fetchall()
                 if not rows:
-                    logger.info("No data found in qa_data table")
-                    return pd.DataFrame(columns=['id', 'date', 'question', 'answer', 'embedding'])
+                    logger.info(f"No data found in {state.data_table} table")
+                    return pd.DataFrame(columns=['id', 'date', 'question', 'answer', 'embedding', 'answer_id'])
                 data = []
                 for row in rows:
-                    embedding = np.frombuffer(row[4]) if row[4] else None
+                    embedding = np.frombuffer(row[4], dtype=np.float32) if row[4] else None
                     data.append({
                         'id': row[0],
                         'date': row[1],
                         'question': row[2],
                         'answer': row[3],
-                        'embedding': embedding
+                        'embedding': embedding,
+                        'answer_id': row[5]
                     })
                 result = pd.DataFrame(data)
                 logger.info(f"Loaded {len(result)} records from database")
                 return result
     except Exception as e:
         logger.error(f"Error loading data: {e}")
-        return pd.DataFrame(columns=['id', 'date', 'question', 'answer', 'embedding'])
+        return pd.DataFrame(columns=['id', 'date', 'question', 'answer', 'embedding', 'answer_id'])
 
 # Lưu dữ liệu vào MySQL
-async def save_data_batch(records: List[Tuple], state: AppState) -> List[Tuple[int, str, str]]:
+async def save_data_batch(records: List[Tuple], state: AppState) -> List[Tuple[int, str, str, int]]:
     if not all(len(record) == 4 for record in records):
         logger.error("Invalid record format in records")
         raise HTTPException(status_code=400, detail="Each record must have 4 elements: "
@@ -224,16 +440,647 @@ async def save_data_batch(records: List[Tuple], state: AppState) -> List[Tuple[i
     async with state.db_pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                query = "INSERT INTO qa_data (date, question, answer, embedding) VALUES (%s, %s, %s, %s)"
-                await cursor.executemany(query, records)
-                await conn.commit()
+                answer_ids = await upsert_answers(cursor, [record[2] for record in records], state.answers_table)
+                query = f"INSERT INTO {state.data_table} (date, question, answer_id, embedding) VALUES (%s, %s, %s, %s)"
+                await cursor.executemany(query, [
+                    (record[0], record[1], answer_ids[record[2]], record[3]) for record in records
+                ])
                 last_id = cursor.lastrowid
+                await cursor.execute(
+                    f"UPDATE {state.stats_table} SET total_records = total_records + %s, updated_at = NOW() WHERE id = 1",
+                    (len(records),)
+                )
+                await conn.commit()
                 logger.info(f"Saved {len(records)} records starting with ID: {last_id}")
-                return [(last_id + i, record[1], record[2]) for i, record in enumerate(records)]
+                return [(last_id + i, record[1], record[2], answer_ids[record[2]]) for i, record in enumerate(records)]
             except Exception as e:
+                await conn.rollback()
                 logger.error(f"Error saving data: {e}")
                 raise HTTPException(status_code=500, detail="Lỗi lưu dữ liệu")
 
+# Thêm các câu trả lời chưa có vào qa_answers, trả về ánh xạ answer -> answer_id
+async def upsert_answers(cursor, answers: List[str], answers_table: str = "qa_answers") -> dict:
+    unique = {answer_hash(a): a for a in answers}
+    if not unique:
+        return {}
+    await cursor.executemany(
+        f"INSERT IGNORE INTO {answers_table} (answer_hash, answer) VALUES (%s, %s)",
+        list(unique.items())
+    )
+    placeholders = ", ".join(["%s"] * len(unique))
+    # Khóa chia sẻ giữ câu trả lời tới khi transaction của người gọi (ghi qa_data) commit,
+    # để compact_cache không xóa nó như câu trả lời mồ côi trong lúc đó
+    await cursor.execute(
+        f"SELECT answer_hash, id FROM {answers_table} WHERE answer_hash IN ({placeholders}) LOCK IN SHARE MODE",
+        list(unique.keys())
+    )
+    ids_by_hash = dict(await cursor.fetchall())
+    return {answer: ids_by_hash[h] for h, answer in unique.items()}
+
+# Đọc thống kê corpus (O(1), dùng chung giữa các replica API và worker)
+async def get_corpus_stats(state: AppState) -> dict:
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"SELECT total_records, last_fine_tune_record_count, last_fine_tune FROM {state.stats_table} WHERE id = 1"
+            )
+            row = await cursor.fetchone()
+    if not row:
+        return {'total_records': 0, 'last_fine_tune_record_count': 0, 'new_records': 0, 'last_fine_tune': None}
+    return {
+        'total_records': row[0],
+        'last_fine_tune_record_count': row[1],
+        'new_records': row[0] - row[1],
+        'last_fine_tune': row[2]
+    }
+
+# Kiểm tra điều kiện kích hoạt fine-tune: đủ bản ghi mới và đã qua khoảng nghỉ kể từ lần fine-tune xong gần nhất.
+# Không ghi gì vào DB: mốc chỉ được dời trong record_fine_tune khi huấn luyện hoàn tất, nên task lỗi hoặc bị
+# kill không làm mất lần kích hoạt. Chỉ một replica xếp task nhờ chỗ giữ FINE_TUNE_PENDING_KEY (reserve_fine_tune).
+async def claim_fine_tune(state: AppState, threshold: int = FINE_TUNE_THRESHOLD,
+                          interval: int = FINE_TUNE_INTERVAL) -> bool:
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"""
+                SELECT 1 FROM {state.stats_table}
+                WHERE id = 1
+                  AND total_records >= 10
+                  AND total_records - last_fine_tune_record_count >= %s
+                  AND (last_fine_tune IS NULL OR last_fine_tune < NOW() - INTERVAL %s SECOND)
+                """,
+                (threshold, interval)
+            )
+            return await cursor.fetchone() is not None
+
+# Giữ chỗ fine-tune cho toàn cluster trước khi xếp task vào Celery: chỉ một task chờ/chạy tại một thời điểm.
+# force=True (fine-tune thủ công) bỏ qua điều kiện số bản ghi mới.
+# Trả về token chủ sở hữu (truyền cho fine_tune_task để worker trả đúng chỗ của mình), None nếu không giữ được.
+async def reserve_fine_tune(state: AppState, interval: int = FINE_TUNE_INTERVAL, force: bool = False) -> Optional[str]:
+    owner = f"{REPLICA_ID}:{uuid.uuid4().hex}"
+    if not state.redis_client.set(FINE_TUNE_PENDING_KEY, owner, nx=True, ex=FINE_TUNE_PENDING_TTL):
+        logger.info("A fine-tune task is already pending in the cluster, skipping")
+        return None
+    try:
+        if force or await claim_fine_tune(state, interval=interval):
+            return owner
+    except Exception:
+        release_fine_tune(state.redis_client, owner)
+        raise
+    release_fine_tune(state.redis_client, owner)
+    return None
+
+# Chỉ xóa chỗ giữ nếu vẫn thuộc owner: chỗ đã hết hạn và bị lần giữ khác chiếm thì không đụng tới
+def release_fine_tune(redis_client: redis.Redis, owner: str):
+    redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, FINE_TUNE_PENDING_KEY, owner)
+
+# Fine-tune thất bại: giữ chỗ thêm delay giây (thay vì trả ngay) để mỗi bản ghi mới không kích hoạt lại liên tục;
+# mốc bản ghi chưa dời nên hết hạn chỗ giữ thì lần kích hoạt kế tiếp sẽ thử lại
+def defer_fine_tune(redis_client: redis.Redis, owner: str, delay: int = FINE_TUNE_RETRY_DELAY):
+    redis_client.eval(_RENEW_LEASE_SCRIPT, 1, FINE_TUNE_PENDING_KEY, owner, delay * 1000)
+
+# Ghi nhận số bản ghi đã dùng cho lần fine-tune vừa hoàn tất
+async def record_fine_tune(state: AppState, record_count: int):
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"UPDATE {state.stats_table} SET last_fine_tune_record_count = %s, last_fine_tune = NOW(), updated_at = NOW() "
+                "WHERE id = 1",
+                (record_count,)
+            )
+            await conn.commit()
+
+# Đọc file tải lên theo từng chunk, không nạp toàn bộ file vào bộ nhớ
+def iter_upload_chunks(path: str, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    ext = os.path.splitext(path)[1].lower()
+    columns = ['question', 'answer']
+    if ext in (".xls", ".xlsx"):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(c).strip() if c is not None else '' for c in (next(rows, None) or ())]
+            if 'question' not in header or 'answer' not in header:
+                raise HTTPException(status_code=400, detail="File must have 'question' and 'answer' columns")
+            q_idx, a_idx = header.index('question'), header.index('answer')
+            buffer = []
+            for row in rows:
+                buffer.append((
+                    row[q_idx] if q_idx < len(row) else None,
+                    row[a_idx] if a_idx < len(row) else None
+                ))
+                if len(buffer) >= chunk_size:
+                    yield pd.DataFrame(buffer, columns=columns)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=columns)
+        finally:
+            workbook.close()
+    elif ext == ".csv":
+        try:
+            reader = pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_size)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="File must have 'question' and 'answer' columns")
+        with reader:
+            for chunk in reader:
+                yield chunk
+    elif ext == ".jsonl":
+        with pd.read_json(path, lines=True, dtype=False, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                if 'question' not in chunk.columns or 'answer' not in chunk.columns:
+                    raise HTTPException(status_code=400, detail="File must have 'question' and 'answer' columns")
+                yield chunk[columns]
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        if not set(columns).issubset(parquet_file.schema_arrow.names):
+            raise HTTPException(status_code=400, detail="File must have 'question' and 'answer' columns")
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        raise HTTPException(status_code=400, detail=f"Supported file types: {', '.join(SUPPORTED_UPLOAD_EXTENSIONS)}")
+
+# Chuẩn hóa và làm sạch một chunk, trả về các cặp hợp lệ (question, answer, q_clean, a_clean)
+def prepare_chunk(df: pd.DataFrame) -> Tuple[List[Tuple[str, str, str, str]], int]:
+    prepared = []
+    skipped_empty = 0
+    for col in ['question', 'answer']:
+        df[col] = df[col].fillna('').astype(str).str.strip()
+    for q, a in zip(df['question'], df['answer']):
+        q_clean = clean_text(q) if q else ""
+        a_clean = clean_text(a) if a else ""
+        if not q_clean or not a_clean:
+            skipped_empty += 1
+            continue
+        prepared.append((q, a, q_clean, a_clean))
+    return prepared, skipped_empty
+
+# Lấy các cặp (question, answer) đã có trong DB trong số các câu hỏi của chunk
+async def find_existing_pairs(questions: List[str], state: AppState) -> set:
+    if not questions:
+        return set()
+    unique_questions = list(set(questions))
+    placeholders = ", ".join(["%s"] * len(unique_questions))
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"SELECT d.question, a.answer FROM {state.data_table} d JOIN {state.answers_table} a ON a.id = d.answer_id "
+                f"WHERE d.question IN ({placeholders})",
+                unique_questions
+            )
+            return {(row[0], row[1]) for row in await cursor.fetchall()}
+
+# Thêm bản ghi mới vào cache trong bộ nhớ (FAISS index do nơi gọi tự cập nhật)
+def append_to_cache(state: AppState, ids: List[int], embeddings: np.ndarray, questions: List[str],
+                    clean_questions: List[str], answer_ids: List[int], answers: dict):
+    if not ids:
+        return
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+    current = state.cache_data['embeddings']
+    rows = len(current) if current.size else 0
+    buffer = state.embedding_buffer
+    # cache_data['embeddings'] là view của một buffer dư chỗ; chỉ cấp phát lại (gấp đôi) khi hết chỗ nên
+    # chuỗi append của import streaming sao chép tổng cộng O(N) thay vì vstack toàn bộ cache mỗi chunk
+    if buffer is None or current.base is not buffer or buffer.shape[1] != embeddings.shape[1] \
+            or rows + len(ids) > len(buffer):
+        buffer = np.empty((max(rows + len(ids), 2 * rows, 1024), embeddings.shape[1]), dtype=np.float32)
+        if rows:
+            buffer[:rows] = current
+        state.embedding_buffer = buffer
+    buffer[rows:rows + len(ids)] = embeddings
+    state.cache_data['embeddings'] = buffer[:rows + len(ids)]
+    state.cache_data['ids'].extend(ids)
+    state.cache_data['questions'].extend(questions)
+    state.cache_data['clean_questions'].extend(clean_questions)
+    state.cache_data['answer_ids'].extend(answer_ids)
+    state.cache_data['answers'].update(answers)
+    state.cache_data['last_updated'] = datetime.now()
+    if state.id_to_idx is not None:
+        start = len(state.cache_data['ids']) - len(ids)
+        state.id_to_idx.update((id_, start + i) for i, id_ in enumerate(ids))
+    if state.lexical_index is not None:
+        for id_, question_clean in zip(ids, clean_questions):
+            state.lexical_index.add(id_, question_clean)
+    elif state.lexical_pending is not None:
+        state.lexical_pending.extend(zip(ids, clean_questions))
+    state.cache_version += 1
+
+# Ánh xạ id -> vị trí dòng trong cache, tạo lại khi cache bị thay thế
+def get_row_index(state: AppState) -> dict:
+    if state.id_to_idx is None or len(state.id_to_idx) != len(state.cache_data['ids']):
+        state.id_to_idx = {id_: idx for idx, id_ in enumerate(state.cache_data['ids'])}
+    return state.id_to_idx
+
+# Chỉ mục đảo BM25 trên câu hỏi đã tách từ, khóa theo id bản ghi (không phụ thuộc vị trí dòng trong cache)
+class BM25Index:
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B, max_term_df: int = BM25_MAX_TERM_DF):
+        self.k1 = k1
+        self.b = b
+        self.max_term_df = max_term_df
+        self.postings = {}  # term -> {id: tần suất trong câu}
+        self.doc_terms = {}  # id -> các term của câu, dùng khi xóa/sửa
+        self.doc_len = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, doc_id: int, text: str):
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        counts = Counter(text.split())
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_terms[doc_id] = list(counts)
+        self.doc_len[doc_id] = sum(counts.values())
+        self.total_len += self.doc_len[doc_id]
+
+    def remove(self, doc_id: int):
+        if doc_id not in self.doc_len:
+            return
+        for term in self.doc_terms.pop(doc_id):
+            posting = self.postings[term]
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    # Trả về [(id, điểm BM25, điểm chuẩn hóa 0..1)] giảm dần; điểm chuẩn hóa = điểm / tổng idf các term
+    # của truy vấn, nên truy vấn có từ không xuất hiện trong kho dữ liệu sẽ có độ tin cậy thấp.
+    # Chạy trong thread trong khi event loop có thể cập nhật chỉ mục, nên chỉ duyệt trên bản sao posting.
+    def search(self, text: str, limit: int) -> List[Tuple[int, float, float]]:
+        terms = set(text.split())
+        doc_count = len(self.doc_len)
+        if not terms or not doc_count:
+            return []
+        avg_len = max(self.total_len, 1) / doc_count
+        scores = {}
+        max_score = 0.0
+        for term in terms:
+            posting = self.postings.get(term, {}).copy()
+            if len(posting) > self.max_term_df:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            max_score += idf
+            for doc_id, tf in posting.items():
+                doc_len = self.doc_len.get(doc_id)
+                if doc_len is None:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * doc_len / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        top = heapq.nlargest(limit, scores.items(), key=lambda x: x[1])
+        return [(doc_id, score, min(score / max_score, 1.0) if max_score else 0.0) for doc_id, score in top]
+
+# Dựng chỉ mục BM25 từ danh sách (id, câu hỏi đã tách từ)
+def build_lexical_index(documents: List[Tuple[int, str]], tombstones=()) -> BM25Index:
+    index = BM25Index()
+    for id_, question_clean in documents:
+        if id_ not in tombstones:
+            index.add(id_, question_clean)
+    return index
+
+# Chỉ mục BM25 của collection (đồng bộ, cho nơi không chạy trên event loop)
+def get_lexical_index(state: AppState) -> BM25Index:
+    if state.lexical_index is None:
+        state.lexical_index = build_lexical_index(
+            zip(state.cache_data['ids'], state.cache_data['clean_questions']), state.cache_data.get('tombstones', ())
+        )
+    return state.lexical_index
+
+# Chỉ mục BM25 của collection, dựng trong thread khi cache bị thay thế, sau đó cập nhật tăng dần.
+# Các request đồng thời cùng chờ một lần dựng; thay đổi cache trong lúc dựng được ghi lại rồi áp dụng sau.
+async def ensure_lexical_index(state: AppState) -> BM25Index:
+    while state.lexical_index is None:
+        if state.lexical_build is None:
+            state.lexical_build = asyncio.ensure_future(_build_lexical_index(state))
+        await asyncio.shield(state.lexical_build)
+    return state.lexical_index
+
+async def _build_lexical_index(state: AppState):
+    start_time = time.time()
+    cache = state.cache_data
+    documents = list(zip(cache['ids'], cache['clean_questions']))
+    tombstones = set(cache.get('tombstones', ()))
+    state.lexical_pending = []
+    try:
+        index = await asyncio.to_thread(build_lexical_index, documents, tombstones)
+        if state.cache_data is not cache:
+            logger.info(f"Cache replaced while building BM25 index for {state.collection}, rebuilding")
+            return
+        for id_, question_clean in state.lexical_pending:
+            if question_clean is None:
+                index.remove(id_)
+            else:
+                index.add(id_, question_clean)
+        state.lexical_index = index
+        logger.info(f"Built BM25 index for collection {state.collection}: {len(index)} questions, "
+                    f"{len(index.postings)} terms in {time.time() - start_time:.2f}s")
+    finally:
+        state.lexical_pending = None
+        state.lexical_build = None
+
+# Sửa một cặp hỏi đáp: cập nhật DB, thay vector trong index và ghi đè dòng cache tại chỗ
+async def edit_record(state: AppState, qa_id: int, question: str, answer: str, embedding: np.ndarray,
+                      question_clean: str, answer_clean: str) -> bool:
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            try:
+                answer_id = (await upsert_answers(cursor, [answer], state.answers_table))[answer]
+                await cursor.execute(
+                    f"UPDATE {state.data_table} SET question = %s, answer_id = %s, embedding = %s WHERE id = %s",
+                    (question, answer_id, embedding.astype(np.float32).tobytes(), qa_id)
+                )
+                if cursor.rowcount == 0:
+                    await cursor.execute(f"SELECT 1 FROM {state.data_table} WHERE id = %s", (qa_id,))
+                    if not await cursor.fetchone():
+                        await conn.rollback()
+                        return False
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error editing record {qa_id}: {e}")
+                raise HTTPException(status_code=500, detail="Lỗi cập nhật dữ liệu")
+    apply_edit(state, qa_id, embedding, question, question_clean, answer_id, answer, answer_clean)
+    publish_mutation(state.redis_client, "edit", [qa_id], embedding.reshape(1, -1), stream=state.mutation_stream,
+                     questions=[question], clean_questions=[question_clean], answer_ids=[answer_id],
+                     answers={answer_id: [answer, answer_clean]})
+    logger.info(f"Edited record {qa_id}")
+    return True
+
+# Thay vector trong index và ghi đè dòng cache tại chỗ
+def apply_edit(state: AppState, qa_id: int, embedding: np.ndarray, question: str, question_clean: str,
+               answer_id: int, answer: str, answer_clean: str):
+    idx = get_row_index(state).get(qa_id)
+    if idx is None or qa_id in state.cache_data['tombstones']:
+        # Không có dòng cache tương ứng: không thêm vector vào index để cache và index không lệch nhau
+        logger.debug(f"Record {qa_id} is not in the cache, skipping edit")
+        return
+    ids = np.array([qa_id], dtype=np.int64)
+    state.index.remove_ids(ids)
+    state.index.add_with_ids(embedding.reshape(1, -1).astype(np.float32), ids)
+    state.cache_data['embeddings'][idx] = embedding
+    state.cache_data['questions'][idx] = question
+    state.cache_data['clean_questions'][idx] = question_clean
+    state.cache_data['answer_ids'][idx] = answer_id
+    state.cache_data['answers'][answer_id] = (answer, answer_clean)
+    state.cache_data['last_updated'] = datetime.now()
+    if state.lexical_index is not None:
+        state.lexical_index.add(qa_id, question_clean)
+    elif state.lexical_pending is not None:
+        state.lexical_pending.append((qa_id, question_clean))
+    state.cache_version += 1
+
+# Xóa một cặp hỏi đáp: xóa khỏi DB và index, đánh dấu tombstone trên dòng cache
+async def delete_record(state: AppState, qa_id: int) -> bool:
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            try:
+                await cursor.execute(f"DELETE FROM {state.data_table} WHERE id = %s", (qa_id,))
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    return False
+                await cursor.execute(
+                    f"UPDATE {state.stats_table} SET total_records = total_records - 1, updated_at = NOW() WHERE id = 1"
+                )
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error deleting record {qa_id}: {e}")
+                raise HTTPException(status_code=500, detail="Lỗi xóa dữ liệu")
+    apply_delete(state, qa_id)
+    publish_mutation(state.redis_client, "delete", [qa_id], stream=state.mutation_stream)
+    logger.info(f"Deleted record {qa_id}")
+    return True
+
+# Xóa vector khỏi index và đánh dấu tombstone trên dòng cache
+def apply_delete(state: AppState, qa_id: int):
+    state.index.remove_ids(np.array([qa_id], dtype=np.int64))
+    if qa_id in get_row_index(state) and qa_id not in state.cache_data.setdefault('tombstones', set()):
+        state.cache_data['tombstones'].add(qa_id)
+        state.cache_data['last_updated'] = datetime.now()
+        if state.lexical_index is not None:
+            state.lexical_index.remove(qa_id)
+        elif state.lexical_pending is not None:
+            state.lexical_pending.append((qa_id, None))
+        state.cache_version += 1
+
+# Loại bỏ các dòng tombstone khỏi cache (chạy trong thread), trả về cache mới
+def build_compacted_cache(cache_data: dict) -> dict:
+    tombstones = cache_data.get('tombstones', set())
+    keep = [i for i, id_ in enumerate(cache_data['ids']) if id_ not in tombstones]
+    answer_ids = [cache_data['answer_ids'][i] for i in keep]
+    used_answers = set(answer_ids)
+    return {
+        'ids': [cache_data['ids'][i] for i in keep],
+        'embeddings': cache_data['embeddings'][keep] if keep else np.array([]),
+        'questions': [cache_data['questions'][i] for i in keep],
+        'clean_questions': [cache_data['clean_questions'][i] for i in keep],
+        'answer_ids': answer_ids,
+        'answers': {k: v for k, v in cache_data['answers'].items() if k in used_answers},
+        'tombstones': set(),
+        'last_updated': cache_data['last_updated'],
+        'stream_offset': cache_data.get('stream_offset')
+    }
+
+# Nén cache khi số tombstone vượt ngưỡng; bỏ qua nếu cache thay đổi trong lúc nén
+async def compact_cache(state: AppState, threshold: int = TOMBSTONE_COMPACT_THRESHOLD) -> bool:
+    if state.compacting or len(state.cache_data.get('tombstones', ())) < threshold:
+        return False
+    state.compacting = True
+    try:
+        version = state.cache_version
+        compacted = await asyncio.to_thread(build_compacted_cache, state.cache_data)
+        if version != state.cache_version:
+            logger.info("Cache changed during compaction, retrying later")
+            return False
+        removed = len(state.cache_data['ids']) - len(compacted['ids'])
+        state.cache_data = compacted
+        state.id_to_idx = None
+        state.cache_version += 1
+        await asyncio.to_thread(save_cache, state.cache_data, state.cache_path, state.redis_client)
+        await delete_orphan_answers(state)
+        logger.info(f"Compacted cache, removed {removed} tombstoned rows")
+        return True
+    finally:
+        state.compacting = False
+
+# Xóa các câu trả lời không còn câu hỏi nào tham chiếu. Các dòng bị khóa FOR UPDATE trong cùng transaction và
+# điều kiện NOT EXISTS được kiểm tra lại khi xóa, nên câu trả lời vừa được upsert_answers dùng lại (đang giữ
+# khóa chia sẻ) sẽ không bị xóa.
+async def delete_orphan_answers(state: AppState, batch_size: int = 1000) -> int:
+    orphan_filter = f"NOT EXISTS (SELECT 1 FROM {state.data_table} d WHERE d.answer_id = a.id)"
+    deleted = 0
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            try:
+                await cursor.execute(f"SELECT a.id FROM {state.answers_table} a WHERE {orphan_filter} FOR UPDATE")
+                orphans = [row[0] for row in await cursor.fetchall()]
+                for i in range(0, len(orphans), batch_size):
+                    batch = orphans[i:i + batch_size]
+                    placeholders = ", ".join(["%s"] * len(batch))
+                    await cursor.execute(
+                        f"DELETE a FROM {state.answers_table} a WHERE a.id IN ({placeholders}) AND {orphan_filter}",
+                        batch
+                    )
+                    deleted += cursor.rowcount
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    if deleted:
+        logger.info(f"Deleted {deleted} orphan answers from {state.answers_table}")
+    return deleted
+
+# Nhập dữ liệu theo luồng: làm sạch → loại trùng → mã hóa → lưu DB theo từng chunk.
+# Việc đọc file, làm sạch và mã hóa chạy trong thread để không chặn event loop.
+async def import_records_stream(path: str, state: AppState, stats: dict = None, update_index: bool = True,
+                                chunk_size: int = IMPORT_CHUNK_SIZE, progress=None) -> dict:
+    stats = stats if stats is not None else {}
+    for key in ('parsed', 'skipped_empty', 'skipped_duplicate', 'encoded', 'inserted'):
+        stats.setdefault(key, 0)
+    chunks = iter_upload_chunks(path, chunk_size)
+    while True:
+        with trace_span("parse"):
+            df = await asyncio.to_thread(next, chunks, None)
+        if df is None:
+            break
+        stats['parsed'] += len(df)
+        with trace_span("clean"):
+            prepared, skipped_empty = await asyncio.to_thread(prepare_chunk, df)
+        stats['skipped_empty'] += skipped_empty
+        # Các chunk trước đã được ghi vào DB nên find_existing_pairs bắt được trùng lặp giữa các chunk;
+        # seen chỉ loại trùng trong chunk hiện tại, bộ nhớ không tăng theo kích thước file
+        with trace_span("dedup"):
+            existing = await find_existing_pairs([p[0] for p in prepared], state)
+        seen = set()
+        fresh = []
+        for item in prepared:
+            key = (item[0], item[1])
+            if key in existing or key in seen:
+                stats['skipped_duplicate'] += 1
+                continue
+            seen.add(key)
+            fresh.append(item)
+        if not fresh:
+            if progress:
+                progress(stats)
+            continue
+        with trace_span("encode"):
+            embeddings = await asyncio.to_thread(encode_text_batch, [item[2] for item in fresh], state)
+        stats['encoded'] += len(fresh)
+        now = datetime.now()
+        with trace_span("save_db"):
+            inserted = await save_data_batch(
+                [(now, item[0], item[1], emb.astype(np.float32).tobytes()) for item, emb in zip(fresh, embeddings)],
+                state
+            )
+        stats['inserted'] += len(inserted)
+        publish_mutation(
+            state.redis_client, "insert", [data[0] for data in inserted], embeddings, stream=state.mutation_stream,
+            questions=[item[0] for item in fresh], clean_questions=[item[2] for item in fresh],
+            answer_ids=[data[3] for data in inserted],
+            answers={data[3]: [item[1], item[3]] for item, data in zip(fresh, inserted)}
+        )
+        if update_index:
+            # Cập nhật index và cache cùng lúc theo từng chunk: id đã ghi DB luôn có dòng cache tương ứng
+            ids = [data[0] for data in inserted]
+            embeddings = embeddings.astype(np.float32)
+            state.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+            append_to_cache(
+                state, ids, embeddings, [item[0] for item in fresh], [item[2] for item in fresh],
+                [data[3] for data in inserted], {data[3]: (item[1], item[3]) for item, data in zip(fresh, inserted)}
+            )
+        logger.debug(f"Imported chunk: {stats}")
+        if progress:
+            progress(stats)
+    logger.info(f"Streaming import finished: {stats}")
+    return stats
+
+# Đồng bộ các bản ghi có id lớn hơn id lớn nhất trong cache, dùng embedding đã lưu trong DB
+async def sync_new_records(state: AppState, batch_size: int = IMPORT_CHUNK_SIZE) -> int:
+    last_id = max(state.cache_data['ids']) if state.cache_data['ids'] else 0
+    synced = 0
+    while True:
+        async with state.db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"SELECT d.id, d.question, a.answer, d.embedding, d.answer_id FROM {state.data_table} d "
+                    f"JOIN {state.answers_table} a ON a.id = d.answer_id WHERE d.id > %s ORDER BY d.id LIMIT %s",
+                    (last_id, batch_size)
+                )
+                rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        prepared, _ = await asyncio.to_thread(
+            prepare_chunk, pd.DataFrame([(r[1], r[2]) for r in rows], columns=['question', 'answer'])
+        )
+        cleaned = {(q, a): (q_clean, a_clean) for q, a, q_clean, a_clean in prepared}
+        ids, embs, questions, clean_questions, answer_ids, answers = [], [], [], [], [], {}
+        missing = []
+        for row_id, q, a, blob, answer_id in rows:
+            if (q.strip(), a.strip()) not in cleaned:
+                continue
+            q_clean, a_clean = cleaned[(q.strip(), a.strip())]
+            ids.append(row_id)
+            questions.append(q)
+            clean_questions.append(q_clean)
+            answer_ids.append(answer_id)
+            answers[answer_id] = (a, a_clean)
+            if blob:
+                embs.append(np.frombuffer(blob, dtype=np.float32))
+            else:
+                embs.append(None)
+                missing.append(len(embs) - 1)
+        if missing:
+            encoded = await asyncio.to_thread(encode_text_batch, [clean_questions[i] for i in missing], state)
+            for i, emb in zip(missing, encoded):
+                embs[i] = emb
+        if ids:
+            embeddings = np.vstack(embs).astype(np.float32)
+            state.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+            append_to_cache(state, ids, embeddings, questions, clean_questions, answer_ids, answers)
+            synced += len(ids)
+    if synced:
+        logger.info(f"Synced {synced} new records from database into cache and index")
+    return synced
+
+# Quản lý trạng thái job nhập dữ liệu trong Redis
+def _import_job_key(job_id: str) -> str:
+    return f"import_job:{job_id}"
+
+def create_import_job(redis_client: redis.Redis, job_id: str, filename: str, path: str,
+                      collection: str = DEFAULT_COLLECTION):
+    key = _import_job_key(job_id)
+    redis_client.hset(key, mapping={
+        "status": "PENDING",
+        "filename": filename,
+        "path": path,
+        "collection": collection,
+        "created_at": time.time(),
+        "parsed": 0, "skipped_empty": 0, "skipped_duplicate": 0, "encoded": 0, "inserted": 0
+    })
+    redis_client.expire(key, IMPORT_JOB_TTL)
+
+def update_import_job(redis_client: redis.Redis, job_id: str, **fields):
+    redis_client.hset(_import_job_key(job_id), mapping={k: str(v) for k, v in fields.items()})
+
+def get_import_job(redis_client: redis.Redis, job_id: str) -> Optional[dict]:
+    raw = redis_client.hgetall(_import_job_key(job_id))
+    if not raw:
+        return None
+    job = {k.decode(): v.decode() for k, v in raw.items()}
+    for key in ('parsed', 'skipped_empty', 'skipped_duplicate', 'encoded', 'inserted'):
+        job[key] = int(job.get(key, 0))
+    started = float(job['started_at']) if job.get('started_at') else None
+    finished = float(job['finished_at']) if job.get('finished_at') else None
+    elapsed = ((finished or time.time()) - started) if started else 0
+    job['elapsed_seconds'] = round(elapsed, 2)
+    job['rows_per_second'] = round(job['parsed'] / elapsed, 2) if elapsed > 0 else 0.0
+    job['inserted_per_second'] = round(job['inserted'] / elapsed, 2) if elapsed > 0 else 0.0
+    job.pop('path', None)
+    return job
+
 # Mã hóa văn bản
 def encode_text_batch(texts: List[str], state: AppState) -> np.ndarray:
     if not texts:
@@ -241,12 +1088,102 @@ def encode_text_batch(texts: List[str], state: AppState) -> np.ndarray:
     embeddings = state.model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
     if embeddings.size > 0:
         embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        if state.projection is not None:
+            embeddings = apply_projection(embeddings, state.projection)
     return embeddings
 
+# Học ma trận PCA (tùy chọn whitening) từ embedding của corpus
+def fit_projection(embeddings: np.ndarray, dim: int, whiten: bool = PROJECTION_WHITEN,
+                   sample_size: int = 100000) -> dict:
+    if len(embeddings) > sample_size:
+        embeddings = embeddings[np.random.default_rng(0).choice(len(embeddings), sample_size, replace=False)]
+    embeddings = embeddings.astype(np.float64)
+    mean = embeddings.mean(axis=0)
+    centered = embeddings - mean
+    eigvals, eigvecs = np.linalg.eigh(centered.T @ centered / max(len(centered) - 1, 1))
+    order = np.argsort(eigvals)[::-1][:dim]
+    components = eigvecs[:, order].T
+    if whiten:
+        components = components / np.sqrt(np.maximum(eigvals[order], 1e-12))[:, None]
+    explained = float(eigvals[order].sum() / max(eigvals.sum(), 1e-12))
+    logger.info(f"Fitted {dim}-dim projection (whiten={whiten}), explained variance {explained:.3f}")
+    return {
+        'mean': mean.astype(np.float32),
+        'components': components.astype(np.float32),
+        'whiten': whiten,
+        'explained_variance': explained
+    }
+
+# Chiếu embedding xuống số chiều thấp hơn rồi chuẩn hóa lại
+def apply_projection(embeddings: np.ndarray, projection: dict) -> np.ndarray:
+    projected = (embeddings.astype(np.float32) - projection['mean']) @ projection['components'].T
+    norms = np.linalg.norm(projected, axis=1, keepdims=True)
+    return projected / np.maximum(norms, 1e-12)
+
+# Lưu / tải ma trận chiếu cùng thư mục mô hình để luôn khớp phiên bản mô hình
+def save_projection(projection: dict, model_path: str):
+    path = os.path.join(model_path, PROJECTION_FILE)
+    np.savez(path + ".tmp.npz", mean=projection['mean'], components=projection['components'],
+             whiten=projection['whiten'], explained_variance=projection['explained_variance'])
+    os.replace(path + ".tmp.npz", path)
+    logger.info(f"Saved projection to {path}")
+
+def load_projection(model_path: str) -> Optional[dict]:
+    path = os.path.join(model_path, PROJECTION_FILE)
+    if not PROJECTION_DIM or not os.path.exists(path):
+        return None
+    data = np.load(path)
+    projection = {
+        'mean': data['mean'],
+        'components': data['components'],
+        'whiten': bool(data['whiten']),
+        'explained_variance': float(data['explained_variance'])
+    }
+    if projection['components'].shape[0] != PROJECTION_DIM:
+        logger.warning(f"Projection at {path} has dim {projection['components'].shape[0]}, expected {PROJECTION_DIM}; ignoring")
+        return None
+    logger.info(f"Loaded {PROJECTION_DIM}-dim projection from {path}")
+    return projection
+
+# Học phép chiếu cho mô hình trong model_path trước khi promote, để projection.npz luôn đi cùng checkpoint
+# (API khởi động lại trước khi re-embed xong vẫn nạp được đúng phép chiếu của mô hình mới)
+def fit_model_projection(model_path: str, embeddings: np.ndarray = None, questions: List[str] = None,
+                         sample_size: int = PROJECTION_FIT_SAMPLE) -> Optional[dict]:
+    if not PROJECTION_DIM:
+        return None
+    if embeddings is None:
+        questions = [q for q in (questions or []) if q]
+        if len(questions) > sample_size:
+            questions = random.Random(0).sample(questions, sample_size)
+        if not questions:
+            return None
+        embeddings = SentenceTransformer(model_path).encode(
+            [clean_text(q) for q in questions], convert_to_numpy=True, show_progress_bar=False
+        )
+    if embeddings.size == 0 or PROJECTION_DIM >= embeddings.shape[1]:
+        return None
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    projection = fit_projection(embeddings, PROJECTION_DIM)
+    save_projection(projection, model_path)
+    return projection
+
+# Số chiều vector trong cache/index: số chiều sau khi chiếu, nếu không thì số chiều của mô hình
+def embedding_dimension(state: AppState) -> int:
+    if state.projection is not None:
+        return state.projection['components'].shape[0]
+    if state.model is not None:
+        return state.model.get_sentence_embedding_dimension() or 768
+    return 768
+
+# Tên khóa Redis theo file: giữ tên cũ cho collection mặc định, thêm tên file cho các collection khác
+def storage_lock_name(base: str, path: str, default_path: str) -> str:
+    return base if path == default_path else f"{base}:{os.path.basename(path)}"
+
 # Lưu FAISS index với Redis Lock
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
 def save_faiss_index(index, path: str, redis_client: redis.Redis):
-    with Lock(redis_client, "faiss_index_lock", timeout=120, blocking_timeout=20):
+    lock_name = storage_lock_name("faiss_index_lock", path, FAISS_INDEX_PATH)
+    with Lock(redis_client, lock_name, timeout=120, blocking_timeout=20):
         try:
             start_time = time.time()
             faiss.write_index(index, path)
@@ -257,7 +1194,7 @@ def save_faiss_index(index, path: str, redis_client: redis.Redis):
 
 # Lưu cache với Redis Lock
 def save_cache(cache_data, path: str, redis_client: redis.Redis):
-    with Lock(redis_client, "cache_lock", timeout=60, blocking_timeout=10):
+    with Lock(redis_client, storage_lock_name("cache_lock", path, CACHE_PATH), timeout=60, blocking_timeout=10):
         try:
             with open(path, "wb") as f:
                 pickle.dump(cache_data, f)
@@ -276,44 +1213,267 @@ def check_resources() -> bool:
         return False
     return True
 
+# Chọn mô hình phục vụ truy vấn; corpus luôn được mã hóa bằng cùng mô hình này.
+# SERVE_MODEL=student dùng mô hình chưng cất nếu đã có và được chưng cất từ checkpoint hiện tại,
+# nếu không dùng mô hình fine-tune rồi mô hình gốc.
+def serving_model_path() -> str:
+    student_path = os.getenv("STUDENT_PATH", STUDENT_PATH)
+    checkpoint_path = os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)
+    if os.getenv("SERVE_MODEL", "teacher") == "student" and os.path.exists(student_path):
+        if not os.path.exists(checkpoint_path) or student_teacher(student_path) == model_fingerprint(checkpoint_path):
+            return student_path
+        logger.warning(f"Student at {student_path} was distilled from an older checkpoint, serving {checkpoint_path}")
+    if os.path.exists(checkpoint_path):
+        return checkpoint_path
+    return os.getenv("MODEL_PATH", MODEL_PATH)
+
+# Dấu vân tay của một mô hình theo tên, kích thước và thời điểm sửa của các file trọng số (không đọc nội dung)
+def model_fingerprint(model_path: str) -> str:
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(model_path, "*.safetensors")) + glob.glob(os.path.join(model_path, "*.bin"))):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+# Dấu vân tay của teacher mà student được chưng cất từ đó (ghi trong distill_report.json)
+def student_teacher(student_path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(student_path, "distill_report.json"), encoding="utf-8") as f:
+            return json.load(f).get("teacher_fingerprint")
+    except (OSError, ValueError):
+        return None
+
+# Tạo cache từ dữ liệu DB; mỗi câu trả lời chỉ được làm sạch và lưu một lần theo answer_id
+def build_cache(raw_data: pd.DataFrame, embeddings: np.ndarray, clean_questions: List[str], last_updated) -> dict:
+    answers = {}
+    for answer_id, answer in zip(raw_data['answer_id'], raw_data['answer']):
+        if answer_id not in answers:
+            answers[int(answer_id)] = (answer, clean_text(answer))
+    return {
+        'ids': raw_data['id'].tolist(),
+        'embeddings': embeddings,
+        'questions': raw_data['question'].tolist(),
+        'clean_questions': clean_questions,
+        'answer_ids': [int(a) for a in raw_data['answer_id']],
+        'answers': answers,
+        'tombstones': set(),
+        'last_updated': last_updated
+    }
+
+# Vai trò của mô hình phục vụ, để bundle snapshot được cài lại đúng thư mục trên replica mới
+def model_role(model_path: str) -> str:
+    model_path = os.path.abspath(model_path)
+    if model_path == os.path.abspath(os.getenv("STUDENT_PATH", STUDENT_PATH)):
+        return "student"
+    if model_path == os.path.abspath(os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)):
+        return "finetuned"
+    return "base"
+
+def model_path_for_role(role: str) -> str:
+    if role == "student":
+        return os.getenv("STUDENT_PATH", STUDENT_PATH)
+    if role == "finetuned":
+        return os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)
+    return os.getenv("MODEL_PATH", MODEL_PATH)
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Chụp cache và index tại một thời điểm (chạy trên event loop để không lẫn với thay đổi đang áp dụng)
+def capture_snapshot_state(state: AppState) -> Tuple[dict, np.ndarray]:
+    cache = {k: v.copy() if isinstance(v, (list, dict, set, np.ndarray)) else v for k, v in state.cache_data.items()}
+    return cache, faiss.serialize_index(state.index)
+
+# Ghi bundle .tar gồm manifest.json (phiên bản, mốc DB, checksum), cache, index và thư mục mô hình
+def write_snapshot_bundle(cache: dict, index_bytes: np.ndarray, model_path: str, directory: str = SNAPSHOT_DIR) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    created_at = datetime.now()
+    with tempfile.TemporaryDirectory(dir=directory) as staging:
+        with open(os.path.join(staging, "cache.pkl"), "wb") as f:
+            pickle.dump(cache, f)
+        index_bytes.tofile(os.path.join(staging, "index.faiss"))
+        shutil.copytree(model_path, os.path.join(staging, "model"))
+        files = {}
+        for root, _, names in os.walk(staging):
+            for name in names:
+                full = os.path.join(root, name)
+                files[os.path.relpath(full, staging).replace(os.sep, "/")] = file_sha256(full)
+        live_ids = [id_ for id_ in cache['ids'] if id_ not in cache.get('tombstones', ())]
+        manifest = {
+            "version": SNAPSHOT_FORMAT_VERSION,
+            "created_at": created_at.isoformat(),
+            "origin": REPLICA_ID,
+            "model_role": model_role(model_path),
+            "record_count": len(live_ids),
+            "dimension": int(cache['embeddings'].shape[1]) if cache['embeddings'].size else None,
+            # Mốc DB: replica mới chỉ cần nạp các dòng có id > max_id và phát lại stream từ stream_offset
+            "max_id": max(cache['ids']) if cache['ids'] else 0,
+            "last_updated": cache['last_updated'].isoformat() if cache.get('last_updated') else None,
+            "stream_offset": cache.get('stream_offset'),
+            "files": files
+        }
+        with open(os.path.join(staging, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        bundle_path = os.path.join(directory, f"snapshot-{created_at.strftime('%Y%m%d-%H%M%S')}.tar")
+        with tarfile.open(bundle_path + ".tmp", "w") as tar:
+            tar.add(os.path.join(staging, "manifest.json"), arcname="manifest.json")
+            for rel in files:
+                tar.add(os.path.join(staging, rel), arcname=rel)
+        os.replace(bundle_path + ".tmp", bundle_path)
+    manifest["path"] = bundle_path
+    logger.info(f"Exported snapshot {bundle_path} with {manifest['record_count']} records (max_id {manifest['max_id']})")
+    return manifest
+
+async def export_snapshot(state: AppState, directory: str = SNAPSHOT_DIR) -> dict:
+    cache, index_bytes = capture_snapshot_state(state)
+    return await asyncio.to_thread(write_snapshot_bundle, cache, index_bytes, serving_model_path(), directory)
+
+# Giải nén bundle vào thư mục staging, kiểm tra phiên bản và checksum rồi cài mô hình. Cache và index ở lại
+# staging (manifest["staging"]) cho tới khi warm_start_from_snapshot chấp nhận snapshot.
+def restore_snapshot(bundle_path: str) -> dict:
+    target_dir = os.path.dirname(os.path.abspath(CACHE_PATH))
+    staging = tempfile.mkdtemp(prefix="snapshot_", dir=target_dir)
+    try:
+        with tarfile.open(bundle_path, "r") as tar:
+            for member in tar.getmembers():
+                if not (member.isfile() or member.isdir()) or os.path.isabs(member.name) or ".." in member.name.split("/"):
+                    raise ValueError(f"Unsafe entry in snapshot bundle: {member.name}")
+            tar.extractall(staging)
+        with open(os.path.join(staging, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {manifest.get('version')}")
+        for rel, digest in manifest["files"].items():
+            if file_sha256(os.path.join(staging, rel)) != digest:
+                raise ValueError(f"Checksum mismatch for {rel} in snapshot bundle")
+        # Thư mục mô hình dùng chung với worker: không bao giờ xóa/ghi đè mô hình đang có. Chỉ cài mô hình của
+        # bundle khi chưa có; nếu đã có mà khác mô hình trong bundle thì giữ nguyên và bỏ qua warm start.
+        model_dest = model_path_for_role(manifest["model_role"])
+        if not os.path.exists(model_dest):
+            shutil.move(os.path.join(staging, "model"), model_dest)
+            manifest["model_path"] = model_dest
+        elif same_model_files(model_dest, manifest["files"]):
+            manifest["model_path"] = model_dest
+        else:
+            logger.warning(f"Model at {model_dest} differs from the snapshot model, keeping it and skipping warm start")
+            manifest["model_path"] = None
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    manifest["staging"] = staging
+    logger.info(f"Restored snapshot {bundle_path} created at {manifest['created_at']} ({manifest['record_count']} records)")
+    return manifest
+
+# Mô hình tại model_path có đúng các file (theo sha256) của mô hình trong bundle không
+def same_model_files(model_path: str, files: dict) -> bool:
+    model_files = {rel[len("model/"):]: digest for rel, digest in files.items() if rel.startswith("model/")}
+    for rel, digest in model_files.items():
+        path = os.path.join(model_path, rel)
+        if not os.path.exists(path) or file_sha256(path) != digest:
+            return False
+    return bool(model_files)
+
+# Stream còn giữ đủ các thay đổi sau offset hay đã bị cắt bớt (MAXLEN)
+def stream_covers(redis_client: redis.Redis, offset: Optional[str], stream: str = MUTATION_STREAM) -> bool:
+    if not offset:
+        return False
+    parse = lambda entry_id: tuple(int(p) for p in (entry_id.decode() if isinstance(entry_id, bytes) else entry_id).split("-"))
+    try:
+        info = redis_client.xinfo_stream(stream)
+    except redis.ResponseError:
+        return True  # stream chưa tồn tại: chưa có thay đổi nào
+    max_deleted = info.get("max-deleted-entry-id")
+    if max_deleted is not None:
+        return parse(max_deleted) <= parse(offset)
+    first = info.get("first-entry")
+    return first is None or parse(first[0]) <= parse(offset) or info.get("length", 0) < MUTATION_STREAM_MAXLEN
+
+# Khởi động từ snapshot đã cài: nạp cache/index có sẵn rồi chỉ bắt kịp các dòng mới hơn mốc DB;
+# sửa/xóa sau snapshot được phát lại từ stream_offset bởi consume_mutations. Trả về False để dựng lại toàn bộ.
+async def warm_start_from_snapshot(state: AppState, manifest: dict) -> bool:
+    try:
+        return await _warm_start_from_snapshot(state, manifest)
+    finally:
+        shutil.rmtree(manifest["staging"], ignore_errors=True)
+
+async def _warm_start_from_snapshot(state: AppState, manifest: dict) -> bool:
+    if not manifest.get("model_path") or os.path.abspath(serving_model_path()) != os.path.abspath(manifest["model_path"]):
+        logger.warning("Snapshot model is not the serving model on this replica, falling back to full rebuild")
+        return False
+    if not stream_covers(state.redis_client, manifest.get("stream_offset"), state.mutation_stream):
+        logger.warning("Mutation stream no longer covers the snapshot offset, falling back to full rebuild")
+        return False
+    cache_file = os.path.join(manifest["staging"], "cache.pkl")
+    index_file = os.path.join(manifest["staging"], "index.faiss")
+    with open(cache_file, "rb") as f:
+        cache = pickle.load(f)
+    if cache.get('tombstones'):
+        cache = build_compacted_cache(cache)
+    if cache['embeddings'].size and cache['embeddings'].shape[1] != embedding_dimension(state):
+        logger.warning("Snapshot embedding dimension does not match the serving model, falling back to full rebuild")
+        return False
+    # Snapshot được chấp nhận: lúc này mới cài cache/index của bundle vào vị trí của replica
+    shutil.move(cache_file, state.cache_path)
+    shutil.move(index_file, state.index_path)
+    state.cache_data = cache
+    state.id_to_idx = None
+    state.lexical_index = None
+    state.index = faiss.read_index(state.index_path)
+    if state.index.ntotal != len(cache['ids']):
+        state.index = faiss.IndexIDMap(faiss.IndexFlatL2(embedding_dimension(state)))
+        if cache['ids']:
+            state.index.add_with_ids(cache['embeddings'].astype(np.float32), np.array(cache['ids'], dtype=np.int64))
+    synced = await sync_new_records(state)
+    if synced:
+        await asyncio.to_thread(save_cache, state.cache_data, state.cache_path, state.redis_client)
+        await asyncio.to_thread(save_faiss_index, state.index, state.index_path, state.redis_client)
+    logger.info(f"Warm-started from snapshot with {len(state.cache_data['ids'])} embeddings ({synced} caught up)")
+    return True
+
 # Tải hoặc tạo embedding
-async def initialize_cache_and_index(state: AppState):
+async def initialize_cache_and_index(state: AppState, rebuild: bool = False):
     try:
-        if os.path.exists(CACHE_PATH):
-            with open(CACHE_PATH, "rb") as f:
+        if rebuild:
+            # Bỏ qua file cache cục bộ, dựng lại toàn bộ từ DB
+            state.cache_data = empty_cache()
+        elif os.path.exists(state.cache_path):
+            with open(state.cache_path, "rb") as f:
                 state.cache_data = pickle.load(f)
+            if state.cache_data.get('tombstones'):
+                state.cache_data = build_compacted_cache(state.cache_data)
+            state.id_to_idx = None
+            state.lexical_index = None
             logger.info(f"Loaded {len(state.cache_data['ids'])} embeddings from cache")
         db_count = await count_records(state)
         db_latest = await get_latest_timestamp(state)
-        if len(state.cache_data['ids']) != db_count or (state.cache_data['last_updated'] and state.cache_data['last_updated'] < db_latest):
+        cache_dim = state.cache_data['embeddings'].shape[1] if state.cache_data['embeddings'].size else None
+        live_count = len(state.cache_data['ids']) - len(state.cache_data.get('tombstones', ()))
+        if live_count != db_count or (state.cache_data['last_updated'] and state.cache_data['last_updated'] < db_latest) \
+                or (cache_dim is not None and cache_dim != embedding_dimension(state)) \
+                or 'answer_ids' not in state.cache_data:
             logger.warning("Cache outdated or mismatched, regenerating")
+            stream_offset = latest_stream_id(state.redis_client, state.mutation_stream)
             state.raw_data = await load_data_db(state)
-            clean_questions = [clean_text(q) for q in state.raw_data['question'] if q]
-            clean_answers = [clean_text(a) for a in state.raw_data['answer'] if a]
-            state.cache_data = {
-                'ids': state.raw_data['id'].tolist(),
-                'embeddings': encode_text_batch(clean_questions, state),
-                'questions': state.raw_data['question'].tolist(),
-                'answers': state.raw_data['answer'].tolist(),
-                'clean_questions': clean_questions,
-                'clean_answers': clean_answers,
-                'last_updated': db_latest
-            }
-            save_cache(state.cache_data, CACHE_PATH, state.redis_client)
+            clean_questions = [clean_text(q) for q in state.raw_data['question']]
+            state.cache_data = build_cache(
+                state.raw_data, encode_text_batch(clean_questions, state), clean_questions, db_latest
+            )
+            state.cache_data['stream_offset'] = stream_offset
+            state.id_to_idx = None
+            state.lexical_index = None
+            save_cache(state.cache_data, state.cache_path, state.redis_client)
         logger.info(f"Cache contains {len(state.cache_data['ids'])} embeddings")
     except Exception as e:
         logger.error(f"Error initializing cache: {e}")
-        state.cache_data = {
-            'ids': [],
-            'embeddings': np.array([]),
-            'questions': [],
-            'answers': [],
-            'clean_questions': [],
-            'clean_answers': [],
-            'last_updated': None
-        }
+        state.cache_data = empty_cache()
+        state.id_to_idx = None
+        state.lexical_index = None
 
-    dimension = state.cache_data['embeddings'].shape[1] if state.cache_data['embeddings'].size else 768
+    dimension = state.cache_data['embeddings'].shape[1] if state.cache_data['embeddings'].size else embedding_dimension(state)
     state.index = faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
     if state.cache_data['embeddings'].size and state.cache_data['ids']:
         state.index.add_with_ids(
@@ -321,59 +1481,522 @@ async def initialize_cache_and_index(state: AppState):
             np.array(state.cache_data['ids'], dtype=np.int64)
         )
     try:
-        save_faiss_index(state.index, FAISS_INDEX_PATH, state.redis_client)
+        save_faiss_index(state.index, state.index_path, state.redis_client)
         logger.info("FAISS index saved")
     except Exception as e:
         logger.error(f"Error saving FAISS index: {e}")
     try:
-        state.index = faiss.read_index(FAISS_INDEX_PATH)
+        state.index = faiss.read_index(state.index_path)
         logger.info("FAISS index loaded")
     except Exception as e:
         logger.warning(f"No FAISS index found, using fresh one: {e}")
         state.index = faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
 
 # Hàm cập nhật embedding sau fine-tune
-async def update_embeddings_after_finetune(state: AppState):
+# refit_projection=False: dùng lại ma trận chiếu đã học (các collection dùng chung encoder và phép chiếu).
+# precomputed: {id: vector đã chuẩn hóa} do các shard re-embed tính sẵn; dòng còn thiếu được mã hóa tại chỗ.
+# reembed_id: mã lần re-embed, dùng chung cho mọi collection để replica chỉ đổi mô hình khi tất cả đã áp dụng.
+async def update_embeddings_after_finetune(state: AppState, model_path: str = None, refit_projection: bool = True,
+                                           precomputed: dict = None, reembed_id: str = None):
     state.raw_data = await load_data_db(state)
     batch_size = 1000
-    clean_questions = [clean_text(q) for q in state.raw_data['question'] if q]
-    clean_answers = [clean_text(a) for a in state.raw_data['answer'] if a]
-    new_embeddings = state.model.encode(clean_questions, convert_to_numpy=True, show_progress_bar=True)
-    if new_embeddings.size > 0:
-        new_embeddings = new_embeddings / np.linalg.norm(new_embeddings, axis=1, keepdims=True)
-    state.cache_data = {
-        'ids': state.raw_data['id'].tolist(),
-        'embeddings': new_embeddings,
-        'questions': state.raw_data['question'].tolist(),
-        'answers': state.raw_data['answer'].tolist(),
-        'clean_questions': clean_questions,
-        'clean_answers': clean_answers,
-        'last_updated': datetime.now()
-    }
+    clean_questions = [clean_text(q) for q in state.raw_data['question']]
+    if precomputed is not None:
+        new_embeddings = assemble_embeddings(state.raw_data['id'].tolist(), clean_questions, precomputed, state.model)
+    else:
+        new_embeddings = encode_with_profile(state.model, clean_questions, f"update_embeddings_{state.collection}")
+        if new_embeddings.size > 0:
+            new_embeddings = new_embeddings / np.linalg.norm(new_embeddings, axis=1, keepdims=True)
+    # Dùng phép chiếu đã học khi promote mô hình; chỉ học lại (trên toàn corpus) nếu mô hình chưa có
+    if refit_projection:
+        state.projection = load_projection(model_path or serving_model_path())
+        if state.projection is None and PROJECTION_DIM and new_embeddings.size > 0 \
+                and PROJECTION_DIM < new_embeddings.shape[1]:
+            state.projection = fit_projection(new_embeddings, PROJECTION_DIM)
+            save_projection(state.projection, model_path or serving_model_path())
+    if state.projection is not None and new_embeddings.size > 0:
+        new_embeddings = apply_projection(new_embeddings, state.projection)
+    state.cache_data = build_cache(state.raw_data, new_embeddings, clean_questions, datetime.now())
+    # Ghi nhận mô hình đã mã hóa cache: replica nạp collection giữa chừng re-embed biết vector thuộc mô hình nào
+    state.cache_data['model_fingerprint'] = model_fingerprint(model_path or serving_model_path())
+    state.id_to_idx = None
+    state.lexical_index = None
     async with state.db_pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
                 for i in range(0, len(state.cache_data['ids']), batch_size):
                     batch_ids = state.cache_data['ids'][i:i + batch_size]
                     batch_embs = state.cache_data['embeddings'][i:i + batch_size]
-                    query = "UPDATE qa_data SET embedding = %s WHERE id = %s"
+                    query = f"UPDATE {state.data_table} SET embedding = %s WHERE id = %s"
                     await cursor.executemany(query, [(emb.tobytes(), id_) for emb, id_ in zip(batch_embs, batch_ids)])
                     await conn.commit()
                 logger.info("Updated embeddings in database")
+                # Phát embedding mới theo lô để các replica đổi mô hình và index mà không đọc lại file
+                reembed_id = reembed_id or uuid.uuid4().hex
+                total = len(state.cache_data['ids'])
+                for i in range(0, max(total, 1), batch_size):
+                    publish_mutation(
+                        state.redis_client, "reembed", state.cache_data['ids'][i:i + batch_size],
+                        state.cache_data['embeddings'][i:i + batch_size] if total else None,
+                        batch_id=reembed_id, last=i + batch_size >= total, stream=state.mutation_stream,
+                        model_path=model_path or serving_model_path()
+                    )
             except Exception as e:
                 logger.error(f"Error updating embeddings: {e}")
                 raise
-    dimension = state.cache_data['embeddings'].shape[1] if state.cache_data['embeddings'].size else 768
+    dimension = state.cache_data['embeddings'].shape[1] if state.cache_data['embeddings'].size else embedding_dimension(state)
     state.index = faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
     if state.cache_data['embeddings'].size:
         state.index.add_with_ids(
             state.cache_data['embeddings'].astype(np.float32),
             np.array(state.cache_data['ids'], dtype=np.int64)
         )
-    save_cache(state.cache_data, CACHE_PATH, state.redis_client)
-    save_faiss_index(state.index, FAISS_INDEX_PATH, state.redis_client)
+    save_cache(state.cache_data, state.cache_path, state.redis_client)
+    save_faiss_index(state.index, state.index_path, state.redis_client)
     logger.info("Updated embeddings and FAISS index after fine-tuning")
 
+# Chia bảng dữ liệu của collection thành các dải id liên tiếp, mỗi dải khoảng shard_size dòng
+# (MySQL tính biên từng dải trên chỉ mục khóa chính, không kéo toàn bộ id về Python)
+async def plan_reembed_shards(state: AppState, shard_size: int = REEMBED_SHARD_SIZE) -> List[Tuple[int, int]]:
+    shards = []
+    last_id = 0  # id là khóa tự tăng, bắt đầu từ 1
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            while True:
+                await cursor.execute(
+                    f"""
+                    SELECT MIN(id), MAX(id) FROM (
+                        SELECT id FROM {state.data_table} WHERE id > %s ORDER BY id LIMIT %s
+                    ) AS shard
+                    """,
+                    (last_id, shard_size)
+                )
+                lo, hi = await cursor.fetchone()
+                if lo is None:
+                    break
+                shards.append((lo, hi))
+                last_id = hi
+    return shards
+
+async def load_question_range(state: AppState, lo: int, hi: int) -> Tuple[List[int], List[str]]:
+    async with state.db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"SELECT id, question FROM {state.data_table} WHERE id BETWEEN %s AND %s ORDER BY id", (lo, hi)
+            )
+            rows = await cursor.fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+# Mã hóa và chuẩn hóa (chưa chiếu) các câu hỏi đã làm sạch
+def encode_normalized(model, clean_questions: List[str], show_progress_bar: bool = False) -> np.ndarray:
+    embeddings = model.encode(clean_questions, convert_to_numpy=True, show_progress_bar=show_progress_bar)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def reembed_shard_path(run_id: str, collection: str, lo: int, hi: int) -> str:
+    return os.path.join(REEMBED_STAGING_DIR, run_id, collection, f"shard-{lo}-{hi}.npz")
+
+# Ghi vector của một shard vào staging (ghi file tạm rồi đổi tên để merge không đọc phải file dở dang)
+def write_reembed_shard(run_id: str, collection: str, lo: int, hi: int, ids: List[int], embeddings: np.ndarray) -> str:
+    path = reembed_shard_path(run_id, collection, lo, hi)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path + ".tmp.npz", ids=np.array(ids, dtype=np.int64), embeddings=embeddings.astype(np.float32))
+    os.replace(path + ".tmp.npz", path)
+    return path
+
+# Dọn thư mục staging của các lần re-embed bị bỏ dở (merge không chạy hoặc worker chết giữa chừng)
+def sweep_reembed_staging(ttl: int = REEMBED_STAGING_TTL):
+    if not os.path.isdir(REEMBED_STAGING_DIR):
+        return
+    cutoff = time.time() - ttl
+    for entry in os.scandir(REEMBED_STAGING_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            logger.info(f"Removed stale re-embed staging {entry.path}")
+
+# Đọc các shard của một collection thành {id: vector}
+def load_reembed_shards(run_id: str, collection: str) -> dict:
+    vectors = {}
+    for path in sorted(glob.glob(os.path.join(REEMBED_STAGING_DIR, run_id, collection, "shard-*.npz"))):
+        data = np.load(path)
+        vectors.update(zip(data['ids'].tolist(), data['embeddings']))
+    return vectors
+
+# Ghép vector theo thứ tự dòng; dòng thêm sau khi chia shard hoặc shard lỗi thì mã hóa lại ở đây
+def assemble_embeddings(ids: List[int], clean_questions: List[str], precomputed: dict, model) -> np.ndarray:
+    missing = [i for i, id_ in enumerate(ids) if id_ not in precomputed]
+    extra = {}
+    if missing:
+        logger.info(f"Encoding {len(missing)} rows not covered by re-embed shards")
+        encoded = encode_normalized(model, [clean_questions[i] for i in missing])
+        extra = {ids[i]: emb for i, emb in zip(missing, encoded)}
+    if not ids:
+        return np.array([])
+    return np.vstack([precomputed[id_] if id_ in precomputed else extra[id_] for id_ in ids]).astype(np.float32)
+
+# Tạo các cặp huấn luyện (question, answer) và (question, question) cùng nhóm câu trả lời
+def build_training_pairs(raw_data: pd.DataFrame) -> List[List[str]]:
+    pairs = []
+    clean_answers = {}  # mỗi câu trả lời chỉ làm sạch một lần
+    questions_by_answer = {}
+    for question, answer_id, answer in zip(raw_data['question'], raw_data['answer_id'], raw_data['answer']):
+        if answer_id not in clean_answers:
+            clean_answers[answer_id] = clean_text(str(answer))
+        q_clean = clean_text(str(question))
+        a_clean = clean_answers[answer_id]
+        if q_clean and a_clean:
+            pairs.append([q_clean, a_clean])
+        if q_clean:
+            questions_by_answer.setdefault(answer_id, []).append(q_clean)
+    # lấy các câu hỏi trong cùng 1 nhóm, tạo cặp câu hỏi tương tự nếu nhóm có nhiều hơn 1 câu.
+    for clean_questions in questions_by_answer.values():
+        if len(clean_questions) > 1:
+            for i in range(len(clean_questions)):
+                for j in range(i + 1, len(clean_questions)):
+                    pairs.append([clean_questions[i], clean_questions[j]])
+    return pairs
+
+# Khai thác hard negative: tìm láng giềng của các câu hỏi (tối đa max_anchors câu, lấy mẫu) trong một lần gọi
+# index.search, chọn láng giềng gần nhất thuộc nhóm câu trả lời khác. Trả về {câu hỏi đã làm sạch: câu hỏi negative}.
+def mine_hard_negatives(index, cache_data: dict, candidates: int = HARD_NEGATIVE_CANDIDATES,
+                        max_anchors: int = HARD_NEGATIVE_MAX_ANCHORS, seed: int = 42) -> dict:
+    tombstones = cache_data.get('tombstones', set())
+    live = [i for i, id_ in enumerate(cache_data['ids']) if id_ not in tombstones]
+    if index is None or index.ntotal < 2 or not live:
+        return {}
+    if max_anchors and len(live) > max_anchors:
+        live = sorted(random.Random(seed).sample(live, max_anchors))
+    id_to_idx = {id_: idx for idx, id_ in enumerate(cache_data['ids'])}
+    start_time = time.time()
+    _, neighbours = index.search(cache_data['embeddings'][live].astype(np.float32), min(candidates + 1, index.ntotal))
+    negatives = {}
+    for row, found in zip(live, neighbours):
+        anchor = cache_data['clean_questions'][row]
+        if not anchor or anchor in negatives:
+            continue
+        answer_id = cache_data['answer_ids'][row]
+        for id_ in found:
+            idx = id_to_idx.get(int(id_))
+            if idx is None or id_ in tombstones:
+                continue
+            candidate = cache_data['clean_questions'][idx]
+            if cache_data['answer_ids'][idx] != answer_id and candidate and candidate != anchor:
+                negatives[anchor] = candidate
+                break
+    logger.info(f"Mined hard negatives for {len(negatives)}/{len(live)} questions in {time.time() - start_time:.2f}s")
+    return negatives
+
+# Gắn negative vào từng cặp (anchor, positive) thành bộ ba; anchor chưa có hard negative
+# nhận một câu hỏi ngẫu nhiên thuộc nhóm khác để mọi mẫu có cùng số cột
+def attach_hard_negatives(pairs: List[List[str]], negatives: dict, cache_data: dict, seed: int = 42) -> List[List[str]]:
+    if not negatives:
+        return pairs
+    rng = random.Random(seed)
+    group_of = dict(zip(cache_data['clean_questions'], cache_data['answer_ids']))
+    pool = [q for q in cache_data['clean_questions'] if q]
+    triplets = []
+    for anchor, positive in pairs:
+        negative = negatives.get(anchor)
+        for _ in range(100):
+            if negative is not None:
+                break
+            candidate = rng.choice(pool)
+            if candidate not in (anchor, positive) and (anchor not in group_of or group_of[candidate] != group_of[anchor]):
+                negative = candidate
+        if negative is None:
+            negative = rng.choice(list(negatives.values()))
+        triplets.append([anchor, positive, negative])
+    return triplets
+
+# Khai thác hard negative trên index của từng collection có trong dữ liệu huấn luyện rồi gắn vào các cặp.
+# answer_id được gắn tên collection (như load_training_data) để nhóm của các collection không trùng nhau.
+def mine_training_negatives(state: AppState, pairs: List[List[str]], raw_data: pd.DataFrame) -> List[List[str]]:
+    collections = raw_data['collection'].unique() if 'collection' in raw_data else [DEFAULT_COLLECTION]
+    negatives, questions, answer_ids = {}, [], []
+    for collection in collections:
+        index, cache_data = load_mining_source(collection_state(state, collection))
+        for anchor, negative in mine_hard_negatives(index, cache_data).items():
+            negatives.setdefault(anchor, negative)
+        questions.extend(cache_data['clean_questions'])
+        answer_ids.extend(f"{collection}:{answer_id}" for answer_id in cache_data['answer_ids'])
+    return attach_hard_negatives(pairs, negatives, {'clean_questions': questions, 'answer_ids': answer_ids})
+
+# Nguồn khai thác trong worker: index và cache hiện tại của API (đọc từ đĩa nếu state chưa nạp)
+def load_mining_source(state: AppState) -> Tuple[Optional[object], dict]:
+    cache_data, index = state.cache_data, state.index
+    if not cache_data['ids'] and os.path.exists(state.cache_path):
+        with open(state.cache_path, "rb") as f:
+            cache_data = pickle.load(f)
+    if index is None and os.path.exists(state.index_path):
+        index = faiss.read_index(state.index_path)
+    if index is not None and cache_data['embeddings'].size and index.d != cache_data['embeddings'].shape[1]:
+        logger.warning("FAISS index and cache dimensions differ, skipping hard-negative mining")
+        return None, cache_data
+    return index, cache_data
+
+# Chuẩn bị thư mục staging: tiếp tục lần chạy dở dang hoặc bắt đầu lần chạy mới.
+# Dữ liệu huấn luyện được cố định trên đĩa để thứ tự dữ liệu giống hệt khi resume.
+def prepare_fine_tune_run(staging_path: str, raw_data: pd.DataFrame,
+                          state: AppState = None) -> Tuple[List[List[str]], bool]:
+    run_file = os.path.join(staging_path, "run.json")
+    pairs_file = os.path.join(staging_path, "train_pairs.jsonl")
+    if os.path.exists(run_file) and os.path.exists(pairs_file):
+        with open(run_file, encoding="utf-8") as f:
+            run = json.load(f)
+        fingerprint = training_data_fingerprint(raw_data)
+        started_at = datetime.fromisoformat(run["started_at"]) if run.get("started_at") else datetime.min
+        if run.get("status") == "training" and run.get("data_fingerprint") != fingerprint:
+            logger.warning("Staged fine-tune run was built from different data, starting a new fine-tune run")
+        elif run.get("status") == "training" and (datetime.now() - started_at).total_seconds() > FINE_TUNE_RESUME_MAX_AGE:
+            logger.warning(f"Staged fine-tune run from {run.get('started_at')} is too old to resume, starting a new one")
+        elif run.get("status") == "training":
+            with open(pairs_file, encoding="utf-8") as f:
+                pairs = [json.loads(line) for line in f if line.strip()]
+            if len(pairs) == run.get("num_examples"):
+                logger.info(f"Resuming fine-tune run started at {run.get('started_at')} with {len(pairs)} examples")
+                return pairs, True
+            logger.warning("Staged training data is incomplete, starting a new fine-tune run")
+
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path, exist_ok=True)
+    pairs = build_training_pairs(raw_data)
+    if state is not None and HARD_NEGATIVE_MINING and pairs:
+        try:
+            pairs = mine_training_negatives(state, pairs, raw_data)
+        except Exception as e:
+            logger.warning(f"Hard-negative mining failed, training with in-batch negatives only: {e}")
+    with open(pairs_file + ".tmp", "w", encoding="utf-8") as f:
+        for pair in pairs:
+            f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+    os.replace(pairs_file + ".tmp", pairs_file)
+    write_fine_tune_run(staging_path, {
+        "status": "training",
+        "started_at": datetime.now().isoformat(),
+        # Mốc fine-tune ghi vào bảng thống kê của collection mặc định
+        "record_count": int((raw_data['collection'] == DEFAULT_COLLECTION).sum()) if 'collection' in raw_data else len(raw_data),
+        "num_examples": len(pairs),
+        "data_fingerprint": training_data_fingerprint(raw_data)
+    })
+    return pairs, False
+
+# Dấu vân tay dữ liệu huấn luyện: số bản ghi và id lớn nhất theo từng collection
+def training_data_fingerprint(raw_data: pd.DataFrame) -> dict:
+    if raw_data is None or raw_data.empty:
+        return {}
+    collections = raw_data['collection'] if 'collection' in raw_data else pd.Series(DEFAULT_COLLECTION, index=raw_data.index)
+    return {str(name): [int(len(group)), int(group['id'].max())] for name, group in raw_data.groupby(collections)}
+
+def write_fine_tune_run(staging_path: str, run: dict):
+    run_file = os.path.join(staging_path, "run.json")
+    with open(run_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(run, f)
+    os.replace(run_file + ".tmp", run_file)
+
+def read_fine_tune_run(staging_path: str) -> dict:
+    with open(os.path.join(staging_path, "run.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+# Tìm checkpoint trung gian mới nhất (có trạng thái optimizer/scheduler) trong thư mục staging
+def latest_intermediate_checkpoint(checkpoints_dir: str) -> Optional[str]:
+    candidates = [
+        path for path in glob.glob(os.path.join(checkpoints_dir, "checkpoint-*"))
+        if os.path.exists(os.path.join(path, "trainer_state.json"))
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda path: int(path.rsplit("-", 1)[-1]))
+
+# Thay checkpoint đang dùng bằng mô hình mới. checkpoint_path là symlink trỏ tới thư mục phiên bản
+# (<checkpoint_path>.v<thời điểm>); đổi phiên bản bằng os.replace một link mới nên tiến trình khác luôn thấy
+# checkpoint_path tồn tại (bản cũ hoặc bản mới). Giữ lại phiên bản liền trước cho tiến trình đang nạp dở.
+def promote_checkpoint(source: str, checkpoint_path: str):
+    version_dir = f"{checkpoint_path}.v{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    shutil.move(source, version_dir)
+    previous = os.path.realpath(checkpoint_path) if os.path.islink(checkpoint_path) else None
+    if os.path.isdir(checkpoint_path) and not os.path.islink(checkpoint_path):
+        # Checkpoint dạng thư mục thường (trước khi dùng symlink): chuyển thành một phiên bản, chỉ xảy ra một lần
+        previous = os.path.realpath(f"{checkpoint_path}.v0-legacy")
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(checkpoint_path, previous)
+    link = checkpoint_path + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, checkpoint_path)
+    for stale in glob.glob(glob.escape(checkpoint_path) + ".v*"):
+        if os.path.realpath(stale) not in (os.path.realpath(version_dir), previous):
+            shutil.rmtree(stale, ignore_errors=True)
+    shutil.rmtree(checkpoint_path + ".previous", ignore_errors=True)
+    logger.info(f"Promoted fine-tuned model to {checkpoint_path} -> {version_dir}")
+
+# Khôi phục checkpoint nếu lần promote trước (kiểu rename, trước khi dùng symlink) bị gián đoạn giữa hai lần rename
+def recover_checkpoint(checkpoint_path: str):
+    if os.path.exists(checkpoint_path):
+        return
+    previous = checkpoint_path + ".previous"
+    incoming = checkpoint_path + ".incoming"
+    if os.path.exists(previous):
+        os.rename(previous, checkpoint_path)
+        logger.warning(f"Restored previous checkpoint at {checkpoint_path}")
+    elif os.path.exists(incoming):
+        os.rename(incoming, checkpoint_path)
+        logger.warning(f"Completed interrupted promotion at {checkpoint_path}")
+
+# Kiểm tra CPU có lệnh bf16 (AVX512-BF16 / AMX) để bật autocast bf16
+def cpu_supports_bf16() -> bool:
+    setting = os.getenv("FINE_TUNE_BF16", "auto").lower()
+    if setting in ("0", "false", "off"):
+        return False
+    if setting in ("1", "true", "on"):
+        return True
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+# Gán CPU affinity (FINE_TUNE_CPU_AFFINITY, ví dụ "0-7" hoặc "0,2,4") và số luồng torch
+def configure_torch_threads() -> int:
+    affinity = os.getenv("FINE_TUNE_CPU_AFFINITY")
+    if affinity and hasattr(os, "sched_setaffinity"):
+        cores = set()
+        for part in affinity.split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                cores.update(range(int(first), int(last) + 1))
+            elif part.strip():
+                cores.add(int(part))
+        os.sched_setaffinity(0, cores)
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    num_threads = int(os.getenv("FINE_TUNE_NUM_THREADS", 0)) or min(psutil.cpu_count(logical=False) or available, available)
+    torch.set_num_threads(num_threads)
+    logger.info(f"Torch using {num_threads} threads")
+    return num_threads
+
+# Tính max_seq_length theo phân vị độ dài token của corpus, làm tròn lên bội số của 8
+def capped_max_seq_length(tokenizer, texts: List[str], current_max: int,
+                          percentile: float = FINE_TUNE_SEQ_PERCENTILE) -> int:
+    if not texts:
+        return current_max
+    sample = texts if len(texts) <= 20000 else random.Random(0).sample(texts, 20000)
+    lengths = [len(tokenizer.encode(text, add_special_tokens=True)) for text in sample]
+    cap = int(np.ceil(np.percentile(lengths, percentile) / 8) * 8)
+    return max(16, min(current_max, cap))
+
+# Batch sampler gom các cặp có độ dài gần nhau để giảm padding; thứ tự xác định theo seed + epoch
+class LengthGroupedBatchSampler:
+    def __init__(self, lengths: List[int], batch_size: int, drop_last: bool = False, seed: int = 0,
+                 mega_batch_mult: int = 50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.mega_batch_size = batch_size * mega_batch_mult
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.mega_batch_size):
+            mega_batch = sorted(order[start:start + self.mega_batch_size], key=lambda i: -self.lengths[i])
+            for i in range(0, len(mega_batch), self.batch_size):
+                batch = mega_batch[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append([int(idx) for idx in batch])
+        for i in rng.permutation(len(batches)):
+            yield batches[i]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+class LengthGroupedTrainer(SentenceTransformerTrainer):
+    def __init__(self, *args, example_lengths: List[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.example_lengths = example_lengths
+
+    def get_batch_sampler(self, dataset, batch_size, drop_last, *args, **kwargs):
+        if self.example_lengths is None or len(self.example_lengths) != len(dataset):
+            return super().get_batch_sampler(dataset, batch_size, drop_last, *args, **kwargs)
+        return LengthGroupedBatchSampler(self.example_lengths, batch_size, drop_last,
+                                         seed=kwargs.get("seed", self.args.seed))
+
+# Huấn luyện theo profile đã chọn, trả về số liệu tốc độ (steps/s, examples/s)
+def train_with_profile(state: AppState, pairs: List[List[str]], checkpoints_dir: str, output_dir: str,
+                       resume_from: Optional[str] = None, profile: str = FINE_TUNE_PROFILE) -> dict:
+    cpu_fast = profile == "cpu_fast"
+    columns = {
+        "anchor": [pair[0] for pair in pairs],
+        "positive": [pair[1] for pair in pairs]
+    }
+    if pairs and len(pairs[0]) == 3:
+        # Bộ ba (anchor, positive, hard negative): MNRL dùng negative cùng với negative trong batch
+        columns["negative"] = [pair[2] for pair in pairs]
+    train_dataset = Dataset.from_dict(columns)
+    train_loss = losses.MultipleNegativesRankingLoss(state.model)
+    original_max_seq_length = state.model.max_seq_length
+    example_lengths = None
+    use_bf16 = False
+    num_threads = torch.get_num_threads()
+    if cpu_fast:
+        num_threads = configure_torch_threads()
+        use_bf16 = cpu_supports_bf16()
+        if state.tokenizer is not None:
+            state.model.max_seq_length = capped_max_seq_length(
+                state.tokenizer, [text for pair in pairs for text in pair], original_max_seq_length
+            )
+        example_lengths = [max(len(text.split()) for text in pair) for pair in pairs]
+    train_max_seq_length = state.model.max_seq_length
+    logger.info(f"Fine-tune profile={profile}, bf16={use_bf16}, max_seq_length={train_max_seq_length}, "
+                f"threads={num_threads}, examples={len(pairs)}")
+
+    args = SentenceTransformerTrainingArguments(
+        output_dir=checkpoints_dir,
+        num_train_epochs=1,
+        per_device_train_batch_size=FINE_TUNE_BATCH_SIZE,
+        warmup_ratio=0.1,
+        save_strategy="steps",
+        save_steps=CHECKPOINT_SAVE_STEPS,
+        save_total_limit=2,
+        bf16=use_bf16,
+        use_cpu=cpu_fast,
+        dataloader_pin_memory=False,
+        logging_steps=50,
+        report_to="none",
+        seed=42
+    )
+    trainer = LengthGroupedTrainer(
+        model=state.model,
+        args=args,
+        train_dataset=train_dataset,
+        loss=train_loss,
+        example_lengths=example_lengths,
+        callbacks=[TorchProfilerCallback(TORCH_PROFILE_STEPS, "fine_tune")] if TORCH_PROFILE_STEPS else None
+    )
+    try:
+        train_output = trainer.train(resume_from_checkpoint=resume_from)
+    finally:
+        # Mô hình phục vụ vẫn dùng độ dài gốc cho câu hỏi dài bất thường
+        state.model.max_seq_length = original_max_seq_length
+    state.model.save(output_dir)
+    metrics = train_output.metrics
+    throughput = {
+        "profile": profile,
+        "bf16": use_bf16,
+        "threads": num_threads,
+        "train_max_seq_length": train_max_seq_length,
+        "steps_per_second": metrics.get("train_steps_per_second"),
+        "examples_per_second": metrics.get("train_samples_per_second"),
+        "train_runtime": metrics.get("train_runtime")
+    }
+    logger.info(f"Fine-tune throughput: {throughput}")
+    return throughput
+
 # Hàm fine-tune PhoBERT
 def fine_tune_phobert(state: AppState, loop: asyncio.AbstractEventLoop = None) -> bool:
     logger.info("Starting fine_tune_phobert")
@@ -419,73 +2042,52 @@ def fine_tune_phobert(state: AppState, loop: asyncio.AbstractEventLoop = None) -
 
         with Lock(state.redis_client, "fine_tune_lock", timeout=3600, blocking_timeout=60):
             try:
-                train_examples = []
-                #  thm dữ lệu vào train_examples
-                for _, row in state.raw_data.iterrows():
-                    q_clean = clean_text(str(row['question']))
-                    a_clean = clean_text(str(row['answer']))
-                    if q_clean and a_clean:
-                        train_examples.append(InputExample(texts=[q_clean, a_clean]))
-
-                # nhóm các câu hỏi theo câu trả lời
-                groups = state.raw_data.groupby('answer')
-                # lấy các câu hoỏi trong cùng 1 nhóm, tạo cặp câu hỏi tương tự nếu nhóm có nhiều hơn 1 câu.
-                for answer, group in groups:
-                    clean_questions = [clean_text(q) for q in group['question'].tolist() if clean_text(q)]
-                    if len(clean_questions) > 1:
-                        for i in range(len(clean_questions)):
-                            for j in range(i + 1, len(clean_questions)):
-                                train_examples.append(InputExample(texts=[clean_questions[i], clean_questions[j]]))
-
-                # Kiểm tra nếu train_examples rỗng, dừng nếu không có dữ liệu.
-                if not train_examples:
+                # xác định nơi lưu mô hình và thư mục staging bền vững cho checkpoint trung gian
+                checkpoint_path = os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)
+                staging_path = os.getenv("FINE_TUNE_STAGING_PATH", checkpoint_path + "_staging")
+                recover_checkpoint(checkpoint_path)
+                pairs, resuming = prepare_fine_tune_run(staging_path, state.raw_data, state)
+
+                # Kiểm tra nếu không có cặp huấn luyện, dừng nếu không có dữ liệu.
+                if not pairs:
                     logger.error("No valid training examples")
                     return False
 
-                train_dataloader = DataLoader( #chia train_examples thành lô (batch size 4), xáo trộn để học đều.
-                    train_examples,
-                    shuffle=True,
-                    batch_size=4,
-                    pin_memory=False
-                )
-                # đo sai số khi huấn luyện
-                train_loss = losses.MultipleNegativesRankingLoss(state.model)
-                # xác ịnh nơi lưu mô hình
-                checkpoint_path = os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)
+                checkpoints_dir = os.path.join(staging_path, "checkpoints")
+                output_dir = os.path.join(staging_path, "output")
+
+                # Huấn luyện tối đa 3 lần, mỗi lần thử lại tiếp tục từ checkpoint trung gian gần nhất
+                max_retries = 3
+                for attempt in range(max_retries):
+                    last_checkpoint = latest_intermediate_checkpoint(checkpoints_dir)
+                    if last_checkpoint:
+                        logger.info(f"Resuming fine-tuning from {last_checkpoint}")
+                    try:
+                        throughput = train_with_profile(state, pairs, checkpoints_dir, output_dir, last_checkpoint)
+                        break
+                    except SoftTimeLimitExceeded:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"Attempt {attempt + 1} failed: {e}")
+                        if attempt == max_retries - 1:
+                            logger.error(f"Fine-tuning failed after {max_retries} retries, marking run as failed")
+                            # Lần fine-tune sau bắt đầu lại với dữ liệu mới thay vì tiếp tục lần chạy hỏng này
+                            run = read_fine_tune_run(staging_path)
+                            run.update(status="failed", finished_at=datetime.now().isoformat(), error=str(e)[:500])
+                            write_fine_tune_run(staging_path, run)
+                            return False
+                        time.sleep(5)
 
-                # Tạo thư mục tạm (temp_dir) để lưu mô hình trong quá trình huấn luyện
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    temp_checkpoint = os.path.join(temp_dir, "phobert_temp")
-                    logger.info(f"Using temporary checkpoint: {temp_checkpoint}")
-                    # Xóa mô hình cũ tại checkpoint_path nếu tồn tại.
-                    if os.path.exists(checkpoint_path):
-                        logger.info(f"Removing old checkpoint at {checkpoint_path}")
-                        shutil.rmtree(checkpoint_path, ignore_errors=True)
-
-                    # state.model.fit 3 lần
-                    max_retries = 3
-                    for attempt in range(max_retries):
-                        try:
-                            state.model.fit(
-                                train_objectives=[(train_dataloader, train_loss)],
-                                epochs=1,
-                                warmup_steps=100,
-                                output_path=temp_checkpoint,
-                                checkpoint_path=temp_checkpoint,
-                                checkpoint_save_steps=100,
-                                show_progress_bar=True # hển th tiê đọ
-                            )
-                            break
-                        except Exception as e:
-                            logger.warning(f"Attempt {attempt + 1} failed: {e}")
-                            if attempt == max_retries - 1:
-                                logger.error(f"Fine-tuning failed after {max_retries} retries")
-                                return False
-                            time.sleep(5)
-
-                    # di chuyêển mô hình từ thư mục tạm sang checkpoint_path
-                    shutil.move(temp_checkpoint, checkpoint_path)
-                    logger.info(f"Moved fine-tuned model to {checkpoint_path}")
+                # Chỉ thay mô hình cũ khi mô hình mới đã huấn luyện xong, kèm phép chiếu của chính mô hình đó
+                fit_model_projection(output_dir, questions=state.raw_data['question'].astype(str).tolist())
+                promote_checkpoint(output_dir, checkpoint_path)
+                run = read_fine_tune_run(staging_path)
+                run.update(status="promoted", finished_at=datetime.now().isoformat(), throughput=throughput)
+                write_fine_tune_run(staging_path, run)
+                # Lưu lịch sử tốc độ huấn luyện của từng lần chạy
+                with open(checkpoint_path + "_history.jsonl", "a", encoding="utf-8") as f:
+                    f.write(json.dumps(run, ensure_ascii=False) + "\n")
+                shutil.rmtree(checkpoints_dir, ignore_errors=True)
 
                 if not os.path.exists(checkpoint_path):
                     logger.error(f"Checkpoint not found: {checkpoint_path}")
@@ -496,23 +2098,798 @@ def fine_tune_phobert(state: AppState, loop: asyncio.AbstractEventLoop = None) -
                 logger.info("Reloaded fine-tuned model")
                 # Cập nhật thời gian
                 state.last_fine_tune = int(time.time())
-                loop = loop or asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
+                state.last_fine_tune_record_count = run.get("record_count", len(state.raw_data))
+                own_loop = loop is None or loop.is_closed()
+                run_loop = asyncio.new_event_loop() if own_loop else loop
+                asyncio.set_event_loop(run_loop)
                 try:
-                    # Cập nhật ố bản ghi cho lần fine tune
-                    state.last_fine_tune_record_count = loop.run_until_complete(count_records(state))
+                    # Lưu watermark số bản ghi đã fine-tune vào MySQL
+                    run_loop.run_until_complete(record_fine_tune(state, state.last_fine_tune_record_count))
                 finally:
-                    if not loop.is_closed():
-                        loop.close()
+                    if own_loop:
+                        run_loop.close()
                         logger.info("Closed temporary event loop")
 
                 logger.info(f"Fine-tuning completed in {time.time() - start_time:.2f}s")
                 return True
 
+            except SoftTimeLimitExceeded:
+                raise
             except Exception as e:
                 logger.error(f"Error during fine-tuning: {e}", exc_info=True)
                 return False
 
+    except SoftTimeLimitExceeded:
+        logger.warning("Fine-tuning hit the soft time limit, progress kept for resume")
+        raise
     except Exception as e:
         logger.error(f"Fine-tune error: {e}")
-        return False
\ No newline at end of file
+        return False
+
+# Tạo mô hình student bằng cách giữ lại một số lớp transformer cách đều của teacher
+def build_student(teacher_path: str, num_layers: int = DISTILL_NUM_LAYERS) -> SentenceTransformer:
+    student = SentenceTransformer(teacher_path)
+    auto_model = student[0].auto_model
+    layers = auto_model.encoder.layer
+    keep = sorted(set(np.linspace(0, len(layers) - 1, num_layers).round().astype(int).tolist()))
+    auto_model.encoder.layer = torch.nn.ModuleList([layers[i] for i in keep])
+    auto_model.config.num_hidden_layers = len(keep)
+    logger.info(f"Built student with layers {keep} of {len(layers)}")
+    return student
+
+# So sánh recall@k của student với teacher: tỉ lệ láng giềng gần nhất trùng nhau (loại chính câu truy vấn)
+# queries: chỉ số các câu hỏi dùng làm truy vấn (mặc định lấy mẫu từ toàn bộ), tìm láng giềng trên cả corpus
+def recall_at_k_parity(teacher_embs: np.ndarray, student_embs: np.ndarray, k: int = 5,
+                       sample_size: int = 1000, queries: np.ndarray = None) -> float:
+    n = len(teacher_embs)
+    if n <= k:
+        return 1.0
+    if queries is None:
+        queries = np.arange(n)
+    if len(queries) > sample_size:
+        queries = np.random.default_rng(0).choice(queries, size=sample_size, replace=False)
+    overlaps = []
+    neighbours = {}
+    for name, embs in (("teacher", teacher_embs), ("student", student_embs)):
+        embs = (embs / np.linalg.norm(embs, axis=1, keepdims=True)).astype(np.float32)
+        index = faiss.IndexFlatL2(embs.shape[1])
+        index.add(embs)
+        _, ids = index.search(embs[queries], k + 1)
+        neighbours[name] = ids
+    for row, query in enumerate(queries):
+        teacher_ids = [i for i in neighbours["teacher"][row] if i != query][:k]
+        student_ids = set(i for i in neighbours["student"][row] if i != query)
+        overlaps.append(len(student_ids.intersection(teacher_ids)) / len(teacher_ids))
+    return float(np.mean(overlaps))
+
+# Chưng cất student từ teacher đã fine-tune trên câu hỏi của mọi collection, rồi đánh giá trên phần
+# câu hỏi giữ lại (không dùng khi chưng cất) và promote
+def distill_student(state: AppState, teacher_path: str = None, student_path: str = None,
+                    holdout: float = DISTILL_HOLDOUT) -> dict:
+    teacher_path = teacher_path or os.getenv("CHECKPOINT_PATH", CHECKPOINT_PATH)
+    student_path = student_path or os.getenv("STUDENT_PATH", STUDENT_PATH)
+    staging_path = student_path + "_staging"
+    clean_questions = [q for q in (clean_text(str(q)) for q in state.raw_data['question']) if q]
+    if len(clean_questions) < 10:
+        raise ValueError("Not enough questions for distillation")
+    order = list(range(len(clean_questions)))
+    random.Random(0).shuffle(order)
+    holdout_rows = np.array(sorted(order[:max(1, int(len(order) * holdout))]))
+    train_rows = sorted(order[len(holdout_rows):])
+
+    with Lock(state.redis_client, "distill_lock", timeout=3600, blocking_timeout=60):
+        start_time = time.time()
+        teacher_fingerprint = model_fingerprint(teacher_path)
+        teacher = SentenceTransformer(teacher_path)
+        teacher_embs = teacher.encode(clean_questions, convert_to_numpy=True, show_progress_bar=False)
+        student = build_student(teacher_path)
+        train_dataset = Dataset.from_dict({
+            "text": [clean_questions[i] for i in train_rows],
+            "label": teacher_embs[train_rows].tolist()
+        })
+        shutil.rmtree(staging_path, ignore_errors=True)
+        args = SentenceTransformerTrainingArguments(
+            output_dir=os.path.join(staging_path, "checkpoints"),
+            num_train_epochs=DISTILL_EPOCHS,
+            per_device_train_batch_size=32,
+            warmup_ratio=0.1,
+            save_strategy="no",
+            bf16=cpu_supports_bf16(),
+            use_cpu=True,
+            dataloader_pin_memory=False,
+            logging_steps=50,
+            report_to="none",
+            seed=42
+        )
+        trainer = SentenceTransformerTrainer(
+            model=student,
+            args=args,
+            train_dataset=train_dataset,
+            loss=losses.MSELoss(student)
+        )
+        trainer.train()
+        output_dir = os.path.join(staging_path, "output")
+        student.save(output_dir)
+
+        # Đánh giá: recall@k so với teacher (truy vấn là các câu hỏi giữ lại) và độ trễ mã hóa một câu hỏi
+        student_embs = student.encode(clean_questions, convert_to_numpy=True, show_progress_bar=False)
+        recall = recall_at_k_parity(teacher_embs, student_embs, k=5, queries=holdout_rows)
+        sample = [clean_questions[i] for i in holdout_rows[:100]]
+        latency = {}
+        for name, model in (("teacher", teacher), ("student", student)):
+            t0 = time.time()
+            for text in sample:
+                model.encode([text], convert_to_numpy=True, show_progress_bar=False)
+            latency[name] = (time.time() - t0) / len(sample) * 1000
+        report = {
+            "finished_at": datetime.now().isoformat(),
+            "num_questions": len(clean_questions),
+            "num_holdout": len(holdout_rows),
+            "student_layers": student[0].auto_model.config.num_hidden_layers,
+            "recall_at_5_parity": round(recall, 4),
+            "teacher_ms_per_query": round(latency["teacher"], 2),
+            "student_ms_per_query": round(latency["student"], 2),
+            "duration_seconds": round(time.time() - start_time, 2),
+            "teacher_fingerprint": teacher_fingerprint,
+            "promoted": recall >= DISTILL_MIN_RECALL
+        }
+        with open(os.path.join(output_dir, "distill_report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        logger.info(f"Distillation report: {report}")
+        if report["promoted"]:
+            fit_model_projection(output_dir, embeddings=student_embs)
+            promote_checkpoint(output_dir, student_path)
+        else:
+            logger.warning(f"Student recall@5 parity {recall:.3f} < {DISTILL_MIN_RECALL}, not promoting; "
+                           f"serving falls back to the teacher until a student of the current checkpoint passes")
+        shutil.rmtree(staging_path, ignore_errors=True)
+        return report
+
+
+# Gia hạn lease nếu đang là leader (so khớp giá trị để không gia hạn lease của replica khác)
+_RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Giữ hoặc giành quyền leader của scheduler; trả về True nếu replica này đang là leader
+def acquire_leadership(redis_client: redis.Redis, ttl: int = SCHEDULER_LEASE_TTL) -> bool:
+    ttl_ms = ttl * 1000
+    if redis_client.eval(_RENEW_LEASE_SCRIPT, 1, SCHEDULER_LEADER_KEY, REPLICA_ID, ttl_ms):
+        return True
+    return bool(redis_client.set(SCHEDULER_LEADER_KEY, REPLICA_ID, nx=True, px=ttl_ms))
+
+def release_leadership(redis_client: redis.Redis):
+    redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, SCHEDULER_LEADER_KEY, REPLICA_ID)
+
+def current_leader(redis_client: redis.Redis) -> Optional[str]:
+    leader = redis_client.get(SCHEDULER_LEADER_KEY)
+    return leader.decode() if leader else None
+
+# Trạng thái lịch fine-tune tự động lưu trong Redis, dùng chung cho mọi replica
+def get_schedule(redis_client: redis.Redis) -> dict:
+    redis_client.hsetnx(AUTO_FINE_TUNE_SCHEDULE_KEY, "enabled", "true")
+    redis_client.hsetnx(AUTO_FINE_TUNE_SCHEDULE_KEY, "next_run", time.time() + AUTO_FINE_TUNE_INTERVAL)
+    raw = {k.decode(): v.decode() for k, v in redis_client.hgetall(AUTO_FINE_TUNE_SCHEDULE_KEY).items()}
+    return {
+        "enabled": raw.get("enabled") == "true",
+        "next_run": float(raw.get("next_run", 0)),
+        "last_run": float(raw["last_run"]) if raw.get("last_run") else None
+    }
+
+def set_schedule_enabled(redis_client: redis.Redis, enabled: bool):
+    redis_client.hset(AUTO_FINE_TUNE_SCHEDULE_KEY, "enabled", "true" if enabled else "false")
+
+# Ghi nhận một lần chạy lịch và đặt lần chạy kế tiếp (chỉ leader gọi)
+def advance_schedule(redis_client: redis.Redis, now: float):
+    redis_client.hset(AUTO_FINE_TUNE_SCHEDULE_KEY, mapping={
+        "last_run": now, "next_run": now + AUTO_FINE_TUNE_INTERVAL
+    })
+
+# Phát một thay đổi lên Redis stream; lỗi Redis không làm hỏng thao tác ghi vì DB vẫn là nguồn dữ liệu gốc
+def publish_mutation(redis_client: redis.Redis, op: str, ids: List[int], embeddings: np.ndarray = None,
+                     stream: str = MUTATION_STREAM, **fields) -> Optional[str]:
+    if redis_client is None:
+        return None
+    entry = {"op": op, "origin": REPLICA_ID, "ids": json.dumps([int(i) for i in ids])}
+    if embeddings is not None and len(embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        entry["embeddings"] = embeddings.tobytes()
+        entry["dim"] = embeddings.shape[-1]
+    for key, value in fields.items():
+        entry[key] = json.dumps(value, ensure_ascii=False, default=int)
+    try:
+        entry_id = redis_client.xadd(stream, entry, maxlen=MUTATION_STREAM_MAXLEN, approximate=True)
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    except redis.RedisError as e:
+        logger.error(f"Error publishing {op} mutation: {e}")
+        return None
+
+def decode_mutation(fields: dict) -> dict:
+    fields = {k.decode() if isinstance(k, bytes) else k: v for k, v in fields.items()}
+    mutation = {
+        "op": fields.pop("op").decode(),
+        "origin": fields.pop("origin").decode(),
+        "ids": json.loads(fields.pop("ids"))
+    }
+    raw = fields.pop("embeddings", None)
+    dim = fields.pop("dim", None)
+    if raw is not None:
+        mutation["embeddings"] = np.frombuffer(raw, dtype=np.float32).reshape(-1, int(dim))
+    for key, value in fields.items():
+        mutation[key] = json.loads(value)
+    if "answers" in mutation:
+        mutation["answers"] = {int(k): tuple(v) for k, v in mutation["answers"].items()}
+    return mutation
+
+def latest_stream_id(redis_client: redis.Redis, stream: str = MUTATION_STREAM) -> str:
+    entries = redis_client.xrevrange(stream, count=1)
+    if not entries:
+        return "0-0"
+    entry_id = entries[0][0]
+    return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+# Áp dụng một thay đổi insert/edit/delete từ replica khác (idempotent khi phát lại)
+def apply_mutation(state: AppState, mutation: dict):
+    op = mutation["op"]
+    if op == "insert":
+        known = get_row_index(state)
+        keep = [i for i, id_ in enumerate(mutation["ids"]) if id_ not in known]
+        if not keep:
+            return
+        ids = [mutation["ids"][i] for i in keep]
+        embeddings = mutation["embeddings"][keep]
+        state.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+        append_to_cache(
+            state, ids, embeddings,
+            [mutation["questions"][i] for i in keep], [mutation["clean_questions"][i] for i in keep],
+            [mutation["answer_ids"][i] for i in keep], mutation["answers"]
+        )
+    elif op == "edit":
+        for i, qa_id in enumerate(mutation["ids"]):
+            answer_id = mutation["answer_ids"][i]
+            answer, answer_clean = mutation["answers"][answer_id]
+            apply_edit(state, qa_id, mutation["embeddings"][i], mutation["questions"][i],
+                       mutation["clean_questions"][i], answer_id, answer, answer_clean)
+    elif op == "delete":
+        for qa_id in mutation["ids"]:
+            apply_delete(state, qa_id)
+    else:
+        logger.warning(f"Unknown mutation op: {op}")
+
+# Mô hình/phép chiếu riêng của một collection (ghi thẳng vào state, không qua parent): dùng khi vector của
+# collection đó và của state gốc đang thuộc hai mô hình khác nhau giữa chừng một lần re-embed
+def pin_encoder(state: AppState, model, projection: Optional[dict]):
+    object.__setattr__(state, "model", model)
+    object.__setattr__(state, "projection", projection)
+
+def unpin_encoder(state: AppState):
+    state.__dict__.pop("model", None)
+    state.__dict__.pop("projection", None)
+
+# Đổi mô hình truy vấn của một collection vừa thay xong vector. Mô hình chung (state gốc) chỉ được thay khi
+# collection mặc định đã áp dụng; collection đang nạp mà chưa áp dụng giữ mô hình cũ, đã áp dụng thì giữ mô hình
+# mới, cho tới khi mọi collection đã nạp cùng dùng mô hình mới thì bỏ các mô hình riêng.
+def switch_encoder(state: AppState, run: dict):
+    root = state.parent or state
+    if state is root:
+        for name, child in root.collection_states.items():
+            if name not in run["applied"] and "model" not in child.__dict__:
+                pin_encoder(child, root.model, root.projection)
+        root.model, root.projection = run["model"], run["projection"]
+    else:
+        pin_encoder(state, run["model"], run["projection"])
+    run["applied"].add(state.collection)
+    settle_reembed_run(root)
+
+# Kết thúc lần re-embed khi collection mặc định và mọi collection đang nạp đã áp dụng
+def settle_reembed_run(root: AppState):
+    run = root.reembed_run
+    if run is None or DEFAULT_COLLECTION not in run["applied"] \
+            or any(name not in run["applied"] for name in root.collection_states):
+        return
+    for child in root.collection_states.values():
+        unpin_encoder(child)
+    root.reembed_run = None
+    logger.info(f"Re-embedding {run['batch_id']} applied to every loaded collection, shared model switched")
+
+# Collection được nạp trong lúc một lần re-embed đang áp dụng dở: cache trên đĩa đã mã hóa bằng mô hình mới thì
+# dùng mô hình mới; cache cũ mà mô hình chung đã đổi thì mã hóa lại từ DB. Còn lại collection giữ mô hình chung
+# (mô hình cũ) và sẽ nhận lô re-embed từ stream như các collection khác.
+async def join_reembed_run(state: AppState):
+    root = state.parent or state
+    run = root.reembed_run
+    if run is None or state is root:
+        return
+    if state.cache_data.get('model_fingerprint') == run["fingerprint"]:
+        switch_encoder(state, run)
+    elif DEFAULT_COLLECTION in run["applied"]:
+        logger.info(f"Collection {state.collection} cache predates re-embedding {run['batch_id']}, rebuilding")
+        await initialize_cache_and_index(state, rebuild=True)
+        switch_encoder(state, run)
+
+# Gom các lô embedding sau fine-tune; khi đủ lô cuối thì thay vector, index và mô hình truy vấn của collection.
+# Mô hình mới được nạp một lần cho mỗi lần re-embed và dùng chung cho mọi collection.
+async def apply_reembed(state: AppState, mutation: dict):
+    pending = state.pending_reembed
+    if pending is None or pending["batch_id"] != mutation["batch_id"]:
+        pending = state.pending_reembed = {"batch_id": mutation["batch_id"], "vectors": {}}
+    if "embeddings" in mutation:
+        pending["vectors"].update(zip(mutation["ids"], mutation["embeddings"]))
+    if not mutation["last"]:
+        return
+    state.pending_reembed = None
+    model_path = mutation["model_path"]
+    root = state.parent or state
+    run = root.reembed_run
+    if run is None or run["batch_id"] != mutation["batch_id"]:
+        logger.info(f"Loading model {model_path} for re-embedding {mutation['batch_id']}")
+        model = await asyncio.to_thread(SentenceTransformer, model_path)
+        run = root.reembed_run = {"batch_id": mutation["batch_id"], "model_path": model_path, "model": model,
+                                  "projection": load_projection(model_path), "applied": set(),
+                                  "fingerprint": await asyncio.to_thread(model_fingerprint, model_path)}
+    model, projection = run["model"], run["projection"]
+    logger.info(f"Applying re-embedding of {len(pending['vectors'])} vectors to {state.collection} with model {model_path}")
+
+    def build():
+        # Dòng nào chưa có vector mới (thêm sau khi bắt đầu re-embed) thì mã hóa lại bằng mô hình mới
+        cache = state.cache_data
+        vectors = pending["vectors"]
+        missing = [i for i, id_ in enumerate(cache['ids']) if id_ not in vectors]
+        extra = {}
+        if missing:
+            encoded = model.encode([cache['clean_questions'][i] for i in missing], convert_to_numpy=True,
+                                   show_progress_bar=False)
+            encoded = encoded / np.linalg.norm(encoded, axis=1, keepdims=True)
+            if projection is not None:
+                encoded = apply_projection(encoded, projection)
+            extra = {cache['ids'][i]: emb for i, emb in zip(missing, encoded)}
+        embeddings = np.vstack([vectors.get(id_, extra.get(id_)) for id_ in cache['ids']]).astype(np.float32) \
+            if cache['ids'] else np.array([])
+        index = faiss.IndexIDMap(faiss.IndexFlatL2(embeddings.shape[1] if embeddings.size else
+                                                   model.get_sentence_embedding_dimension()))
+        live = [i for i, id_ in enumerate(cache['ids']) if id_ not in cache.get('tombstones', ())]
+        if live:
+            index.add_with_ids(embeddings[live], np.array([cache['ids'][i] for i in live], dtype=np.int64))
+        return embeddings, index
+
+    version = state.cache_version
+    embeddings, index = await asyncio.to_thread(build)
+    if version != state.cache_version:
+        # Cache thay đổi trong lúc dựng index: dựng lại một lần trên event loop để không mất thay đổi
+        embeddings, index = build()
+    state.cache_data['embeddings'] = embeddings
+    state.index = index
+    state.cache_version += 1
+    switch_encoder(state, run)
+    logger.info(f"Re-embedding applied to {state.collection}")
+
+# Vòng lặp đọc Redis stream và áp dụng thay đổi của các replica khác theo thứ tự
+async def consume_mutations(state: AppState):
+    offset = state.cache_data.get('stream_offset') or latest_stream_id(state.redis_client, state.mutation_stream)
+    logger.info(f"Replica {REPLICA_ID} consuming {state.mutation_stream} from {offset}")
+    failures = 0
+    while True:
+        try:
+            response = await asyncio.to_thread(
+                state.redis_client.xread, {state.mutation_stream: offset}, 100, 1000
+            )
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                    try:
+                        mutation = decode_mutation(fields)
+                        if mutation["origin"] != REPLICA_ID:
+                            if mutation["op"] == "reembed":
+                                await apply_reembed(state, mutation)
+                            else:
+                                apply_mutation(state, mutation)
+                    except Exception as e:
+                        # Bỏ qua entry lỗi (đưa vào dead-letter stream) thay vì đọc lại nó mãi
+                        failures += 1
+                        logger.error(f"Skipping mutation {entry_id} on {state.mutation_stream} "
+                                     f"({failures}/{MUTATION_MAX_FAILURES}): {e}", exc_info=True)
+                        park_mutation(state.redis_client, state.mutation_stream, entry_id, fields, e)
+                    offset = entry_id
+                    state.cache_data['stream_offset'] = offset
+            if response:
+                state.redis_client.hset(f"{state.mutation_stream}:offsets", REPLICA_ID, offset)
+            if failures >= MUTATION_MAX_FAILURES:
+                # Cache đã lệch khỏi DB sau nhiều entry bị bỏ qua: dựng lại từ DB rồi đọc tiếp từ mốc mới
+                logger.warning(f"{failures} mutations skipped on {state.mutation_stream}, rebuilding cache from database")
+                state.pending_reembed = None
+                await initialize_cache_and_index(state, rebuild=True)
+                offset = state.cache_data.get('stream_offset') or offset
+                failures = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error consuming mutations at {offset}: {e}", exc_info=True)
+            await asyncio.sleep(1)
+
+# Lưu entry không áp dụng được vào dead-letter stream để kiểm tra sau
+def park_mutation(redis_client: redis.Redis, stream: str, entry_id: str, fields: dict, error: Exception):
+    try:
+        entry = {k.decode() if isinstance(k, bytes) else k: v for k, v in fields.items()}
+        entry.update({"entry_id": entry_id, "replica": REPLICA_ID, "error": str(error)[:500]})
+        redis_client.xadd(f"{stream}:dead", entry, maxlen=MUTATION_DEAD_LETTER_MAXLEN, approximate=True)
+    except redis.RedisError as e:
+        logger.error(f"Error parking mutation {entry_id}: {e}")
+
+
+# Kiểm soát tải cho /search: giới hạn số request đang xử lý và hàng đợi, từ chối sớm khi không kịp deadline
+class AdmissionController:
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.queued = 0
+        self.service_time = 0.05  # EWMA thời gian xử lý một request (giây)
+        self.metrics = {"accepted": 0, "completed": 0, "shed_queue_full": 0, "shed_deadline": 0, "timed_out": 0,
+                        "deadline_exceeded": 0}
+
+    def estimated_wait(self) -> float:
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return (self.queued + 1) / self.max_in_flight * self.service_time
+
+    def reject(self, reason: str, wait: float):
+        self.metrics[reason] += 1
+        retry_after = max(1, math.ceil(wait))
+        logger.warning(f"Shedding search request ({reason}), in_flight={self.in_flight}, queued={self.queued}, "
+                       f"retry_after={retry_after}s")
+        raise HTTPException(status_code=503, detail="Hệ thống đang quá tải, vui lòng thử lại sau",
+                            headers={"Retry-After": str(retry_after)})
+
+    # Chờ slot tối đa timeout giây. acquire chạy trong task riêng thay vì wait_for (trên Python < 3.12 wait_for
+    # có thể hủy đúng lúc acquire vừa xong và làm rò slot): slot đã cấp mà request bị hủy thì trả lại ngay.
+    async def acquire(self, timeout: float) -> bool:
+        task = asyncio.ensure_future(self.semaphore.acquire())
+        try:
+            await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            if task.done() and not task.cancelled():
+                self.semaphore.release()
+            else:
+                task.cancel()
+            raise
+        if task.done():
+            return True
+        task.cancel()
+        return False
+
+    # Dừng request đã vào xử lý nếu đã quá deadline, trước các bước tốn kém (encode, tìm kiếm)
+    def check_deadline(self, deadline: float, stage: str):
+        if time.monotonic() >= deadline:
+            logger.warning(f"Search request exceeded its deadline before {stage}")
+            self.reject("deadline_exceeded", self.estimated_wait())
+
+    # Trả về thời điểm deadline (time.monotonic) để endpoint kiểm tra lại trong lúc xử lý
+    @asynccontextmanager
+    async def admit(self, budget: float):
+        deadline = time.monotonic() + budget
+        wait = self.estimated_wait()
+        if self.queued >= self.max_queue:
+            self.reject("shed_queue_full", wait)
+        if wait + self.service_time > budget:
+            self.reject("shed_deadline", wait)
+        self.queued += 1
+        try:
+            acquired = await self.acquire(max(budget - self.service_time, 0.001))
+        finally:
+            self.queued -= 1
+        if not acquired:
+            self.reject("timed_out", self.estimated_wait())
+        self.in_flight += 1
+        self.metrics["accepted"] += 1
+        start = time.monotonic()
+        try:
+            yield deadline
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - start)
+            self.metrics["completed"] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            **self.metrics,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "service_time_ms": round(self.service_time * 1000, 2)
+        }
+
+
+# State của một collection dùng chung encoder/kết nối với state gốc (dùng trong worker, không giữ trong bộ nhớ)
+def collection_state(root: AppState, collection: Optional[str]) -> AppState:
+    collection = (collection or DEFAULT_COLLECTION).strip().lower()
+    if collection == DEFAULT_COLLECTION:
+        return root
+    if collection not in QA_COLLECTIONS:
+        raise HTTPException(status_code=404, detail=f"Unknown collection: {collection}")
+    return AppState(collection, parent=root)
+
+# Dữ liệu huấn luyện encoder dùng chung: gộp mọi collection, answer_id được gắn tên collection để không trùng nhóm
+async def load_training_data(state: AppState) -> pd.DataFrame:
+    frames = [(await load_data_db(state)).assign(collection=DEFAULT_COLLECTION)]
+    for collection in QA_COLLECTIONS:
+        frame = await load_data_db(AppState(collection, parent=state))
+        if not frame.empty:
+            frame['answer_id'] = [f"{collection}:{answer_id}" for answer_id in frame['answer_id']]
+            frames.append(frame.assign(collection=collection))
+    return pd.concat(frames, ignore_index=True)
+
+# Ước lượng bộ nhớ của một collection: embedding trong cache và trong index phẳng, cộng văn bản
+def collection_footprint(state: AppState) -> int:
+    cache = state.cache_data
+    vectors = cache['embeddings'].nbytes if isinstance(cache['embeddings'], np.ndarray) else 0
+    if state.index is not None:
+        vectors += state.index.ntotal * state.index.d * 4
+    text = sum(len(q) for q in cache['questions']) + sum(len(q) for q in cache['clean_questions'])
+    text += sum(len(a) + len(c) for a, c in cache['answers'].values())
+    return vectors + text * 2
+
+# Các collection được nạp khi dùng lần đầu và bị loại theo LRU khi tổng bộ nhớ vượt ngân sách.
+# Collection mặc định luôn ở trong bộ nhớ.
+class CollectionRegistry:
+    def __init__(self, root: AppState, memory_budget_mb: int = COLLECTION_MEMORY_BUDGET_MB):
+        self.root = root
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.loaded = OrderedDict()
+        root.collection_states = self.loaded
+        self.loading = {}
+
+    async def get(self, collection: Optional[str]) -> AppState:
+        collection = (collection or DEFAULT_COLLECTION).strip().lower()
+        if collection == DEFAULT_COLLECTION:
+            return self.root
+        if collection not in QA_COLLECTIONS:
+            raise HTTPException(status_code=404, detail=f"Unknown collection: {collection}")
+        coll_state = self.loaded.get(collection)
+        if coll_state is None:
+            async with self.loading.setdefault(collection, asyncio.Lock()):
+                coll_state = self.loaded.get(collection)
+                if coll_state is None:
+                    coll_state = await self.load(collection)
+        self.loaded.move_to_end(collection)
+        return coll_state
+
+    async def load(self, collection: str) -> AppState:
+        start_time = time.time()
+        coll_state = AppState(collection, parent=self.root)
+        await init_db(coll_state)
+        await initialize_cache_and_index(coll_state)
+        # Đăng ký ngay để switch_encoder thấy collection này nếu mô hình chung đổi trong lúc nạp tiếp
+        self.loaded[collection] = coll_state
+        await join_reembed_run(coll_state)
+        if LEXICAL_PREBUILD:
+            await ensure_lexical_index(coll_state)
+        coll_state.mutation_consumer = asyncio.create_task(consume_mutations(coll_state))
+        logger.info(f"Loaded collection {collection} with {coll_state.index.ntotal} vectors "
+                    f"in {time.time() - start_time:.2f}s")
+        await self.evict(keep=collection)
+        return coll_state
+
+    def memory_usage(self) -> int:
+        return collection_footprint(self.root) + sum(collection_footprint(s) for s in self.loaded.values())
+
+    async def evict(self, keep: str = None):
+        while self.memory_usage() > self.memory_budget:
+            victim = next((name for name in self.loaded if name != keep), None)
+            if victim is None:
+                break
+            coll_state = self.loaded.pop(victim)
+            if coll_state.mutation_consumer:
+                coll_state.mutation_consumer.cancel()
+            # Lưu cache kèm stream_offset để lần nạp sau phát lại các thay đổi bị bỏ lỡ
+            await asyncio.to_thread(save_cache, coll_state.cache_data, coll_state.cache_path, coll_state.redis_client)
+            logger.info(f"Evicted collection {victim}, memory usage now {self.memory_usage() / 1024 / 1024:.1f} MB")
+            # Collection bị gỡ không còn chặn việc đổi mô hình chung của lần re-embed đang dở
+            settle_reembed_run(self.root)
+
+    def close(self):
+        for coll_state in self.loaded.values():
+            if coll_state.mutation_consumer:
+                coll_state.mutation_consumer.cancel()
+
+    def snapshot(self) -> dict:
+        return {
+            "collections": [DEFAULT_COLLECTION] + QA_COLLECTIONS,
+            "loaded": [DEFAULT_COLLECTION] + list(self.loaded),
+            "memory_usage_mb": round(self.memory_usage() / 1024 / 1024, 1),
+            "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 1)
+        }
+
+
+# Span thời gian theo từng request: bật khi request có header X-Trace, trả về qua Server-Timing
+current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("current_trace", default=None)
+
+class RequestTrace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans = {}  # tên stage -> [tổng thời gian (giây), số lần]
+
+    def record(self, name: str, elapsed: float):
+        span = self.spans.setdefault(name, [0.0, 0])
+        span[0] += elapsed
+        span[1] += 1
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{name};dur={total * 1000:.2f}" + (f';desc="x{count}"' if count > 1 else "")
+            for name, (total, count) in self.spans.items()
+        )
+
+    def summary(self) -> dict:
+        return {name: {"ms": round(total * 1000, 2), "count": count} for name, (total, count) in self.spans.items()}
+
+# Đo một stage của request đang trace; không làm gì nếu request không bật trace
+@contextmanager
+def trace_span(name: str):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(name, time.perf_counter() - start)
+
+# Lấy mẫu stack của mọi thread trong tiến trình, trả về định dạng folded (flamegraph.pl, speedscope)
+def sample_stacks(seconds: float, interval: float = 0.01) -> str:
+    sampler_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, f"thread-{thread_id}"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in counts.most_common()) + "\n"
+
+# Ghi bảng thời gian theo operator và chrome trace của một lần chạy torch profiler
+def write_torch_profile(prof, name: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=50))
+    prof.export_chrome_trace(base + ".json")
+    logger.info(f"Saved torch profile to {base}.txt and {base}.json")
+    return base
+
+# Chụp torch profiler cho một số bước huấn luyện (bỏ qua 1 bước đầu, khởi động 1 bước)
+class TorchProfilerCallback(TrainerCallback):
+    def __init__(self, steps: int, name: str):
+        self.steps = steps
+        self.name = name
+        self.profiler = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            schedule=torch.profiler.schedule(wait=1, warmup=1, active=self.steps, repeat=1),
+            on_trace_ready=lambda prof: write_torch_profile(prof, self.name),
+            record_shapes=True
+        )
+        self.profiler.start()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.profiler.step_num >= self.steps + 2:
+                self.stop()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+# Mã hóa corpus; khi bật TORCH_PROFILE_STEPS thì chụp profiler cho số lô đầu tiên rồi mã hóa phần còn lại như thường
+def encode_with_profile(model, texts: List[str], name: str, steps: int = TORCH_PROFILE_STEPS,
+                        batch_size: int = 32) -> np.ndarray:
+    if not steps or not texts:
+        return model.encode(texts, convert_to_numpy=True, show_progress_bar=True)
+    profiled = texts[:steps * batch_size]
+    parts = []
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True) as prof:
+        for i in range(0, len(profiled), batch_size):
+            with torch.profiler.record_function(f"encode_batch_{i // batch_size}"):
+                parts.append(model.encode(profiled[i:i + batch_size], batch_size=batch_size, convert_to_numpy=True,
+                                          show_progress_bar=False))
+    write_torch_profile(prof, name)
+    if len(texts) > len(profiled):
+        parts.append(model.encode(texts[len(profiled):], convert_to_numpy=True, show_progress_bar=True))
+    return np.vstack(parts)
+
+current_capture: ContextVar[Optional[dict]] = ContextVar("current_capture", default=None)
+
+# Gắn thêm thông tin hình dạng request vào bản ghi capture hiện tại; không làm gì nếu request không được ghi
+def capture_shape(**fields):
+    shape = current_capture.get()
+    if shape is not None:
+        shape.update(fields)
+
+# Hình dạng ẩn danh của một đoạn văn bản: hash HMAC (giữ được truy vấn lặp lại), số từ và số ký tự
+def text_shape(text: str) -> dict:
+    digest = hmac.new(TRAFFIC_CAPTURE_SALT.encode(), text.strip().lower().encode("utf-8"), hashlib.sha256)
+    return {"hash": digest.hexdigest()[:16], "words": len(text.split()), "chars": len(text)}
+
+# Ghi traffic ra file JSONL theo lô; mỗi dòng là thời điểm bắt đầu (epoch, để gộp được capture của nhiều replica),
+# replica, đường dẫn, status, thời gian xử lý và shape. File được ghi trong thread để không chặn event loop.
+class TrafficRecorder:
+    def __init__(self, path: str = TRAFFIC_CAPTURE_PATH, sample: float = TRAFFIC_CAPTURE_SAMPLE,
+                 flush_every: int = 100, flush_interval: float = 5.0):
+        self.path = path
+        self.sample = sample
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.buffer = []
+        self.recorded = 0
+        self.writes = set()
+        self.write_lock = threading.Lock()
+
+    def should_capture(self) -> bool:
+        return self.sample >= 1 or random.random() < self.sample
+
+    def record(self, method: str, path: str, started_at: float, elapsed: float, status: int, shape: dict):
+        self.buffer.append({
+            "t": round(started_at, 4),
+            "replica": REPLICA_ID,
+            "method": method,
+            "path": path,
+            "status": status,
+            "ms": round(elapsed * 1000, 2),
+            **shape
+        })
+        self.recorded += 1
+        if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        entries, self.buffer = self.buffer, []
+        await asyncio.to_thread(self.write, entries)
+
+    # Ghi tuần tự từng lô bằng một lệnh write (O_APPEND) để các lô không xen lẫn nhau
+    def write(self, entries: List[dict]):
+        with self.write_lock:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+            except OSError as e:
+                logger.error(f"Error writing traffic capture to {self.path}: {e}")
+
+    # Ghi nốt buffer và chờ các lần ghi đang chạy (gọi khi tắt ứng dụng)
+    async def close(self):
+        await self.flush()
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+